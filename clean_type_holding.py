@@ -1,34 +1,43 @@
 import pandas as pd
 import re
 import requests
-import time
-import csv
-import random
 import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed, Future
 from pathlib import Path
 from datetime import datetime
 from prefect import task
 from difflib import SequenceMatcher
+from http_pool import get_session, close_sessions
+from rate_limiter import limiter_summary
+from csv_writer import CsvWriterThread, resume_line
+from resume_index import ResumeIndex
+from holding_type_store import HoldingTypeStore
 
 BASE_DIR = Path(__file__).resolve().parent
 INPUT_FILE = BASE_DIR / 'wealthmagik/raw_data/wealthmagik_holdings.csv' 
 OUTPUT_FILE = BASE_DIR / 'merged_output/merged_holding.csv'
 OUTPUT_FILE.parent.mkdir(parents=True, exist_ok=True)
-DB_FILE = Path('stock_type_holding.csv') 
-OTHER_DB_FILE = Path('other_type_holding.csv')
-RESUME_FILE = BASE_DIR / "clean_type_resume.log"
+STORE_FILE = BASE_DIR / "holding_type.db"
+DB_FILE = BASE_DIR / 'stock_type_holding.csv'  # old append-only caches, imported into STORE_FILE once
+OTHER_DB_FILE = BASE_DIR / 'other_type_holding.csv'
+RESUME_FILE = BASE_DIR / "clean_type_resume.log"  # old resume log, imported into the resume index once
 LOG_DIR = BASE_DIR / "Logs"
 LOG_DIR.mkdir(exist_ok=True)
 SEARCH_API_URL = "https://www.finnomena.com/market-info/api/public/search/_search"
 QUOTE_API_URL = "https://www.finnomena.com/market-info/api/public/stock/quote"
 HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'}
 current_date_str = datetime.now().strftime("%Y-%m-%d")
-stock_db_cache = {}
-other_db_cache = set()
+STORE = None
 LOG_BUFFER = []
-NUM_WORKERS = 3
+NUM_WORKERS = 3  # Threads, requests to www.finnomena.com are paced by rate_limiter. Don't set more than 3 to avoid ban
+POOL_NAME = "clean_type_holding"
+REFRESH_WORKERS = 2  # threads re-asking the API for entries past their TTL while the run goes on
+REFRESH_LIMIT = 200  # stale entries refreshed per run, the rest wait for the next one
+TWO_PHASE = True  # resolve every distinct holding once then join, False = old one task per row with resume
+FIELDNAMES = ['fund_code', 'symbol', 'type', 'sector', 'name', 'percent', 'as_of_date', 'source_url']
 _G_STORAGE = {}
+_LOOKUPS = {}  # holding code -> Future of its API lookup, shared by every row that holds it
+_REFRESH = {"executor": None, "codes": set()}
 
 def get_obj(name):
     if name not in _G_STORAGE:
@@ -53,9 +62,6 @@ def is_ticker_related(api_ticker, my_code):
     t2 = str(my_code).upper().replace(" ", "")
     return (t1 in t2) or (t2 in t1)
 
-def polite_sleep():
-    time.sleep(random.uniform(0.8, 1.5))
-
 def save_daily_log():
     log_filename = LOG_DIR / f"process_{current_date_str}.log"
     with open(log_filename, "a", encoding="utf-8") as f:
@@ -63,100 +69,97 @@ def save_daily_log():
     LOG_BUFFER.clear()
 
 def get_resume_state():
-    if not RESUME_FILE.exists(): return set()
-    finished = set()
-    try:
-        with open(RESUME_FILE, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        if not lines: return set()
-        first_line_parts = lines[0].strip().split('|')
-        if len(first_line_parts) < 2 or first_line_parts[1] != current_date_str:
-            RESUME_FILE.unlink()
-            return set()
-        for line in lines:
-            parts = line.strip().split('|')
-            if len(parts) >= 1: finished.add(parts[0])
-        return finished
-    except: return set()
-
-def append_resume_state(unique_key):
-    try:
-        with open(RESUME_FILE, 'a', encoding='utf-8') as f:
-            f.write(f"{unique_key}|{current_date_str}\n")
-    except: pass
+    return ResumeIndex(POOL_NAME, current_date_str, RESUME_FILE, log)
 
 def load_databases():
-    if DB_FILE.exists():
-        with open(DB_FILE, mode='r', encoding='utf-8-sig') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                saved_symbol = row.get('symbol', row['holding_code']) 
-                stock_db_cache[row['holding_code']] = (row['type'], row['sector'], saved_symbol)
-        log(f"load 'stock' from file: {len(stock_db_cache)}")
-    if OTHER_DB_FILE.exists():
-        with open(OTHER_DB_FILE, mode='r', encoding='utf-8-sig') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                other_db_cache.add(row['holding_code'])
-        log(f"load type 'other' from file: {len(other_db_cache)}")
+    global STORE
+    STORE = HoldingTypeStore(STORE_FILE)
+    STORE.import_csv(DB_FILE, OTHER_DB_FILE, log)
+    log(f"holding type store: {STORE.count()} codes")
 
-def save_to_other_db(code):
-    if code in other_db_cache: return
-    with get_obj("DB_LOCK"):
-        file_exists = OTHER_DB_FILE.exists()
-        with open(OTHER_DB_FILE, mode='a', encoding='utf-8-sig', newline='') as f:
-            writer = csv.DictWriter(f, fieldnames=['holding_code'])
-            if not file_exists: writer.writeheader()
-            writer.writerow({'holding_code': code})
-        other_db_cache.add(code)
+def save_to_other_db(code, hint_name='', source='api'):
+    STORE.put(code, 'Other', hint_name=hint_name, source=source)
 
-def save_to_stock_db(code, s_type, sector, real_symbol):
-    file_exists = DB_FILE.exists()
-    mode = 'a'
-    with open(DB_FILE, mode=mode, encoding='utf-8-sig', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=['holding_code', 'type', 'sector', 'symbol'])
-        if not file_exists: 
-            writer.writeheader()
-        writer.writerow({
-            'holding_code': code, 
-            'type': s_type, 
-            'sector': sector,
-            'symbol': real_symbol
-        })
-    stock_db_cache[code] = (s_type, sector, real_symbol)
+def save_to_stock_db(code, s_type, sector, real_symbol, hint_name=''):
+    STORE.put(code, s_type, sector, real_symbol, hint_name)
+
+def cached_type(code, hint_name):
+    # stored (type, sector, symbol) or None, a stale entry is used for this run and refreshed in the background
+    entry = STORE.get(code)
+    if not entry: return None
+    if not entry['fresh']: schedule_refresh(code, entry['hint_name'] or hint_name)
+    if entry['type'] == 'Other': return 'Other', '', ''
+    symbol = entry['symbol'] if str(entry['type']).startswith('Stock') else ''
+    return entry['type'], entry['sector'], symbol
+
+def schedule_refresh(code, hint_name):
+    with get_obj("REFRESH_LOCK"):
+        executor = _REFRESH["executor"]
+        if executor is None or code in _REFRESH["codes"] or len(_REFRESH["codes"]) >= REFRESH_LIMIT: return
+        _REFRESH["codes"].add(code)
+    executor.submit(refresh_holding, code, hint_name)
+
+def refresh_holding(code, hint_name):
+    if get_obj("STOP_EVENT").is_set(): return
+    temp_type, _ = classify_initial(hint_name or code, code)
+    if temp_type == 'Other':
+        save_to_other_db(code, hint_name, source='rule')
+    elif temp_type != 'Check_System':
+        STORE.delete(code)  # the rules place it now, nothing to keep
+    else:
+        check_stock_api(code, hint_name or code, refresh=True)
+        # answers are stored under the upper-case code, which is where the next lookup ends up
+        if code != code.upper(): STORE.delete(code)
+
+def stop_refresh(wait=True):
+    with get_obj("REFRESH_LOCK"):
+        executor, _REFRESH["executor"] = _REFRESH["executor"], None
+        refreshed = len(_REFRESH["codes"])
+        _REFRESH["codes"] = set()
+    if executor: executor.shutdown(wait=wait, cancel_futures=not wait)
+    return f"refreshed {refreshed} stale holding types"
+
+def lookup_once(code, hint_name):
+    # single flight: the first row holding a code asks the API, the others wait for that answer
+    key = code.upper()
+    with get_obj("LOOKUP_LOCK"):
+        future = _LOOKUPS.get(key)
+        owner = future is None
+        if owner: future = _LOOKUPS[key] = Future()
+    if not owner: return future.result()
+    try: result = check_stock_api(code, hint_name)
+    except Exception: result = ('Other', '', '')
+    future.set_result(result)
+    return result
+
+def resolve_holding(name, h_code, lookup=None):
+    # (type, sector, symbol) of one holding name, lookup is the API call for codes the rules can't place
+    lookup = lookup or check_stock_api
+    cached = cached_type(h_code, name)
+    if cached: return cached
+    temp_type, temp_sector = classify_initial(name, h_code)
+    if temp_type == 'Check_System':
+        return lookup(h_code, name)
+    if temp_type == 'Other':
+        save_to_other_db(h_code, name, source='rule')
+        return 'Other', '', ''
+    return temp_type, temp_sector, ''
 
 def process_row_task(row, writer, finished_keys):
     unique_key = f"{row['fund_code']}_{row['name']}"
     if unique_key in finished_keys: return None
     h_code = extract_code(row['name'])
-    res_type, res_sector, res_symbol = 'Other', '', ''
-    if h_code in other_db_cache:
-        res_type, res_sector, res_symbol = 'Other', '', ''
-    elif h_code in stock_db_cache:
-        res_type, res_sector, res_symbol = stock_db_cache[h_code]
-        if not str(res_type).startswith('Stock'):
-            res_symbol = ''
-    else:
-        temp_type, temp_sector = classify_initial(row['name'], h_code)
-        if temp_type == 'Check_System':
-            res_type, res_sector, res_symbol = check_stock_api(h_code, row['name'])
-        elif temp_type == 'Other':
-            save_to_other_db(h_code)
-            res_type, res_sector, res_symbol = 'Other', '', ''
-        else:
-            res_type, res_sector, res_symbol = temp_type, temp_sector, ''
-    with get_obj("CSV_LOCK"):
-        writer.writerow({
-            'fund_code': row['fund_code'],
-            'symbol': res_symbol,
-            'type': res_type,
-            'sector': res_sector,
-            'name': row['name'],
-            'percent': row['percent'],
-            'as_of_date': row['as_of_date'],
-            'source_url': row['source_url']
-        })
-        append_resume_state(unique_key)
+    res_type, res_sector, res_symbol = resolve_holding(row['name'], h_code)
+    writer.submit({"rows": [{
+        'fund_code': row['fund_code'],
+        'symbol': res_symbol,
+        'type': res_type,
+        'sector': res_sector,
+        'name': row['name'],
+        'percent': row['percent'],
+        'as_of_date': row['as_of_date'],
+        'source_url': row['source_url']
+    }]}, resume_line(unique_key, current_date_str, with_time=False))
     return f"{h_code} -> {res_symbol} ({res_type})"
 
 def extract_code(name):
@@ -196,10 +199,16 @@ def classify_initial(name_full, code):
     
     return 'Check_System', ''
 
-def check_stock_api(code, hint_name):
+def create_session():
+    s = requests.Session()
+    s.headers.update(HEADERS)
+    return s
+
+def check_stock_api(code, hint_name, refresh=False):
     code_up = code.upper()
-    if code_up in stock_db_cache: return stock_db_cache[code_up]
-    if code_up in other_db_cache: return ('Other', '', '')
+    if not refresh:
+        cached = cached_type(code_up, hint_name)
+        if cached: return cached
     clean_hint = hint_name.split('(')[0].strip()
     found_match = None
     best_score = 0
@@ -217,33 +226,98 @@ def check_stock_api(code, hint_name):
                     best_score = final_score
                     found_match = item
     try:
-        polite_sleep()
-        resp = requests.get(SEARCH_API_URL, headers=HEADERS, params={'q': code_up, 'size': 5}, timeout=5).json()
+        session = get_session(POOL_NAME, create_session)
+        resp = session.get(SEARCH_API_URL, params={'q': code_up, 'size': 5}, timeout=5).json()
         if 'data' in resp and resp['data']['result']:
             evaluate_candidates(resp['data']['result'])
         if not found_match and len(clean_hint) > 1:
-            polite_sleep()
-            resp_name = requests.get(SEARCH_API_URL, headers=HEADERS, params={'q': clean_hint, 'size': 10}, timeout=5).json()
+            resp_name = session.get(SEARCH_API_URL, params={'q': clean_hint, 'size': 10}, timeout=5).json()
             if 'data' in resp_name and resp_name['data']['result']:
                 evaluate_candidates(resp_name['data']['result'])
         if not found_match:
-            save_to_other_db(code_up)
+            save_to_other_db(code_up, hint_name)
             return ('Other', '', '')
         match = found_match
         real_symbol = match.get('title', code_up).upper()
         if match.get('type_en', '').lower() == 'fund': 
+            save_to_stock_db(code_up, 'Fund', '', '', hint_name)
             return ('Fund', '', '')
         country = match.get('meta', {}).get('country_iso', 'TH')
         final_type = f"Stock ({country})"
         ex = 'US' if country == 'US' else ('HK' if country == 'HK' else None)
-        q_res = requests.get(f"{QUOTE_API_URL}/{real_symbol}", headers=HEADERS, params={'exchange': ex} if ex else {}, timeout=5).json()
+        q_res = session.get(f"{QUOTE_API_URL}/{real_symbol}", params={'exchange': ex} if ex else {}, timeout=5).json()
         sector = q_res.get('data', {}).get('sector', '') if q_res.get('status') else ''
         if sector == '-': sector = ''
-        save_to_stock_db(code_up, final_type, sector, real_symbol) 
+        save_to_stock_db(code_up, final_type, sector, real_symbol, hint_name) 
         return (final_type, sector, real_symbol)
     except Exception as e:
         return ('Other', '', '')
 
+def resolve_unique(names):
+    # phase one: every distinct holding name once, concurrent API lookups collapse per code
+    _LOOKUPS.clear()
+    resolved = {}
+    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+        futures = {executor.submit(resolve_holding, name, extract_code(name), lookup_once): name for name in names}
+        for i, future in enumerate(as_completed(futures), 1):
+            if get_obj("STOP_EVENT").is_set(): break
+            name = futures[future]
+            try:
+                resolved[name] = future.result()
+                res_type, _, res_symbol = resolved[name]
+                log(f"[{i}/{len(names)}] {extract_code(name)} -> {res_symbol} ({res_type})")
+            except Exception as e:
+                log(f"error holding {name} because: {e}")
+            if i % 20 == 0:
+                save_daily_log()
+    return resolved
+
+def clean_two_phase(df, finished_keys):
+    df = df.copy()
+    df['name_key'] = df['name'].astype(str)
+    names = list(df['name_key'].unique())
+    log(f"{len(df)} rows, {len(names)} distinct holdings")
+    resolved = resolve_unique(names)
+    if len(resolved) < len(names):
+        log(f"stopped with {len(names) - len(resolved)} holdings left, {OUTPUT_FILE.name} not written")
+        return
+    # phase two: join the answers back onto every row
+    lookup = pd.DataFrame(
+        [(name, t, sector, symbol) for name, (t, sector, symbol) in resolved.items()],
+        columns=['name_key', 'type', 'sector', 'symbol']
+    )
+    merged = df.drop(columns=[c for c in ['type', 'sector', 'symbol'] if c in df.columns]).merge(lookup, on='name_key', how='left')
+    tmp_path = OUTPUT_FILE.with_suffix(".tmp")
+    merged[FIELDNAMES].to_csv(tmp_path, index=False, encoding='utf-8-sig')
+    tmp_path.replace(OUTPUT_FILE)
+    # the file is complete, an old per-row resume state has nothing left to resume
+    finished_keys.clear()
+    log(f"wrote {len(merged)} rows to {OUTPUT_FILE.name}")
+
+def clean_rows(df, finished_keys):
+    total_rows = len(df)
+    file_mode = 'a' if OUTPUT_FILE.exists() and len(finished_keys) > 0 else 'w'
+    writer = CsvWriterThread(finished_keys, log, POOL_NAME)
+    try:
+        writer.add_output("rows", OUTPUT_FILE, FIELDNAMES, file_mode, file_mode == 'w').start()
+        with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+            rows = df.to_dict('records')
+            futures = [executor.submit(process_row_task, row, writer, finished_keys) for row in rows]
+            for i, future in enumerate(as_completed(futures), 1):
+                if get_obj("STOP_EVENT").is_set():
+                    break
+                try:
+                    result = future.result()
+                    if result:
+                        log(f"[{i}/{total_rows}] {result}")
+                except Exception as e:
+                    log(f"error line {i} because: {e}")
+                if i % 20 == 0:
+                    save_daily_log()
+    finally:
+        writer.close()
+        log(writer.summary())
+
 @task(name="clean_type_holding", log_prints=True)
 def clean_holding():
     log("clean type of holding start")
@@ -253,33 +327,20 @@ def clean_holding():
     load_databases()
     finished_keys = get_resume_state()
     df = pd.read_csv(INPUT_FILE, low_memory=False)
-    total_rows = len(df)
-    fieldnames = ['fund_code', 'symbol', 'type', 'sector', 'name', 'percent', 'as_of_date', 'source_url']
-    file_mode = 'a' if OUTPUT_FILE.exists() and len(finished_keys) > 0 else 'w'
+    _REFRESH["executor"] = ThreadPoolExecutor(max_workers=REFRESH_WORKERS)
     try:
-        with open(OUTPUT_FILE, mode=file_mode, encoding='utf-8-sig', newline='') as outfile:
-            writer = csv.DictWriter(outfile, fieldnames=fieldnames)
-            if file_mode == 'w': writer.writeheader()
-            with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
-                rows = df.to_dict('records')
-                futures = [executor.submit(process_row_task, row, writer, finished_keys) for row in rows]
-                for i, future in enumerate(as_completed(futures), 1):
-                    if get_obj("STOP_EVENT").is_set():
-                        break
-                    try:
-                        result = future.result()
-                        if result:
-                            log(f"[{i}/{total_rows}] {result}")
-                    except Exception as e:
-                        log(f"error line {i} because: {e}")
-                    if i % 20 == 0:
-                        with get_obj("CSV_LOCK"):
-                            outfile.flush()
-                        save_daily_log()
-
+        if TWO_PHASE: clean_two_phase(df, finished_keys)
+        else: clean_rows(df, finished_keys)
     except KeyboardInterrupt:
         log("\nstop now")
+        get_obj("STOP_EVENT").set()
     finally:
+        log(stop_refresh(wait=not get_obj("STOP_EVENT").is_set()))
+        finished_keys.close()
+        log(STORE.summary())
+        STORE.close()
+        log(close_sessions(POOL_NAME))
+        log(limiter_summary("www.finnomena.com"))
         save_daily_log()
         log(f"done (clean type holding)")
 
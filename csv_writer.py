@@ -0,0 +1,143 @@
+import csv
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+import metrics
+from resume_index import ResumeIndex
+
+# CONFIG
+BUFFER_SIZE = 1024 * 1024  # bytes buffered per output file between commits
+QUEUE_SIZE = 2000  # row batches waiting for the writer, workers only wait when it falls this far behind
+COMMIT_EVERY = 50  # resume/journal markers per group commit
+COMMIT_SECONDS = 2.0  # commit at least this often while rows are coming in
+FSYNC = True  # data reaches the disk before the resume markers that point at it
+_STOP = object()
+
+def resume_line(code, date_str, with_time=True):
+    if with_time: return f"{code}|{date_str}|{datetime.now().strftime('%H:%M:%S')}\n"
+    return f"{code}|{date_str}\n"
+
+# owns every output file of a scraper, workers hand over row batches through a queue
+class CsvWriterThread:
+    def __init__(self, resume_file=None, log=print, name="writer", journal_file=None, on_commit=None):
+        # resume_file: a ResumeIndex (or a plain log path), markers land there after the rows they stand for
+        # on_commit: called with the resume markers of every commit that reached the disk
+        self.resume_file = resume_file
+        self.on_commit = on_commit
+        self.journal_file = journal_file
+        self.log = log
+        self.name = name
+        self.outputs = {}
+        self.sinks = {}
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.thread = None
+        self.resume_handle = None
+        self.journal_handle = None
+        self.stats = {"rows": 0, "markers": 0, "commits": 0}
+
+    def add_output(self, key, path, fieldnames, mode="a", write_header=False, encoding="utf-8-sig"):
+        f = open(path, mode, newline="", encoding=encoding, buffering=BUFFER_SIZE)
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        if write_header: writer.writeheader()
+        self.outputs[key] = (f, writer)
+        return self
+
+    def add_sink(self, key, flush):
+        # rows submitted under key are not csv rows, they are handed to flush(rows) on this thread
+        # at every commit, before the resume markers that stand for them; if flush raises, the rows are
+        # tried again at the next commit and the commit itself still goes ahead
+        self.sinks[key] = (flush, [])
+        return self
+
+    def start(self):
+        if self.resume_file and not isinstance(self.resume_file, ResumeIndex):
+            self.resume_handle = open(self.resume_file, 'a', encoding='utf-8')
+        if self.journal_file:
+            self.journal_handle = open(self.journal_file, 'a', encoding='utf-8')
+        self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self.thread.start()
+        return self
+
+    def submit(self, rows=None, resume=None, journal=None):
+        # rows: {output key: [row dict, ...]}, resume: a ready resume log line (or a list of them) written after the rows are on disk
+        # journal: extra checkpoint lines, committed the same way
+        self.queue.put((rows or {}, resume, journal or []))
+        metrics.QUEUE_DEPTH.set(self.queue.qsize(), task=self.name, queue="writer")
+
+    def run(self):
+        markers, journal = [], []
+        last_commit = time.monotonic()
+        while True:
+            try: item = self.queue.get(timeout=COMMIT_SECONDS)
+            except queue.Empty: item = None
+            if item is _STOP: break
+            if item:
+                rows, resume, lines = item
+                try:
+                    for key, batch in rows.items():
+                        if not batch: continue
+                        if key in self.sinks: self.sinks[key][1].extend(batch)
+                        else: self.outputs[key][1].writerows(batch)
+                        self.stats["rows"] += len(batch)
+                    if isinstance(resume, list): markers.extend(resume)
+                    elif resume: markers.append(resume)
+                    journal.extend(lines)
+                except Exception as e:
+                    self.log(f"Error writing rows: {e}")
+            pending = len(markers) + len(journal)
+            if pending and (pending >= COMMIT_EVERY or time.monotonic() - last_commit >= COMMIT_SECONDS):
+                self.commit(markers, journal)
+                markers, journal = [], []
+                last_commit = time.monotonic()
+        self.commit(markers, journal)
+
+    def append_lines(self, handle, lines):
+        if not lines or not handle: return
+        handle.write("".join(lines))
+        handle.flush()
+        if FSYNC: os.fsync(handle.fileno())
+
+    def commit(self, markers, journal=None):
+        for key, (flush, buffered) in self.sinks.items():
+            if not buffered: continue
+            batch = buffered[:]
+            buffered.clear()
+            try: flush(batch)
+            except Exception as e:
+                # the rows wait for the next commit, the csv rows and markers below still go out:
+                # dropping the markers would redo those funds and write their csv rows twice
+                buffered[:0] = batch
+                self.log(f"Error writing {key} rows, kept for the next commit: {e}")
+        try:
+            for f, _ in self.outputs.values():
+                f.flush()
+                if FSYNC: os.fsync(f.fileno())
+            self.append_lines(self.journal_handle, journal)
+            if isinstance(self.resume_file, ResumeIndex):
+                if markers: self.resume_file.add_lines(markers)
+            else:
+                self.append_lines(self.resume_handle, markers)
+            self.stats["markers"] += len(markers)
+            self.stats["commits"] += 1
+            if self.on_commit and markers: self.on_commit(markers)
+        except Exception as e:
+            self.log(f"Error committing output: {e}")
+
+    def close(self):
+        if self.thread:
+            self.queue.put(_STOP)
+            self.thread.join()
+            self.thread = None
+        for f, _ in self.outputs.values():
+            try: f.close()
+            except: pass
+        for handle in [self.resume_handle, self.journal_handle]:
+            if handle:
+                try: handle.close()
+                except: pass
+        self.resume_handle = self.journal_handle = None
+
+    def summary(self):
+        return f"Writer ({self.name}): {self.stats['rows']} rows, {self.stats['markers']} resume markers in {self.stats['commits']} commits"
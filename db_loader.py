@@ -6,6 +6,7 @@ import numpy as np
 from datetime import datetime, timedelta
 from sqlalchemy import create_engine, text, inspect
 from prefect import task
+from nav_store import NavStore, MERGED_NAV_SCHEMA
 
 # CONFIGURATION
 DB_USER = "root"
@@ -15,7 +16,9 @@ DB_PORT = "3306"
 DB_NAME = "thai_funds"
 script_dir = Path(__file__).resolve().parent
 MERGED_DIR = script_dir/"merged_output"
-NAV_DIR = MERGED_DIR/"merged_nav_all"
+NAV_STORE_DIR = MERGED_DIR/"merged_nav_store"
+SEC_DELTA_CSV = "sec_fund_info_delta.csv"  # only the SEC rows that changed, written by scrape_sec_info
+NAV_INSERT_CHUNK = 5000
 INIT_SQL_PATH = script_dir/"init.sql"
 LOOKBACK_DAYS = 7
 
@@ -161,66 +164,75 @@ def sync_master_info(engine):
         except Exception as e:
             log(f"Error syncing Master Info: {e}")
 
+def upsert_nav_rows(conn, insert_sql, df):
+    df = df.astype(object).where(pd.notna(df), None)
+    params = [{
+        "fund_code": row.fund_code,
+        "nav_date": row.date,
+        "nav_value": row.value,
+        "aum": row.amount,
+        "bid": row.bid,
+        "offer": row.offer,
+        "source": row.source_nav or 'merged'
+    } for row in df.itertuples(index=False)]
+    for i in range(0, len(params), NAV_INSERT_CHUNK):
+        conn.execute(insert_sql, params[i:i + NAV_INSERT_CHUNK])
+    conn.commit()
+
 def sync_daily_nav(engine):
     log("Syncing Daily NAVs")
-    nav_files = list(NAV_DIR.glob("merged_nav_*.csv"))
-    if not nav_files:
-        log("No NAV files found")
+    nav_store = NavStore(NAV_STORE_DIR, schema=MERGED_NAV_SCHEMA)
+    if nav_store.is_empty():
+        log("No NAV store found")
         return
+    insert_sql = text("""
+        INSERT INTO funds_daily (fund_code, nav_date, nav_value, aum, bid, offer, source)
+        VALUES (:fund_code, :nav_date, :nav_value, :aum, :bid, :offer, :source)
+        ON DUPLICATE KEY UPDATE 
+            nav_value = VALUES(nav_value),
+            aum = VALUES(aum),
+            bid = VALUES(bid),
+            offer = VALUES(offer),
+            source = VALUES(source);
+    """)
+    changes = nav_store.changes()
     count = 0
-    for filepath in nav_files:
-        fund_code = ""
+    failed = False
+    with engine.connect() as conn:
         try:
-            df = pd.read_csv(filepath)
-            if df.empty: continue
-            if 'fund_code' in df.columns:
-                fund_code = str(df.iloc[0]['fund_code']).strip()
-            else:
-                fund_code = filepath.stem.removeprefix("merged_nav_")
-            with engine.connect() as conn:
-                res = conn.execute(text(f"SELECT MAX(nav_date) FROM funds_daily WHERE fund_code = '{fund_code}'"))
-                max_date = res.scalar()
-                if max_date:
-                    last_date_obj = pd.to_datetime(max_date)
-                    cutoff_date = last_date_obj - timedelta(days=LOOKBACK_DAYS)
-                    date_col_name = 'nav_date' if 'nav_date' in df.columns else 'date'
-                    df['date_obj'] = pd.to_datetime(df[date_col_name], format="%d-%m-%Y", errors='coerce')
-                    df = df[df['date_obj'] > cutoff_date]
-                    df = df.drop(columns=['date_obj'])
-                if df.empty: continue
-                values_list = []
-                for _, row in df.iterrows():
-                    nav_date = get_sql_val(row.get('nav_date') or row.get('date'), is_date=True)
-                    nav_val = get_sql_val(row.get('nav_value') or row.get('value'))
-                    aum = get_sql_val(row.get('aum') or row.get('amount'))
-                    bid = get_sql_val(row.get('bid_price_per_unit') or row.get('bid') or row.get('bid_price'))
-                    offer = get_sql_val(row.get('offer_price_per_unit') or row.get('offer') or row.get('offer_price'))
-                    source = get_sql_val(row.get('data_source') or row.get('source_nav') or 'merged')
-                    values_list.append(f"('{fund_code}', {nav_date}, {nav_val}, {aum}, {bid}, {offer}, {source})")
-                if values_list:
-                    sql = f"""
-                        INSERT INTO funds_daily (fund_code, nav_date, nav_value, aum, bid, offer, source)
-                        VALUES {", ".join(values_list)}
-                        ON DUPLICATE KEY UPDATE 
-                            nav_value = VALUES(nav_value),
-                            aum = VALUES(aum),
-                            bid = VALUES(bid),
-                            offer = VALUES(offer),
-                            source = VALUES(source);
-                    """
-                    conn.execute(text(sql))
-                    conn.commit()
-                    count += 1
+            res = conn.execute(text("SELECT fund_code, MAX(nav_date) FROM funds_daily GROUP BY fund_code"))
+            cutoff_map = {code: pd.to_datetime(max_date) - timedelta(days=LOOKBACK_DAYS) for code, max_date in res if max_date}
         except Exception as e:
-            log(f"Error processing NAV {fund_code}: {e}")
+            log(f"Error reading NAV max dates: {e}")
+            return
+        if changes is not None and cutoff_map:
+            # only the funds merge_funds touched since the last load, from their first changed date
+            buckets = nav_store.read_since(changes)
+        else:
+            buckets = ((bucket, table.to_pandas()) for bucket, table in nav_store.iter_buckets())
+        for bucket, df in buckets:
+            try:
+                if changes is None or not cutoff_map:
+                    df['date_obj'] = pd.to_datetime(df['date'])
+                    cutoff = df['fund_code'].map(cutoff_map)
+                    df = df[cutoff.isna() | (df['date_obj'] > cutoff)]
+                if df.empty: continue
+                upsert_nav_rows(conn, insert_sql, df)
+                count += df['fund_code'].nunique()
+            except Exception as e:
+                failed = True
+                log(f"Error processing NAV bucket {bucket}: {e}")
+    # what was loaded is acknowledged only when every bucket made it, a failed one is retried in full next time
+    if not failed: nav_store.ack(changes)
     log(f"Updated NAVs for {count} funds")
 
 def sync_generic_table(engine, csv_name, table_name, pk_col):
+    # True once every row is in the table, False on errors, None when there is no file
     filepath = MERGED_DIR/csv_name
     if not filepath.exists(): return
     log(f"Syncing {table_name}")
     df = pd.read_csv(filepath)
-    if df.empty: return
+    if df.empty: return True
     date_cols_map = {
         "funds_statistics": ["as_of_date"],
         "funds_fee": [],
@@ -247,9 +259,19 @@ def sync_generic_table(engine, csv_name, table_name, pk_col):
                 """
                 conn.execute(text(sql))
             conn.commit()
-            log(f"Synced {table_name}")
+            log(f"Synced {table_name} ({len(df)} rows)")
+            return True
         except Exception as e:
             log(f"Error syncing {table_name}: {e}")
+            return False
+
+def sync_statistics(engine):
+    # the delta keeps piling up until a load gets through, so a failed run is picked up by the next one
+    if not sync_generic_table(engine, SEC_DELTA_CSV, "funds_statistics", "fund_code"):
+        if not (MERGED_DIR/SEC_DELTA_CSV).exists(): log("No changed SEC statistics")
+        return
+    try: (MERGED_DIR/SEC_DELTA_CSV).unlink()
+    except Exception as e: log(f"Cannot remove {SEC_DELTA_CSV}: {e}")
 
 def sync_portfolio_table(engine, csv_name, table_name):
     filepath = MERGED_DIR/csv_name
@@ -314,7 +336,7 @@ def db_loader():
         log(f"Database Connection Failed: {e}")
         return
     sync_master_info(engine)
-    sync_generic_table(engine, "all_sec_fund_info.csv", "funds_statistics", "fund_code")
+    sync_statistics(engine)
     sync_generic_table(engine, "merged_fee.csv", "funds_fee", "fund_code")
     sync_generic_table(engine, "merged_codes.csv", "funds_codes", "fund_code")
     sync_portfolio_table(engine, "merged_holding.csv", "funds_holding")
@@ -0,0 +1,115 @@
+import os
+import re
+import sys
+import pickle
+import signal
+import logging
+import subprocess
+import pdfplumber
+from io import BytesIO
+from pathlib import Path
+
+# Runs inside the PDF parser processes, keep imports light so they start fast
+ROOT_DIR = Path(__file__).resolve().parent.parent
+logging.getLogger("pdfminer").setLevel(logging.CRITICAL)
+ISIN_PATTERN = re.compile(r"\b([A-Z]{2}[A-Z0-9]{9}[0-9])\b")
+ISIN_HEADER = re.compile(r"\bISIN\b", re.IGNORECASE)
+
+def page_scan_order(total_pages, target_pages=None):
+    order = [p for p in (target_pages or []) if 0 <= p < total_pages]
+    return order + [p for p in range(total_pages) if p not in order]
+
+def extract_page_text(page, crop_bbox=None):
+    if crop_bbox:
+        # crop_bbox is (x0, top, x1, bottom) as fractions of the page size
+        x0, top, x1, bottom = crop_bbox
+        page = page.crop((x0 * page.width, top * page.height, x1 * page.width, bottom * page.height))
+    return page.extract_text(x_tolerance=3, y_tolerance=3) or ""
+
+def scan_pages(pdf, pages, crop_bbox, early_exit, isins):
+    # adds the codes of pages to isins, returns (pages parsed, True if the end of the code list was seen,
+    # True if an ISIN header or code showed up at all)
+    pages_parsed = 0
+    header_seen = False
+    for page_no in pages:
+        text = extract_page_text(pdf.pages[page_no], crop_bbox)
+        found = set(ISIN_PATTERN.findall(text))
+        pages_parsed += 1
+        header_seen = header_seen or bool(found) or bool(ISIN_HEADER.search(text))
+        # a code list can run over a page break, stop at the first page after it that adds nothing
+        if early_exit and isins and not (found - isins): return pages_parsed, True, header_seen
+        isins |= found
+    return pages_parsed, False, header_seen
+
+def parse_pdf_isins(content, max_pages=None, target_pages=None, crop_bbox=None, early_exit=True):
+    isins = set()
+    with pdfplumber.open(BytesIO(content)) as pdf:
+        total_pages = len(pdf.pages)
+        order = page_scan_order(total_pages, target_pages)
+        capped = order[:max_pages] if max_pages else order
+        pages_parsed, list_ended, header_seen = scan_pages(pdf, capped, crop_bbox, early_exit, isins)
+        if not isins and crop_bbox:
+            # the crop may have cut the list off, read the same pages whole
+            more, list_ended, header_seen = scan_pages(pdf, capped, None, early_exit, isins)
+            pages_parsed += more
+            crop_bbox = None
+        # past the cap only when the first pages show an ISIN list that they did not finish,
+        # a factsheet without one (most Thai funds) stops here
+        if len(capped) < total_pages and header_seen and not list_ended:
+            more, _, _ = scan_pages(pdf, order[len(capped):], crop_bbox, early_exit, isins)
+            pages_parsed += more
+    return isins, pages_parsed, total_pages
+
+def init_worker():
+    # Ctrl-C is handled by the scraper through STOP_EVENT, the parser is stopped by closing its stdin
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def serve():
+    # entry point of a parser process: pickled arguments of parse_pdf_isins come in on stdin,
+    # a pickled (ok, result or error text) goes back on stdout, one factsheet at a time
+    init_worker()
+    out = os.fdopen(os.dup(1), "wb")
+    os.dup2(2, 1)  # whatever pdfminer prints lands on stderr, stdout only carries results
+    requests = sys.stdin.buffer
+    while True:
+        try: args = pickle.load(requests)
+        except EOFError: return
+        try: result = (True, parse_pdf_isins(*args))
+        except Exception as e: result = (False, f"{type(e).__name__}: {e}")
+        pickle.dump(result, out)
+        out.flush()
+
+# A parser child started with its own entry point (python -m finnomena.pdf_isin). Unlike a multiprocessing
+# spawn or forkserver child it never runs the parent's __main__ again, which under Prefect would be
+# master_runner with Prefect and every scraper (about 2 s and 190 MB per process)
+class ParserProcess:
+    def __init__(self):
+        self.proc = None
+
+    def parse(self, *args):
+        # blocking, call it from a thread; the child starts on first use and again after it died
+        if self.proc is None or self.proc.poll() is not None:
+            self.proc = subprocess.Popen([sys.executable, "-m", "finnomena.pdf_isin"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=ROOT_DIR)
+        try:
+            pickle.dump(args, self.proc.stdin)
+            self.proc.stdin.flush()
+            ok, result = pickle.load(self.proc.stdout)
+        except (EOFError, OSError, pickle.UnpicklingError) as e:
+            self.close(kill=True)
+            raise RuntimeError(f"PDF parser process stopped: {e!r}")
+        if not ok: raise RuntimeError(result)
+        return result
+
+    def close(self, kill=False):
+        proc, self.proc = self.proc, None
+        if proc is None: return
+        if kill: proc.kill()
+        try: proc.stdin.close()
+        except: pass
+        try: proc.wait(timeout=10)
+        except subprocess.TimeoutExpired: proc.kill()
+        try: proc.stdout.close()
+        except: pass
+
+if __name__ == "__main__":
+    serve()
@@ -1,28 +1,38 @@
-import requests
+import asyncio
+import aiohttp
 import csv
+import json
+import hashlib
+import os
 import time
-import re
-import random
-import pdfplumber
-import logging
 import threading
+import sys
+import pandas as pd
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from io import BytesIO
+from urllib.parse import urlparse
 from datetime import datetime
 from prefect import task
 
 # CONFIG
-logging.getLogger("pdfminer").setLevel(logging.CRITICAL)
 script_dir = Path(__file__).resolve().parent
 current_date_str = datetime.now().strftime("%Y-%m-%d")
 root = script_dir.parent
 FN_RAW_DATA_DIR = script_dir/"raw_data"
-NAV_ALL_DIR = script_dir/"all_nav"
+NAV_ALL_DIR = script_dir/"all_nav"  # old one-csv-per-fund layout, only read once for migration
+NAV_STORE_DIR = script_dir/"nav_store"
 WM_DIR = root/"wealthmagik"
 WM_RAW_DATA_DIR = WM_DIR/"raw_data"
-for d in [FN_RAW_DATA_DIR, NAV_ALL_DIR]:
+for d in [FN_RAW_DATA_DIR, NAV_STORE_DIR]:
     d.mkdir(parents=True, exist_ok=True)
+if str(root) not in sys.path: sys.path.append(str(root))
+from nav_store import NavStore, import_csv_dir
+from http_cache import HttpCache
+from http_pool import get_stats, close_sessions
+from rate_limiter import get_limiter, limiter_summary
+from csv_writer import CsvWriterThread, resume_line
+from resume_index import ResumeIndex
+import metrics
+from finnomena.pdf_isin import ParserProcess
 OUTPUT_FUND_LIST = FN_RAW_DATA_DIR/"finnomena_fund_list.csv"
 OUTPUT_MASTER    = FN_RAW_DATA_DIR/"finnomena_info.csv"
 OUTPUT_ALLOCATIONS = FN_RAW_DATA_DIR/"finnomena_allocations.csv"
@@ -30,12 +40,53 @@ OUTPUT_FEES      = FN_RAW_DATA_DIR/"finnomena_fees.csv"
 OUTPUT_CODES     = FN_RAW_DATA_DIR/"finnomena_codes.csv"
 OUTPUT_PERFORMANCE = FN_RAW_DATA_DIR/"finnomena_performance.csv"
 WM_LIST_FILE = WM_RAW_DATA_DIR/"wealthmagik_fund_list.csv"
-RESUME_FILE = script_dir/"scrape_finnomena_resume.log"
+RESUME_FILE = script_dir/"scrape_finnomena_resume.log"  # old resume log, imported into the resume index once
+CHECKPOINT_FILE = script_dir/"scrape_finnomena_checkpoint.log"  # code|date|time|stage|ok/fail, one line per stage attempt
 PDF_LOG_FILE = script_dir/"last_pdf_run.log"
+HTTP_CACHE_FILE = script_dir/"http_cache.sqlite"
+PDF_CACHE_FILE = script_dir/"pdf_isin_cache.json"
+FINGERPRINT_FILE = script_dir/"fund_fingerprints.json"
 LOG_BUFFER = []
 HAS_ERROR = False
 _G_STORAGE = {}
-NUM_WORKERS = 3  # Number of threads. Don't set more than 3 to avoid ban
+FUNDS_IN_FLIGHT = 40  # Funds inside the stage pipeline at the same time (no thread per fund)
+STAGES = ["info", "nav", "fee", "portfolio", "codes", "performance"]
+STAGE_AFTER_INFO = ["fee", "codes"]  # need min buy / factsheet url from info, the rest start right away
+STAGE_CONCURRENCY = {"info": 2, "nav": 1, "fee": 1, "portfolio": 1, "codes": 3, "performance": 1}  # workers per stage, requests per host are paced by rate_limiter
+STAGE_QUEUE_SIZE = {"info": 20, "nav": 20, "fee": 20, "portfolio": 20, "codes": 20, "performance": 20}  # funds waiting in front of each stage
+STAGE_REPORT_SECONDS = 60  # log per-stage throughput and queue depth this often
+STAGE_STATS = {}
+STAGE_OUTPUTS = {"info": ["master"], "nav": [], "fee": ["fees"], "portfolio": ["allocations"], "codes": ["codes"], "performance": ["performance"]}
+CHECKPOINTS = {}  # fund code -> stages already done today
+POOL_NAME = "finnomena"
+NAV_INCREMENTAL = True  # Only request the newest NAV window for funds that already have history
+NAV_WINDOWS = [(25, "1M"), (85, "3M"), (175, "6M"), (360, "1Y")]  # (days since last stored NAV, range to request)
+NAV_STATS = {"incremental": 0, "full": 0, "backfill": 0}
+NAV_COLUMNS = ["fund_code", "date", "value", "amount"]
+LAST_NAV_DATES = {}
+HTTP_CACHE_ENABLED = True
+HTTP_CACHE_TTL = {  # seconds a cached response is used without asking the server, 0 = always send a conditional request
+    "info": 72 * 3600,
+    "fee": 7 * 24 * 3600,
+    "portfolio": 20 * 3600,
+    "performance": 0,
+}
+HTTP_CACHE = None
+PDF_PARSE_WORKERS = 2  # Processes for pdfplumber, parsing no longer holds the GIL of the fetch loop
+PDF_QUEUE_SIZE = 20  # Downloaded factsheets waiting to be parsed
+PDF_QUEUE = None
+PDF_EARLY_EXIT = True  # Stop reading a factsheet once the ISIN list has been passed
+PDF_MAX_PAGES = 3  # Pages read first (None = all), the rest only when they show an ISIN header or codes and the list runs on
+PDF_TARGET_PAGES = [0, 1]  # Pages (0 = first) where codes usually appear, scanned before the rest
+PDF_CROP_BBOX = None  # e.g. (0, 0.3, 1, 1) to only read the lower 70% of each page
+PDF_CACHE = {}  # factsheet url -> sha256, validators and the ISINs found last time
+PDF_STATS = {"parsed": 0, "same_hash": 0, "not_modified": 0}
+PDF_PAGE_STATS = {"parsed": 0, "total": 0}
+FINGERPRINT_ENABLED = True  # Skip the info and fee calls for funds whose fund list entry did not change
+FINGERPRINT_MAX_AGE = 7 * 24 * 3600  # Seconds, info and fee are fetched again after this even if the entry looks the same
+FINGERPRINT_VOLATILE = ("nav", "return", "price", "date", "aum", "updated")  # List fields that move every day, left out of the fingerprint
+FUND_FINGERPRINTS = {}  # fund code -> fingerprint, when it was fetched, the info/fee rows and factsheet url
+FINGERPRINT_STATS = {"reused": 0, "fetched": 0}
 
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
@@ -72,77 +123,128 @@ def save_log_if_error():
     except: pass
 
 def get_resume_state():
-    if not RESUME_FILE.exists(): return set()
-    finished = set()
+    finished = ResumeIndex(POOL_NAME, current_date_str, RESUME_FILE, log)
+    if finished: log(f"Resuming Found {len(finished)} funds done")
+    return finished
+
+def load_checkpoints():
+    CHECKPOINTS.clear()
+    if not CHECKPOINT_FILE.exists(): return
     try:
-        with open(RESUME_FILE, 'r', encoding='utf-8') as f:
+        with open(CHECKPOINT_FILE, 'r', encoding='utf-8') as f:
             lines = f.readlines()
-        if not lines: return set()
+        if not lines: return
         first_line_parts = lines[0].strip().split('|')
         if len(first_line_parts) < 2 or first_line_parts[1] != current_date_str:
-            log(f"Resume file date mismatch Deleting and starting new")
-            try: RESUME_FILE.unlink()
+            try: CHECKPOINT_FILE.unlink()
             except: pass
-            return set()
+            return
         for line in lines:
             parts = line.strip().split('|')
-            if len(parts) >= 1: finished.add(parts[0])
-        log(f"Resuming Found {len(finished)} funds done")
-        return finished
-    except Exception as e: 
-        log(f"Error reading resume file: {e}")
-        return set()
+            if len(parts) < 5: continue
+            done = CHECKPOINTS.setdefault(parts[0], set())
+            if parts[4] == "ok": done.add(parts[3])
+            else: done.discard(parts[3])
+        partial = sum(1 for done in CHECKPOINTS.values() if done and len(done) < len(STAGES))
+        log(f"Checkpoints: {partial} funds partly done today, only their missing stages are fetched")
+    except Exception as e:
+        log(f"Error reading checkpoint file: {e}")
 
-def append_resume_state(code):
-    with get_obj("CSV_LOCK"):
-        try:
-            current_time = datetime.now().strftime("%H:%M:%S")
-            with open(RESUME_FILE, 'a', encoding='utf-8') as f:
-                f.write(f"{code}|{current_date_str}|{current_time}\n")
-        except: pass
+def checkpoint_line(code, stage, ok):
+    return f"{code}|{current_date_str}|{datetime.now().strftime('%H:%M:%S')}|{stage}|{'ok' if ok else 'fail'}\n"
 
 def cleanup_resume_file():
-    if RESUME_FILE.exists():
+    try: ResumeIndex(POOL_NAME, current_date_str, log=log).clear()
+    except: pass
+    if CHECKPOINT_FILE.exists():
         try:
-            RESUME_FILE.unlink()
-            log("Resume file deleted")
+            CHECKPOINT_FILE.unlink()
+            log(f"{CHECKPOINT_FILE.name} deleted")
         except: pass
 
-def sanitize_filename(name):
-    if not name: return "unknown_fund"
-    return re.sub(r'[<>:"/\\|?*]', '_', name).strip()
-
 def format_date(iso_date):
     if not iso_date: return ""
     try:
         return datetime.fromisoformat(iso_date.replace("Z", "+00:00")).strftime("%d-%m-%Y")
     except: return iso_date
 
-def safe_api_get(url, params=None):
+def parse_nav_date(date_str):
+    try: return datetime.strptime(date_str, "%d-%m-%Y")
+    except: return None
+
+def pick_nav_range(last_nav_date):
+    if not last_nav_date: return "MAX"
+    days_behind = (datetime.now() - last_nav_date).days
+    for max_days, nav_range in NAV_WINDOWS:
+        if days_behind <= max_days: return nav_range
+    return "MAX"
+
+def create_session():
+    # one keep-alive connector for the whole run, the trace counts handshakes vs requests
+    stats = get_stats(POOL_NAME)
+    async def on_request_start(session, ctx, params): stats.add_request()
+    async def on_connection_create_end(session, ctx, params): stats.add_connection()
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(on_request_start)
+    trace.on_connection_create_end.append(on_connection_create_end)
+    connector = aiohttp.TCPConnector(limit=sum(STAGE_CONCURRENCY.values()) * 2, ttl_dns_cache=300, keepalive_timeout=60)
+    return aiohttp.ClientSession(headers=HEADERS, connector=connector, trace_configs=[trace])
+
+async def safe_api_get(session, url, params=None, endpoint=None, missing=None):
+    # None means the call failed, a 404 returns `missing` so callers can tell "no data" from "try again"
     MAX_RETRIES = 3
     RETRY_DELAY = 3
+    limiter = get_limiter(urlparse(url).hostname)
+    cache = HTTP_CACHE if endpoint else None
+    cached = cache.lookup(url, endpoint) if cache else None
+    if cached and cached["fresh"]:
+        cache.record("fresh")
+        return json.loads(cached["body"])
+    headers = cache.conditional_headers(cached) if cached else None
     for attempt in range(MAX_RETRIES):
+        status = retry_after = None
+        nbytes = 0
+        if attempt: metrics.count_retry(POOL_NAME, url)
+        ticket = await limiter.acquire_async()
+        started = time.monotonic()
         try:
-            r = requests.get(url, headers=HEADERS, params=params, timeout=20)
-            if r.status_code == 200:
-                return r.json()
-            elif r.status_code == 404:
-                return None
+            async with session.get(url, params=params, headers=headers, timeout=aiohttp.ClientTimeout(total=20)) as r:
+                status, retry_after = r.status, r.headers.get("Retry-After")
+                if r.status == 304 and cached:
+                    cache.record("revalidated")
+                    cache.touch(url)
+                    return json.loads(cached["body"])
+                elif r.status == 200:
+                    body = await r.read()
+                    nbytes = len(body)
+                    data = json.loads(body)
+                    if cache:
+                        cache.record("miss")
+                        cache.store(url, body, r.headers.get("ETag"), r.headers.get("Last-Modified"))
+                    return data
+                elif r.status == 404:
+                    return missing
         except Exception as e:
-            if attempt < MAX_RETRIES - 1:
-                time.sleep(RETRY_DELAY)
-            else:
-                pass
+            pass
+        finally:
+            limiter.release(ticket, status, retry_after)
+            metrics.observe_request(POOL_NAME, url, status, time.monotonic() - started, nbytes)
+        if attempt < MAX_RETRIES - 1:
+            await asyncio.sleep(RETRY_DELAY)
     return None
 
-def get_all_fund_list():
+async def get_all_fund_list(session):
     url = "https://www.finnomena.com/fn3/api/fund/v2/public/funds"
     try:
-        data = safe_api_get(url)
+        data = await safe_api_get(session, url)
         return data.get("data", []) if data and data.get("status") else []
     except Exception as e:
         log(f"Error getting fund list: {e}")
         return []
+
+async def fetch_fund_list():
+    async with create_session() as session:
+        return await get_all_fund_list(session)
     
 def load_existing_codes():
     if not OUTPUT_CODES.exists(): return {}
@@ -158,26 +260,121 @@ def load_existing_codes():
     except: pass
     return codes_map
 
-def extract_codes_from_pdf(pdf_url, fund_code):
+def load_pdf_cache():
+    PDF_CACHE.clear()
+    if not PDF_CACHE_FILE.exists(): return
+    try:
+        with open(PDF_CACHE_FILE, 'r', encoding='utf-8') as f:
+            PDF_CACHE.update(json.load(f))
+    except Exception as e:
+        log(f"Error reading PDF cache: {e}")
+
+def save_pdf_cache():
+    try:
+        tmp_path = PDF_CACHE_FILE.with_suffix(".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(PDF_CACHE, f)
+        os.replace(tmp_path, PDF_CACHE_FILE)
+    except Exception as e:
+        log(f"Error saving PDF cache: {e}")
+
+def fund_fingerprint(fund):
+    stable = {k: v for k, v in fund.items() if not any(part in k.lower() for part in FINGERPRINT_VOLATILE)}
+    return hashlib.sha256(json.dumps(stable, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+def load_fingerprints():
+    FUND_FINGERPRINTS.clear()
+    if not FINGERPRINT_FILE.exists(): return
+    try:
+        with open(FINGERPRINT_FILE, 'r', encoding='utf-8') as f:
+            FUND_FINGERPRINTS.update(json.load(f))
+    except Exception as e:
+        log(f"Error reading fund fingerprints: {e}")
+
+def save_fingerprints():
+    try:
+        tmp_path = FINGERPRINT_FILE.with_suffix(".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(FUND_FINGERPRINTS, f, ensure_ascii=False)
+        os.replace(tmp_path, FINGERPRINT_FILE)
+    except Exception as e:
+        log(f"Error saving fund fingerprints: {e}")
+
+def cached_detail(job):
+    if not FINGERPRINT_ENABLED: return None
+    entry = FUND_FINGERPRINTS.get(job["code"])
+    if not entry or entry.get("fingerprint") != job["fingerprint"]: return None
+    if time.time() - entry.get("fetched_at", 0) > FINGERPRINT_MAX_AGE: return None
+    if not entry.get("master") or not entry.get("fee"): return None
+    return entry
+
+async def extract_codes_from_pdf(session, pdf_url, fund_code):
     codes = []
     if not pdf_url: return codes
     MAX_RETRIES = 3
+    limiter = get_limiter(urlparse(pdf_url).hostname)
+    loop = asyncio.get_running_loop()
+    cached = PDF_CACHE.get(pdf_url)
+    headers = {}
+    if cached and cached.get("etag"): headers["If-None-Match"] = cached["etag"]
+    if cached and cached.get("last_modified"): headers["If-Modified-Since"] = cached["last_modified"]
     for attempt in range(MAX_RETRIES):
         try:
-            r = requests.get(pdf_url, headers=HEADERS, timeout=25)
-            if r.status_code == 200:
-                with pdfplumber.open(BytesIO(r.content)) as pdf:
-                    full_text = ""
-                    for page in pdf.pages:
-                        full_text += (page.extract_text(x_tolerance=3, y_tolerance=3) or "") + "\n"
-                    isin_matches = re.findall(r"\b([A-Z]{2}[A-Z0-9]{9}[0-9])\b", full_text)
-                    for isin in set(isin_matches):
-                        codes.append({"fund_code": fund_code, "type": "ISIN", "code": isin, "factsheet_url": pdf_url})
-                break
+            status = content = None
+            if attempt: metrics.count_retry(POOL_NAME, pdf_url)
+            ticket = await limiter.acquire_async()
+            started = time.monotonic()
+            try:
+                async with session.get(pdf_url, headers=headers, timeout=aiohttp.ClientTimeout(total=25)) as r:
+                    status = r.status
+                    content = await r.read() if status == 200 else None
+                    etag, last_modified = r.headers.get("ETag"), r.headers.get("Last-Modified")
+            finally:
+                limiter.release(ticket, status)
+                metrics.observe_request(POOL_NAME, pdf_url, status, time.monotonic() - started, len(content or b""))
+            isin_matches = None
+            if status == 304 and cached:
+                PDF_STATS["not_modified"] += 1
+                isin_matches = cached["isins"]
+            elif status == 200:
+                digest = hashlib.sha256(content).hexdigest()
+                if cached and cached.get("sha256") == digest:
+                    # same bytes as last time, pdfplumber would find the same codes
+                    PDF_STATS["same_hash"] += 1
+                    isin_matches = cached["isins"]
+                else:
+                    parsed = loop.create_future()
+                    await PDF_QUEUE.put((content, parsed))
+                    metrics.QUEUE_DEPTH.set(PDF_QUEUE.qsize(), task=POOL_NAME, queue="pdf_parse")
+                    found, pages_parsed, pages_total = await parsed
+                    isin_matches = sorted(found)
+                    PDF_STATS["parsed"] += 1
+                    PDF_PAGE_STATS["parsed"] += pages_parsed
+                    PDF_PAGE_STATS["total"] += pages_total
+                PDF_CACHE[pdf_url] = {"sha256": digest, "etag": etag, "last_modified": last_modified, "isins": isin_matches}
+            if isin_matches is not None:
+                for isin in isin_matches:
+                    codes.append({"fund_code": fund_code, "type": "ISIN", "code": isin, "factsheet_url": pdf_url})
+                return codes
+            if status == 404: return codes
         except Exception as e:
-            if attempt < MAX_RETRIES - 1: time.sleep(2)
+            if attempt < MAX_RETRIES - 1: await asyncio.sleep(2)
             else: log(f"PDF Error {fund_code}: {e}")
-    return codes
+    return None
+
+async def pdf_parse_worker(parser):
+    loop = asyncio.get_running_loop()
+    while True:
+        content, parsed = await PDF_QUEUE.get()
+        try:
+            result = await loop.run_in_executor(
+                None, parser.parse, content, PDF_MAX_PAGES, PDF_TARGET_PAGES, PDF_CROP_BBOX, PDF_EARLY_EXIT
+            )
+            if not parsed.done(): parsed.set_result(result)
+        except Exception as e:
+            if not parsed.done(): parsed.set_exception(e)
+        finally:
+            PDF_QUEUE.task_done()
 
 def check_is_monthly_run():
     if not PDF_LOG_FILE.exists(): return True
@@ -232,26 +429,52 @@ def parse_fee_value(fees_list, keywords):
             return fee.get("rate", ""), fee.get("actual_value", "")
     return "", ""
 
-def process_fund_task(fund, writers, existing_codes_map, is_monthly_run, stop_event):
-    if stop_event.is_set(): return None
+def new_fund_job(fund):
     fund_id = fund.get("fund_id")
-    code = fund.get("short_code")
-    time.sleep(random.uniform(0.5, 2.0))
-    if stop_event.is_set(): return None
-    info_json = {}
-    is_success = False
-    factsheet_url = ""
-
-    # 1. Info
+    done = CHECKPOINTS.get(fund.get("short_code"), set())
+    needed = {name for name in STAGES if name not in done}
+    # fee and codes need the info payload, info is fetched again without writing its row
+    if needed & set(STAGE_AFTER_INFO): needed.add("info")
+    return {
+        "code": fund.get("short_code"),
+        "fund_id": fund_id,
+        "base_url": f"https://www.finnomena.com/fn3/api/fund/v2/public/funds/{fund_id}",
+        "source_url": f"https://www.finnomena.com/fund/{fund_id}",
+        "info_ok": False,
+        "info_json": {},
+        "factsheet_url": "",
+        "fingerprint": fund_fingerprint(fund),
+        "cached": None,
+        "done": done,
+        "ok": set(),
+        "pending": needed,
+        "rows": {name: [] for name in ["master", "fees", "allocations", "codes", "performance"]},
+        "nav_rows": [],
+    }
+
+async def stage_info(session, job, run):
+    code = job["code"]
+    silent = "info" in job["done"]
+    cached = cached_detail(job)
+    if cached:
+        # list entry unchanged since the last fetch, info and fee rows are reused as they are
+        job["cached"] = cached
+        job["factsheet_url"] = cached.get("factsheet_url", "")
+        if not silent: job["rows"]["master"].append(cached["master"])
+        job["info_ok"] = True
+        FINGERPRINT_STATS["reused"] += 1
+        return True
     try:
-        if stop_event.is_set(): return None
-        res = safe_api_get(f"https://www.finnomena.com/fn3/api/fund/v2/public/funds/{fund_id}")
+        res = await safe_api_get(session, job["base_url"], endpoint="info")
         if res is None:
             log(f"Error cannot fetch info for {code}")
-            return None 
+            return False
         info_json = res.get("data", {}) if res else {}
-        factsheet_url = info_json.get("fund_fact_sheet", "")
-        row_data = {
+        job["info_json"] = info_json
+        job["factsheet_url"] = info_json.get("fund_fact_sheet", "")
+        job["info_ok"] = True
+        if silent: return True
+        job["rows"]["master"].append({
             "fund_code": code,
             "full_name_th": info_json.get("name_th", ""),
             "full_name_en": info_json.get("name_en", ""),
@@ -260,35 +483,55 @@ def process_fund_task(fund, writers, existing_codes_map, is_monthly_run, stop_ev
             "risk_level": info_json.get("risk_level", ""),
             "is_dividend": "จ่าย" if info_json.get("dividend_policy") != "ไม่จ่าย" else "ไม่จ่าย",
             "inception_date": format_date(info_json.get("inception_date")),
-            "source_url": f"https://www.finnomena.com/fund/{fund_id}"
-        }
-        with get_obj("CSV_LOCK"):
-            writers['master'].writerow(row_data)
-        is_success = True 
-
-    except Exception as e: 
+            "source_url": job["source_url"]
+        })
+        return True
+    except Exception as e:
         log(f"Error Info {code}: {e}")
-        is_success = False
+        job["info_ok"] = False
+        return False
 
-    # 2. NAV
+async def stage_nav(session, job, run):
+    code = job["code"]
+    last_nav_date = LAST_NAV_DATES.get(code) if NAV_INCREMENTAL else None
+    nav_range = pick_nav_range(last_nav_date)
     try:
-        if stop_event.is_set(): return None
-        res = safe_api_get(f"https://www.finnomena.com/fn3/api/fund/v2/public/funds/{fund_id}/nav/q?range=MAX")
+        res = await safe_api_get(session, f"{job['base_url']}/nav/q?range={nav_range}", missing={})
+        if res is None: return False
         nav_data = res.get("data", {}).get("navs", []) if res else []
-        if nav_data:
-            safe_code_filename = sanitize_filename(code)
-            with open(NAV_ALL_DIR/f"{safe_code_filename}.csv", "w", newline="", encoding="utf-8") as f_nav:
-                w_nav = csv.writer(f_nav)
-                w_nav.writerow(["fund_code", "date", "value", "amount"]) 
-                for n in nav_data:
-                    if stop_event.is_set(): return None 
-                    w_nav.writerow([code, format_date(n.get("date")), n.get("value"), n.get("amount")])
-    except Exception as e: log(f"Error NAV {code}: {e}")
-
-    # 3. Fee
+        nav_rows = [[code, parse_nav_date(format_date(n.get("date"))), n.get("value"), n.get("amount")] for n in nav_data]
+        nav_rows = [r for r in nav_rows if r[1]]
+        if nav_rows and last_nav_date:
+            # window must overlap what we have, otherwise some days are missing
+            if min(r[1] for r in nav_rows) > last_nav_date:
+                log(f"NAV gap detected for {code} Full backfill")
+                NAV_STATS["backfill"] += 1
+                res = await safe_api_get(session, f"{job['base_url']}/nav/q?range=MAX", missing={})
+                if res is None: return False
+                nav_data = res.get("data", {}).get("navs", []) if res else []
+                nav_rows = [[code, parse_nav_date(format_date(n.get("date"))), n.get("value"), n.get("amount")] for n in nav_data]
+                nav_rows = [r for r in nav_rows if r[1]]
+                last_nav_date = None
+        if nav_rows and last_nav_date:
+            job["nav_rows"] = [r for r in nav_rows if r[1] > last_nav_date]
+            NAV_STATS["incremental" if nav_range != "MAX" else "full"] += 1
+        elif nav_rows:
+            job["nav_rows"] = nav_rows
+            NAV_STATS["full"] += 1
+        return True
+    except Exception as e:
+        log(f"Error NAV {code}: {e}")
+        return False
+
+async def stage_fee(session, job, run):
+    code = job["code"]
+    info_json = job["info_json"]
+    if job["cached"]:
+        job["rows"]["fees"].append(job["cached"]["fee"])
+        return True
     try:
-        if stop_event.is_set(): return None
-        res = safe_api_get(f"https://www.finnomena.com/fn3/api/fund/v2/public/funds/{fund_id}/fee")
+        res = await safe_api_get(session, f"{job['base_url']}/fee", endpoint="fee", missing={})
+        if res is None: return False
         fees_list = res.get("data", {}).get("fees", []) if res else []
         front_max, front_act = parse_fee_value(fees_list, ["front-end"])
         back_max, back_act = parse_fee_value(fees_list, ["back-end"])
@@ -297,9 +540,9 @@ def process_fund_task(fund, writers, existing_codes_map, is_monthly_run, stop_ev
         switch_out_max, switch_out_act = parse_fee_value(fees_list, ["switching", "out"])
         ter_max, ter_act = parse_fee_value(fees_list, ["ค่าใช้จ่ายรวมทั้งหมด"])
         
-        fee_row = {
+        job["rows"]["fees"].append({
             "fund_code": code, 
-            "source_url": f"https://www.finnomena.com/fund/{fund_id}", 
+            "source_url": job["source_url"], 
             "front_end_max": front_max, "front_end_actual": front_act,
             "back_end_max": back_max, "back_end_actual": back_act,
             "management_max": mngt_max, "management_actual": mngt_act,
@@ -308,15 +551,17 @@ def process_fund_task(fund, writers, existing_codes_map, is_monthly_run, stop_ev
             "switching_out_max": switch_out_max, "switching_out_actual": switch_out_act,
             "min_initial_buy": info_json.get("minimum_initial", ""), 
             "min_next_buy": info_json.get("minimum_subsequent", "")
-        }
-        with get_obj("CSV_LOCK"):
-            writers['fees'].writerow(fee_row)
-    except Exception as e: log(f"Error Fee {code}: {e}")
+        })
+        return True
+    except Exception as e:
+        log(f"Error Fee {code}: {e}")
+        return False
 
-    # 4. Allocations
+async def stage_portfolio(session, job, run):
+    code = job["code"]
     try:
-        if stop_event.is_set(): return None
-        res = safe_api_get(f"https://www.finnomena.com/fn3/api/fund/v2/public/funds/{fund_id}/portfolio")
+        res = await safe_api_get(session, f"{job['base_url']}/portfolio", endpoint="portfolio", missing={})
+        if res is None: return False
         port_data = res.get("data") if res else None
         if port_data:
             alloc_rows = []
@@ -325,76 +570,231 @@ def process_fund_task(fund, writers, existing_codes_map, is_monthly_run, stop_ev
                 alloc_rows.append({
                     "fund_code": code, "type": "asset_alloc", "name": item.get("name"),
                     "percent": item.get("percent"), "as_of_date": format_date(asset_alloc.get("data_date")),
-                    "source_url": f"https://www.finnomena.com/fund/{fund_id}"
+                    "source_url": job["source_url"]
                 })
             sector_alloc = port_data.get("global_stock_sector") or port_data.get("sector_allocation") or {}
             for item in (sector_alloc.get("elements") or []):
                 alloc_rows.append({
                     "fund_code": code, "type": "sector_alloc", "name": item.get("name"),
                     "percent": item.get("percent"), "as_of_date": format_date(sector_alloc.get("data_date")),
-                    "source_url": f"https://www.finnomena.com/fund/{fund_id}"
+                    "source_url": job["source_url"]
                 })
-            
-            with get_obj("CSV_LOCK"):
-                if alloc_rows: writers['allocations'].writerows(alloc_rows)
-    except Exception as e: log(f"Error Holding {code}: {e}")
+            job["rows"]["allocations"].extend(alloc_rows)
+        return True
+    except Exception as e:
+        log(f"Error Holding {code}: {e}")
+        return False
 
-    # 5. codes (PDF)
+async def stage_codes(session, job, run):
+    code = job["code"]
+    factsheet_url = job["factsheet_url"]
     try:
-        if stop_event.is_set(): return None
-        cached_rows = existing_codes_map.get(code, [])
+        cached_rows = run["existing_codes_map"].get(code, [])
         need_scrape = False
         if not cached_rows: need_scrape = True
-        elif is_monthly_run: need_scrape = True
+        elif run["is_monthly_run"]: need_scrape = True
         elif cached_rows and cached_rows[0].get('factsheet_url') != factsheet_url: need_scrape = True 
         
         if need_scrape:
              if factsheet_url and factsheet_url.endswith(".pdf"):
-                 codes_found = extract_codes_from_pdf(factsheet_url, code)
-                 if codes_found: 
-                    with get_obj("CSV_LOCK"): writers['codes'].writerows(codes_found)
+                 codes_found = await extract_codes_from_pdf(session, factsheet_url, code)
+                 if codes_found is None: return False
+                 job["rows"]["codes"].extend(codes_found)
         else:
-            with get_obj("CSV_LOCK"): writers['codes'].writerows(cached_rows)
-    except Exception as e: log(f"Error Codes {code}: {e}")
+            job["rows"]["codes"].extend(cached_rows)
+        return True
+    except Exception as e:
+        log(f"Error Codes {code}: {e}")
+        return False
 
-    # 6. performance
+async def stage_performance(session, job, run):
+    code = job["code"]
     try:
-        if stop_event.is_set(): return None
-        res = safe_api_get(f"https://www.finnomena.com/fn3/api/fund/v2/public/funds/{fund_id}/performance")
+        res = await safe_api_get(session, f"{job['base_url']}/performance", endpoint="performance", missing={})
+        if res is None: return False
         perf_data = res.get("data", {}) if res else {}
-        ret_1y = perf_data.get("total_return_1y", "")
-        ret_3y = perf_data.get("total_return_3y", "")
-        perf_row = {
+        job["rows"]["performance"].append({
             "fund_code": code,
-            "total_return_1y": ret_1y,
-            "total_return_3y": ret_3y,
-            "source_url": f"https://www.finnomena.com/fund/{fund_id}"
-        }
-        with get_obj("CSV_LOCK"):
-            writers['performance'].writerow(perf_row)
+            "total_return_1y": perf_data.get("total_return_1y", ""),
+            "total_return_3y": perf_data.get("total_return_3y", ""),
+            "source_url": job["source_url"]
+        })
+        return True
     except Exception as e: 
         log(f"Error Performance {code}: {e}")
+        return False
 
-    with get_obj("CSV_LOCK"):
-        for w in writers.values():
-            pass
-    if is_success:
-        append_resume_state(code)
-        return code
-    else:
-        return None
+STAGE_FUNCS = {
+    "info": stage_info,
+    "nav": stage_nav,
+    "fee": stage_fee,
+    "portfolio": stage_portfolio,
+    "codes": stage_codes,
+    "performance": stage_performance,
+}
+
+def commit_fund(job, writer):
+    # every stage is checkpointed on its own, the next round only redoes the stages that failed here
+    code = job["code"]
+    rows, journal, failed = {}, [], []
+    for name in STAGES:
+        if name in job["done"]: continue
+        ok = name in job["ok"]
+        if ok:
+            for key in STAGE_OUTPUTS[name]: rows[key] = job["rows"][key]
+        else:
+            failed.append(name)
+        journal.append(checkpoint_line(code, name, ok))
+    # NAV rows go through the writer too, so they reach the store before the fund's resume marker
+    if "nav" in job["ok"]: rows["nav"] = job["nav_rows"]
+    if FINGERPRINT_ENABLED and not job["cached"] and job["rows"]["master"] and job["rows"]["fees"]:
+        FUND_FINGERPRINTS[job["code"]] = {
+            "fingerprint": job["fingerprint"],
+            "fetched_at": time.time(),
+            "factsheet_url": job["factsheet_url"],
+            "master": job["rows"]["master"][0],
+            "fee": job["rows"]["fees"][0],
+        }
+        FINGERPRINT_STATS["fetched"] += 1
+    # the fund only counts as done once every stage has succeeded
+    writer.submit(rows, None if failed else resume_line(code, current_date_str), journal)
+    return failed
+
+def stage_report(queues, started):
+    elapsed = max(time.monotonic() - started, 1e-6)
+    parts = []
+    for name in STAGES:
+        s = STAGE_STATS[name]
+        busy = s["busy"] / (elapsed * STAGE_CONCURRENCY[name])
+        parts.append(f"{name} {s['done']} ({s['done'] / elapsed:.2f}/s, queue {queues[name].qsize()}/{queues[name].maxsize}, peak {s['peak']}, busy {busy:.0%})")
+    return " | ".join(parts)
+
+async def report_stages(queues, started):
+    while True:
+        await asyncio.sleep(STAGE_REPORT_SECONDS)
+        log(f"Stages: {stage_report(queues, started)}")
+
+async def run_fund_tasks(pending_funds, writer, existing_codes_map, is_monthly_run, total, finished_start):
+    global PDF_QUEUE
+    STAGE_STATS.clear()
+    # round 2 runs in the same process, its summaries count only its own work
+    for stats in (NAV_STATS, PDF_STATS, PDF_PAGE_STATS, FINGERPRINT_STATS):
+        for key in stats: stats[key] = 0
+    stop_event = get_obj("STOP_EVENT")
+    run = {"existing_codes_map": existing_codes_map, "is_monthly_run": is_monthly_run}
+    fund_slots = asyncio.Semaphore(FUNDS_IN_FLIGHT)
+    queues = {name: asyncio.Queue(maxsize=STAGE_QUEUE_SIZE[name]) for name in STAGES}
+    for name in STAGES: STAGE_STATS[name] = {"done": 0, "busy": 0.0, "peak": 0}
+    progress = {"finished": 0, "saved": 0}
+    all_done = asyncio.Event()
+    if not pending_funds: all_done.set()
+    started = time.monotonic()
+    # downloaded factsheets go through a queue to a process pool, fetch workers never wait on pdfplumber
+    PDF_QUEUE = asyncio.Queue(maxsize=PDF_QUEUE_SIZE)
+    # each consumer owns a parser process, started on its first factsheet, so runs without PDFs start none
+    pdf_parsers = [ParserProcess() for _ in range(PDF_PARSE_WORKERS)]
+    pdf_workers = [asyncio.create_task(pdf_parse_worker(parser)) for parser in pdf_parsers]
+
+    async def enqueue(name, job):
+        await queues[name].put(job)
+        STAGE_STATS[name]["peak"] = max(STAGE_STATS[name]["peak"], queues[name].qsize())
+        metrics.QUEUE_DEPTH.set(queues[name].qsize(), task=POOL_NAME, queue=name)
+
+    def finish_stage(job, name):
+        job["pending"].discard(name)
+        if job["pending"]: return
+        fund_slots.release()
+        progress["finished"] += 1
+        try:
+            failed = commit_fund(job, writer)
+            if not failed:
+                progress["saved"] += 1
+                log(f"[{finished_start + progress['saved']}/{total}] {job['code']} (finnomena)")
+            else:
+                log(f"{job['code']} failed stages: {', '.join(failed)} (finnomena, kept for next round)")
+        except Exception as e:
+            log(f"Task Failed: {e}")
+        if progress["finished"] == len(pending_funds): all_done.set()
+
+    async def stage_worker(name, session):
+        queue = queues[name]
+        stats = STAGE_STATS[name]
+        while True:
+            job = await queue.get()
+            metrics.QUEUE_DEPTH.set(queue.qsize(), task=POOL_NAME, queue=name)
+            t0 = time.monotonic()
+            try:
+                if not stop_event.is_set() and await STAGE_FUNCS[name](session, job, run):
+                    job["ok"].add(name)
+            except Exception as e:
+                log(f"Error {name} {job['code']}: {e}")
+            finally:
+                stats["busy"] += time.monotonic() - t0
+                stats["done"] += 1
+                queue.task_done()
+            if name == "info":
+                for next_name in STAGE_AFTER_INFO:
+                    if next_name not in job["pending"]: continue
+                    if job["info_ok"]: await enqueue(next_name, job)
+                    else: finish_stage(job, next_name)
+            finish_stage(job, name)
+
+    async def admit():
+        for fund in pending_funds:
+            await fund_slots.acquire()
+            if stop_event.is_set():
+                # the rest is never admitted, so the finished count can't reach the total: wait until the funds
+                # in flight are committed (their stages are skipped once stopped) and end the run
+                fund_slots.release()
+                for _ in range(FUNDS_IN_FLIGHT): await fund_slots.acquire()
+                all_done.set()
+                break
+            job = new_fund_job(fund)
+            if not job["pending"]:
+                job["pending"].add("info")
+                finish_stage(job, "info")
+                continue
+            for name in STAGES:
+                if name in job["pending"] and name not in STAGE_AFTER_INFO: await enqueue(name, job)
+
+    async with create_session() as session:
+        workers = [asyncio.create_task(stage_worker(name, session)) for name in STAGES for _ in range(STAGE_CONCURRENCY[name])]
+        workers.append(asyncio.create_task(admit()))
+        workers.append(asyncio.create_task(report_stages(queues, started)))
+        try:
+            await all_done.wait()
+        finally:
+            for t in workers: t.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            for t in pdf_workers: t.cancel()
+            await asyncio.gather(*pdf_workers, return_exceptions=True)
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*(loop.run_in_executor(None, parser.close, stop_event.is_set()) for parser in pdf_parsers))
+            log(f"Stage summary: {stage_report(queues, started)}")
+            if sum(PDF_STATS.values()):
+                log(f"Factsheets: {PDF_STATS['parsed']} parsed, {PDF_STATS['same_hash']} unchanged, {PDF_STATS['not_modified']} not modified (304)")
+            if PDF_PAGE_STATS["total"]:
+                log(f"Factsheet pages: parsed {PDF_PAGE_STATS['parsed']} of {PDF_PAGE_STATS['total']} ({1 - PDF_PAGE_STATS['parsed'] / PDF_PAGE_STATS['total']:.1%} skipped)")
+    if FINGERPRINT_ENABLED:
+        log(f"Fund fingerprints: info/fee reused for {FINGERPRINT_STATS['reused']} funds, fetched for {FINGERPRINT_STATS['fetched']}")
+    if HTTP_CACHE: log(HTTP_CACHE.summary())
+    log(close_sessions(POOL_NAME))
+    log(limiter_summary("www.finnomena.com"))
+    log(f"NAV: {NAV_STATS['incremental']} incremental, {NAV_STATS['full']} full, {NAV_STATS['backfill']} gap backfills")
 
 @task(name="Finnomena scraper", log_prints=True)
 def finnomena_scraper():
-    global HAS_ERROR
+    global HAS_ERROR, HTTP_CACHE
     log("Starting Finnomena Scraper")
     IS_MONTHLY_RUN = check_is_monthly_run()
     if IS_MONTHLY_RUN:
         log("Status: NEW MONTH PDF scraping ENABLED")
     else:
         log("Status: SAME MONTH PDF scraping SKIPPED")
-    finished_funds = get_resume_state()
-    raw_funds = get_all_fund_list()
+    resume_index = get_resume_state()
+    finished_funds = set(resume_index.finished)
+    load_checkpoints()
+    raw_funds = asyncio.run(fetch_fund_list())
     log(f"Fetched {len(raw_funds)} funds from API")
     active_funds = [
         f for f in raw_funds 
@@ -405,6 +805,17 @@ def finnomena_scraper():
     active_funds.sort(key=lambda x: x.get("short_code", "").strip())
     active_fund_codes = {f.get("short_code").strip() for f in active_funds}
     log(f"Found {len(active_fund_codes)} ACTIVE funds")
+    nav_store = NavStore(NAV_STORE_DIR)
+    if nav_store.is_empty() and NAV_ALL_DIR.exists():
+        imported = import_csv_dir(nav_store, NAV_ALL_DIR)
+        if imported: log(f"Imported {imported} NAV csv files into {NAV_STORE_DIR.name}")
+    if HTTP_CACHE_ENABLED:
+        HTTP_CACHE = HttpCache(HTTP_CACHE_FILE, HTTP_CACHE_TTL)
+    LAST_NAV_DATES.clear()
+    if NAV_INCREMENTAL: LAST_NAV_DATES.update(nav_store.last_dates())
+    log(f"NAV store has history for {len(LAST_NAV_DATES)} funds")
+    load_pdf_cache()
+    if FINGERPRINT_ENABLED: load_fingerprints()
     existing_codes_map = load_existing_codes()
     log(f"Loaded {len(existing_codes_map)} existing funds ISIN")
     sync_and_clean_wealthmagik_list(active_fund_codes)
@@ -419,60 +830,44 @@ def finnomena_scraper():
     log(f"Saved Finnomena Fund List to {OUTPUT_FUND_LIST}")
     mode = 'a'
     write_header = not OUTPUT_MASTER.exists()
-    if not finished_funds:
+    if not finished_funds and not CHECKPOINTS:
         mode = 'w'
         write_header = True
-    f_master = open(OUTPUT_MASTER, mode, newline="", encoding="utf-8-sig")
-    f_fees = open(OUTPUT_FEES, mode, newline="", encoding="utf-8-sig")
-    f_allocations = open(OUTPUT_ALLOCATIONS, mode, newline="", encoding="utf-8-sig")
-    f_codes = open(OUTPUT_CODES, mode, newline="", encoding="utf-8-sig")
-    f_performance = open(OUTPUT_PERFORMANCE, mode, newline="", encoding="utf-8-sig")
-    writers = {
-        'master': csv.DictWriter(f_master, fieldnames=["fund_code", "full_name_th", "full_name_en", "amc", "category", "risk_level", "is_dividend", "inception_date", "source_url"]),
-        'fees': csv.DictWriter(f_fees, fieldnames=["fund_code", "source_url", "front_end_max", "front_end_actual", "back_end_max", "back_end_actual", "management_max", "management_actual", "ter_max", "ter_actual", "switching_in_max", "switching_in_actual", "switching_out_max", "switching_out_actual", "min_initial_buy", "min_next_buy"]),
-        'allocations': csv.DictWriter(f_allocations, fieldnames=["fund_code", "type", "name", "percent", "as_of_date", "source_url"]),
-        'codes': csv.DictWriter(f_codes, fieldnames=["fund_code", "type", "code", "factsheet_url"]),
-        'performance': csv.DictWriter(f_performance, fieldnames=["fund_code", "total_return_1y", "total_return_3y", "source_url"])
-    }
-    if write_header:
-        for w in writers.values(): w.writeheader()
+    # one writer thread owns the five csv files and the resume markers, rows and markers are committed together
+    writer = CsvWriterThread(resume_index, log, "finnomena", CHECKPOINT_FILE)
+    writer.add_output('master', OUTPUT_MASTER, ["fund_code", "full_name_th", "full_name_en", "amc", "category", "risk_level", "is_dividend", "inception_date", "source_url"], mode, write_header)
+    writer.add_output('fees', OUTPUT_FEES, ["fund_code", "source_url", "front_end_max", "front_end_actual", "back_end_max", "back_end_actual", "management_max", "management_actual", "ter_max", "ter_actual", "switching_in_max", "switching_in_actual", "switching_out_max", "switching_out_actual", "min_initial_buy", "min_next_buy"], mode, write_header)
+    writer.add_output('allocations', OUTPUT_ALLOCATIONS, ["fund_code", "type", "name", "percent", "as_of_date", "source_url"], mode, write_header)
+    writer.add_output('codes', OUTPUT_CODES, ["fund_code", "type", "code", "factsheet_url"], mode, write_header)
+    writer.add_output('performance', OUTPUT_PERFORMANCE, ["fund_code", "total_return_1y", "total_return_3y", "source_url"], mode, write_header)
+    # NAV rows are staged in the parquet store by the writer thread at each commit, never on the event loop
+    writer.add_sink('nav', lambda rows: nav_store.stage(pd.DataFrame(rows, columns=NAV_COLUMNS)))
+    writer.start()
     try:
         total = len(active_funds)
         active_fund_codes_set = {f.get('short_code').strip() for f in active_funds}
         finished_funds = finished_funds.intersection(active_fund_codes_set)
         pending_funds = [f for f in active_funds if f.get('short_code').strip() not in finished_funds]
         log(f"Processing {len(pending_funds)} funds (Skipped {len(finished_funds)})")
-        executor = ThreadPoolExecutor(max_workers=NUM_WORKERS)
-        futures = []
-        for fund in pending_funds:
-            if get_obj("STOP_EVENT").is_set(): break
-            futures.append(executor.submit(process_fund_task, fund, writers, existing_codes_map, IS_MONTHLY_RUN, get_obj("STOP_EVENT")))
-        count = 0
-        for future in as_completed(futures):
-            if get_obj("STOP_EVENT").is_set(): break
-            try:
-                result_code = future.result()
-                if result_code:
-                    count += 1
-                    completed = len(finished_funds) + count
-                    log(f"[{completed}/{total}] {result_code} (finnomena)")
-                    if count % 10 == 0:
-                        with get_obj("CSV_LOCK"):
-                            f_master.flush(); f_fees.flush(); f_allocations.flush(); f_codes.flush(); f_performance.flush()
-            except Exception as e:
-                log(f"Task Failed: {e}")
+        asyncio.run(run_fund_tasks(pending_funds, writer, existing_codes_map, IS_MONTHLY_RUN, total, len(finished_funds)))
 
     except KeyboardInterrupt: 
         log("Stopping Scraper")
         get_obj("STOP_EVENT").set()
-        executor.shutdown(wait=False, cancel_futures=True)
         HAS_ERROR = True
     except Exception as e:
         log(f"Critical Error: {e}")
     finally:
-        f_master.close(); f_fees.close(); f_allocations.close(); f_codes.close(); f_performance.close()
-        try: executor.shutdown(wait=True) 
-        except: pass
+        writer.close()
+        resume_index.close()
+        log(writer.summary())
+        save_pdf_cache()
+        if FINGERPRINT_ENABLED: save_fingerprints()
+        if HTTP_CACHE:
+            HTTP_CACHE.close()
+            HTTP_CACHE = None
+        try: nav_store.compact()
+        except Exception as e: log(f"Error compacting NAV store: {e}")
         if not HAS_ERROR: 
             if IS_MONTHLY_RUN:
                 update_pdf_run_log()
@@ -0,0 +1,118 @@
+import csv
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+# CONFIG
+POSITIVE_TTL_DAYS = 90  # a listed stock rarely changes its type or sector
+NEGATIVE_TTL_DAYS = 14  # "Other" from the search API is asked again sooner, new listings show up late
+BUSY_TIMEOUT = 30  # seconds
+
+# classification of every holding code seen so far, one row per code
+# source: "api" answers expire after their TTL, "rule" entries come from classify_initial and never do
+class HoldingTypeStore:
+    def __init__(self, db_path, positive_ttl=POSITIVE_TTL_DAYS * 86400, negative_ttl=NEGATIVE_TTL_DAYS * 86400):
+        self.db_path = Path(db_path)
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.stats = {"fresh": 0, "stale": 0, "miss": 0, "writes": 0}
+        self.conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS holding_type (
+                holding_code TEXT PRIMARY KEY,
+                type TEXT NOT NULL,
+                sector TEXT NOT NULL DEFAULT '',
+                symbol TEXT NOT NULL DEFAULT '',
+                hint_name TEXT NOT NULL DEFAULT '',
+                source TEXT NOT NULL,
+                fetched_at REAL NOT NULL
+            ) WITHOUT ROWID
+        """)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS store_meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.commit()
+
+    def is_fresh(self, s_type, source, fetched_at):
+        if source == "rule": return True
+        ttl = self.negative_ttl if s_type == "Other" else self.positive_ttl
+        return time.time() - fetched_at < ttl
+
+    def get(self, code):
+        # {"type", "sector", "symbol", "hint_name", "fresh"} or None, a stale entry is still returned
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT type, sector, symbol, hint_name, source, fetched_at FROM holding_type WHERE holding_code = ?", (code,)
+            ).fetchone()
+            if not row:
+                self.stats["miss"] += 1
+                return None
+            s_type, sector, symbol, hint_name, source, fetched_at = row
+            fresh = self.is_fresh(s_type, source, fetched_at)
+            self.stats["fresh" if fresh else "stale"] += 1
+        return {"type": s_type, "sector": sector, "symbol": symbol, "hint_name": hint_name, "fresh": fresh}
+
+    def put(self, code, s_type, sector="", symbol="", hint_name="", source="api", fetched_at=None):
+        with self.lock:
+            self.conn.execute("""
+                INSERT INTO holding_type (holding_code, type, sector, symbol, hint_name, source, fetched_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(holding_code) DO UPDATE SET
+                    type = excluded.type, sector = excluded.sector, symbol = excluded.symbol,
+                    hint_name = CASE WHEN excluded.hint_name <> '' THEN excluded.hint_name ELSE hint_name END,
+                    source = excluded.source, fetched_at = excluded.fetched_at
+            """, (code, s_type, sector or "", symbol or "", hint_name or "", source, fetched_at or time.time()))
+            self.conn.commit()
+            self.stats["writes"] += 1
+
+    def delete(self, code):
+        with self.lock:
+            self.conn.execute("DELETE FROM holding_type WHERE holding_code = ?", (code,))
+            self.conn.commit()
+
+    def import_csv(self, stock_csv, other_csv, log=print):
+        # one-time import of the old append-only caches, later rows win and "other" wins over "stock"
+        # like the old lookup order; entries keep the file's age so old answers get refreshed in time
+        with self.lock:
+            if self.conn.execute("SELECT 1 FROM store_meta WHERE key = 'csv_imported'").fetchone(): return
+        files = [(Path(stock_csv), False), (Path(other_csv), True)]
+        if not any(path.exists() for path, _ in files): return
+        entries = {}
+        for path, is_other in files:
+            if not path.exists(): continue
+            try:
+                fetched_at = path.stat().st_mtime
+                with open(path, mode='r', encoding='utf-8-sig') as f:
+                    for row in csv.DictReader(f):
+                        code = (row.get('holding_code') or '').strip()
+                        if not code: continue
+                        if is_other: entries[code] = (code, 'Other', '', '', '', 'api', fetched_at)
+                        else:
+                            symbol = row.get('symbol', code)
+                            entries[code] = (code, row.get('type') or 'Other', row.get('sector') or '', symbol or '', '', 'api', fetched_at)
+            except Exception as e:
+                log(f"Cannot import {path.name}: {e}")
+                return
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO holding_type (holding_code, type, sector, symbol, hint_name, source, fetched_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                list(entries.values())
+            )
+            self.conn.execute("INSERT OR REPLACE INTO store_meta (key, value) VALUES ('csv_imported', ?)", (time.strftime('%Y-%m-%d %H:%M:%S'),))
+            self.conn.commit()
+        log(f"Holding type store: imported {len(entries)} codes from {', '.join(p.name for p, _ in files if p.exists())}")
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM holding_type").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            try: self.conn.close()
+            except: pass
+
+    def summary(self):
+        s = self.stats
+        return f"Holding type store: {s['fresh']} fresh, {s['stale']} stale, {s['miss']} new, {s['writes']} writes"
@@ -0,0 +1,88 @@
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+
+# CONFIG
+COMMIT_EVERY = 50  # stored responses are committed in groups
+
+class HttpCache:
+    def __init__(self, db_path, ttl_by_endpoint=None):
+        self.db_path = Path(db_path)
+        self.ttl_by_endpoint = ttl_by_endpoint or {}
+        self.lock = threading.Lock()
+        self.pending_writes = 0
+        self.stats = {"fresh": 0, "revalidated": 0, "miss": 0}
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS http_cache (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL,
+                body BLOB NOT NULL
+            )
+        """)
+        self.conn.commit()
+
+    def lookup(self, url, endpoint):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT etag, last_modified, fetched_at, body FROM http_cache WHERE url = ?", (url,)
+            ).fetchone()
+        if not row: return None
+        etag, last_modified, fetched_at, body = row
+        ttl = self.ttl_by_endpoint.get(endpoint, 0)
+        return {
+            "etag": etag,
+            "last_modified": last_modified,
+            "fresh": ttl > 0 and (time.time() - fetched_at) < ttl,
+            "body": zlib.decompress(body),
+        }
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry and entry.get("etag"): headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"): headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def record(self, outcome):
+        with self.lock:
+            self.stats[outcome] += 1
+
+    def store(self, url, body, etag=None, last_modified=None):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO http_cache (url, etag, last_modified, fetched_at, body) VALUES (?, ?, ?, ?, ?)",
+                (url, etag, last_modified, time.time(), zlib.compress(body))
+            )
+            self.maybe_commit()
+
+    def touch(self, url):
+        # 304 Not Modified, the stored body is good for another TTL
+        with self.lock:
+            self.conn.execute("UPDATE http_cache SET fetched_at = ? WHERE url = ?", (time.time(), url))
+            self.maybe_commit()
+
+    def maybe_commit(self):
+        self.pending_writes += 1
+        if self.pending_writes >= COMMIT_EVERY:
+            self.conn.commit()
+            self.pending_writes = 0
+
+    def hit_ratio(self):
+        total = sum(self.stats.values())
+        return (self.stats["fresh"] + self.stats["revalidated"]) / total if total else 0.0
+
+    def summary(self):
+        total = sum(self.stats.values())
+        return (f"HTTP cache: {self.stats['fresh']} fresh, {self.stats['revalidated']} revalidated (304), "
+                f"{self.stats['miss']} miss of {total} lookups (hit ratio {self.hit_ratio():.1%})")
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
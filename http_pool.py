@@ -0,0 +1,111 @@
+import threading
+import time
+import requests
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from rate_limiter import get_limiter
+from metrics import observe_request
+
+# CONFIG
+POOL_CONNECTIONS = 8  # hosts kept alive per session
+POOL_MAXSIZE = 2  # keep-alive connections per host per session (one session per worker thread)
+HOST_POOL_MAXSIZE = {  # hosts we hit all night get their own adapter
+    "www.finnomena.com": 4,
+    "www.wealthmagik.com": 4,
+    "web-fct-api.sec.or.th": 4,
+}
+_SESSIONS = {}
+_STATS = {}
+_LOCK = threading.Lock()
+
+class ConnectionStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+
+    def add_request(self):
+        with self.lock: self.requests += 1
+
+    def add_connection(self):
+        with self.lock: self.new_connections += 1
+
+    def summary(self, name):
+        reused = max(self.requests - self.new_connections, 0)
+        ratio = reused / self.requests if self.requests else 0.0
+        return f"Connections ({name}): {self.requests} requests, {self.new_connections} new connections ({ratio:.1%} reused)"
+
+def get_stats(name):
+    with _LOCK:
+        if name not in _STATS: _STATS[name] = ConnectionStats()
+        return _STATS[name]
+
+def counting_pool_class(base, stats):
+    class CountingPool(base):
+        def _new_conn(self):
+            stats.add_connection()
+            return super()._new_conn()
+    return CountingPool
+
+class PooledAdapter(HTTPAdapter):
+    def __init__(self, stats, task="", **kwargs):
+        self.stats = stats
+        self.task = task
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        # every TCP+TLS handshake goes through _new_conn, that is what we count
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": counting_pool_class(HTTPConnectionPool, self.stats),
+            "https": counting_pool_class(HTTPSConnectionPool, self.stats),
+        }
+
+    def send(self, request, **kwargs):
+        # every request waits for its host's token bucket, the answer tunes the pace
+        limiter = get_limiter(urlparse(request.url).hostname)
+        ticket = limiter.acquire()
+        self.stats.add_request()
+        started = time.monotonic()
+        try:
+            response = super().send(request, **kwargs)
+            # read the body here (it would be read right after anyway) so latency and bytes are complete
+            nbytes = len(response.content) if not kwargs.get("stream") else 0
+        except Exception:
+            limiter.release(ticket)
+            observe_request(self.task, request.url, None, time.monotonic() - started)
+            raise
+        limiter.release(ticket, response.status_code, response.headers.get("Retry-After"))
+        observe_request(self.task, request.url, response.status_code, time.monotonic() - started, nbytes)
+        return response
+
+def mount_pooled_adapters(session, stats, task=""):
+    default_adapter = PooledAdapter(stats, task, pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+    session.mount("http://", default_adapter)
+    session.mount("https://", default_adapter)
+    for host, maxsize in HOST_POOL_MAXSIZE.items():
+        session.mount(f"https://{host}/", PooledAdapter(stats, task, pool_connections=1, pool_maxsize=maxsize))
+    return session
+
+def get_session(name, factory=None):
+    # one keep-alive session per (scraper, worker thread), reused for every fund the worker handles
+    key = (name, threading.get_ident())
+    with _LOCK:
+        session = _SESSIONS.get(key)
+    if session is None:
+        session = factory() if factory else requests.Session()
+        mount_pooled_adapters(session, get_stats(name), name)
+        with _LOCK:
+            _SESSIONS[key] = session
+    return session
+
+def close_sessions(name):
+    with _LOCK:
+        keys = [k for k in _SESSIONS if k[0] == name]
+        sessions = [_SESSIONS.pop(k) for k in keys]
+        stats = _STATS.pop(name, ConnectionStats())
+    for s in sessions:
+        try: s.close()
+        except: pass
+    return stats.summary(name)
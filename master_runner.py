@@ -13,6 +13,7 @@ from finnomena.scrape_finnomena import finnomena_scraper
 from wealthmagik.allocations_wealthmagik import allo_wm_req
 from wealthmagik.bid_offer_wealthmagik import bid_offer_wm_req
 from wealthmagik.holding_wealthmagik import holding_wm_req
+from wealthmagik.crawler_wealthmagik import crawler_wm_req
 #from wealthmagik.allocations_wealthmagik_selenium import allo_wm_sel
 #from wealthmagik.bid_offer_wealthmagik_selenium import bid_offer_wm_sel
 #from wealthmagik.holding_wealthmagik_selenium import holding_wm_sel
@@ -23,26 +24,32 @@ from clean_type_holding import clean_holding
 from merge_funds import merged_file
 from scrape_sec_info import sec_scrape
 from update_driver import update_geckodriver
+import metrics
+from resume_index import has_state
 
 #CONFIG
 DAILY_START_TIME = "01:00"
 HOURS_WAIT_FOR_ROUND_2 = 5
 DAYS_TO_SKIP = [6, 0]   # 6=Sunday, 0=Monday
 DATE_LOG_FILE = "date.log"
-MODE_FOR_WEALTHMAGIK = 1
+MODE_FOR_WEALTHMAGIK = 4
 """
 MODE FOR WEALTHMAGIK
-1 = work one thing at the time (recommend)
+1 = work one thing at the time
 2 = work bid_offer first and then will work allocations and holding at the same time
 3 = work together at the same time 
+4 = one crawler walks the fund list once and fetches every page a fund needs (recommend)
 """
 ALWAYS_SELENIUM_WM = False # No longer support selenium
+METRICS_PORT = 9108 # Prometheus text at http://<host>:9108/metrics while the scheduler is up, it shows the current or last flow run (0 = off)
 
 # FILE PATHS
 script_dir = Path(__file__).resolve().parent
-RESUME_WM_HOLDING    = script_dir/"wealthmagik/holding_resume.log"
-RESUME_WM_ALLOC      = script_dir/"wealthmagik/allocations_resume.log"
-RESUME_SEC           = script_dir/"scrape_sec_resume.log"
+LEGACY_WM_HOLDING    = script_dir/"wealthmagik/holding_resume.log"  # old resume logs, until a run imports them into resume_index
+LEGACY_WM_ALLOC      = script_dir/"wealthmagik/allocations_resume.log"
+LEGACY_SEC           = script_dir/"scrape_sec_resume.log"
+METRICS_DIR          = script_dir/"Logs"
+METRICS_LIVE_FILE    = METRICS_DIR/"metrics_live.prom"  # rewritten by the running flow, read by the endpoint
 
 def is_skip_day():
     return datetime.now().weekday() in DAYS_TO_SKIP
@@ -81,7 +88,7 @@ def perform_scraping_round(round_name, is_new_month):
     background_tasks.append(task_fin)
     time.sleep(6)
 
-    if is_new_month or RESUME_SEC.exists():
+    if is_new_month or has_state("sec", LEGACY_SEC):
         task_sec = sec_scrape.submit()
         background_tasks.append(task_sec)
     else:
@@ -104,35 +111,47 @@ def perform_scraping_round(round_name, is_new_month):
 
     if MODE_FOR_WEALTHMAGIK == 1:
         task_bid_func.submit().wait()
-        if is_new_month or RESUME_WM_HOLDING.exists():
+        if is_new_month or has_state("holding_wm", LEGACY_WM_HOLDING):
             task_holding_func.submit().wait()
             clean_holding.submit().wait()
-        if is_new_month or RESUME_WM_ALLOC.exists():
+        if is_new_month or has_state("allocations_wm", LEGACY_WM_ALLOC):
             task_alloc_func.submit().wait()
 
     elif MODE_FOR_WEALTHMAGIK == 2:
         task_bid_func.submit().wait()
-        if is_new_month or RESUME_WM_HOLDING.exists():
+        if is_new_month or has_state("holding_wm", LEGACY_WM_HOLDING):
             h_future = task_holding_func.submit()
             c_future = clean_holding.submit(wait_for=[h_future])
             background_tasks.append(c_future)
-        if is_new_month or RESUME_WM_ALLOC.exists():
+        if is_new_month or has_state("allocations_wm", LEGACY_WM_ALLOC):
             background_tasks.append(task_alloc_func.submit())
 
     elif MODE_FOR_WEALTHMAGIK == 3:
         background_tasks.append(task_bid_func.submit())
-        if is_new_month or RESUME_WM_HOLDING.exists():
+        if is_new_month or has_state("holding_wm", LEGACY_WM_HOLDING):
             h_future = task_holding_func.submit()
             c_future = clean_holding.submit(wait_for=[h_future])
             background_tasks.append(c_future)
-        if is_new_month or RESUME_WM_ALLOC.exists():
+        if is_new_month or has_state("allocations_wm", LEGACY_WM_ALLOC):
             background_tasks.append(task_alloc_func.submit())
 
+    elif MODE_FOR_WEALTHMAGIK == 4:
+        need_holding = is_new_month or has_state("holding_wm", LEGACY_WM_HOLDING)
+        need_alloc = is_new_month or has_state("allocations_wm", LEGACY_WM_ALLOC)
+        crawler_wm_req.submit(need_holding, need_alloc).wait()
+        if need_holding:
+            clean_holding.submit().wait()
+
     if background_tasks:
         logger.info(f"Waiting for {len(background_tasks)} background tasks")
         for t in background_tasks:
             t.wait()
     logger.info("All scraping tasks finished.")
+    try:
+        snapshot = metrics.write_snapshot(METRICS_DIR/f"metrics_{datetime.now().strftime('%Y-%m-%d')}_{round_name}.prom")
+        logger.info(f"Metrics snapshot saved: {snapshot.name}")
+    except Exception as e:
+        logger.warning(f"Cannot save metrics snapshot: {e}")
 
     merged_file()
     set_isin_process()
@@ -145,7 +164,17 @@ def daily_scraper_cycle():
     if is_skip_day():
         print(f"Today is Skip Day (Day {datetime.now().weekday()})")
         return
-
+    # flow runs get their own process under .serve(), the scrapers' counters live here and reach
+    # the endpoint in the scheduler process through METRICS_LIVE_FILE
+    snapshots = metrics.start_snapshots(METRICS_LIVE_FILE) if METRICS_PORT else None
+    try: run_daily_pipeline()
+    finally:
+        if snapshots:
+            snapshots.set()
+            try: metrics.write_snapshot(METRICS_LIVE_FILE)
+            except Exception as e: print(f"Cannot save metrics snapshot: {e}")
+
+def run_daily_pipeline():
     is_new_month = check_is_new_month()
     if is_new_month: print("New Month Detected: Full Scrape Mode")
 
@@ -171,6 +200,10 @@ def daily_scraper_cycle():
     print("Pipeline Finished")
 
 if __name__ == "__main__":
+    try:
+        if metrics.start_server(METRICS_PORT, source=METRICS_LIVE_FILE): print(f"Metrics on port {METRICS_PORT}")
+    except Exception as e:
+        print(f"Metrics server not started: {e}")
     print(f"Scheduled to run daily at {DAILY_START_TIME}. Waiting")
     my_schedule = CronSchedule(
         cron="0 1 * * *", 
@@ -2,23 +2,23 @@ import pandas as pd
 from pathlib import Path
 import glob
 import time
-import re
 from datetime import datetime
 from prefect import task
+from nav_store import NavStore, MERGED_NAV_SCHEMA
 
 # CONFIG
 script_dir = Path(__file__).resolve().parent
 
 # Input Folders
 FN_RAW_DIR = script_dir/"finnomena/raw_data"
-FN_NAV_DIR = script_dir/"finnomena/all_nav"
+FN_NAV_STORE_DIR = script_dir/"finnomena/nav_store"
 WM_RAW_DIR = script_dir/"wealthmagik/raw_data"
 
 # Output Folders
 MERGED_OUTPUT_DIR = script_dir/"merged_output"
-MERGED_NAV_DIR = MERGED_OUTPUT_DIR/"merged_nav_all"
+MERGED_NAV_STORE_DIR = MERGED_OUTPUT_DIR/"merged_nav_store"
 
-for d in [MERGED_OUTPUT_DIR, MERGED_NAV_DIR]:
+for d in [MERGED_OUTPUT_DIR]:
     if not d.exists(): d.mkdir(parents=True, exist_ok=True)
 
 def log(msg):
@@ -31,10 +31,6 @@ def safe_read_csv(path):
         except: return pd.DataFrame()
     return pd.DataFrame()
 
-def sanitize_filename(name):
-    if not name: return "unknown"
-    return re.sub(r'[<>:"/\\|?*]', '_', str(name)).strip()
-
 def get_valid_fund_codes():
     path = FN_RAW_DIR/"finnomena_fund_list.csv"
     df = safe_read_csv(path)
@@ -191,46 +187,59 @@ def merge_codes():
 def merge_nav():
     log("Merging NAVs")
     wm_bid_offer_file = WM_RAW_DIR/"wealthmagik_bid_offer.csv"
-    wm_data_map = {}
     wm_df = safe_read_csv(wm_bid_offer_file)
     if not wm_df.empty:
         log(f"Loaded WealthMagik Bid/Offer data ({len(wm_df)} rows)")
-        for _, row in wm_df.iterrows():
-            code = str(row.get('fund_code', '')).strip()
-            date_str = str(row.get('nav_date', '')).strip()
-            bid = row.get('bid_price', '')
-            offer = row.get('offer_price', '')
-            if code and date_str:
-                wm_data_map[(code, date_str)] = {'bid': bid, 'offer': offer}
-    fin_files = list(FN_NAV_DIR.glob("*.csv"))
-    total_files = len(fin_files)
-    log(f"Found {total_files} historical NAV files from Finnomena")
-    count = 0
-    for f_path in fin_files:
-        count += 1
-        nav_df = safe_read_csv(f_path)
-        if nav_df.empty: continue
-        if 'fund_code' in nav_df.columns and not nav_df.empty:
-            fund_code = str(nav_df.iloc[0]['fund_code']).strip()
-        else:
-            fund_code = f_path.stem
-        nav_df['date_str'] = nav_df['date'].astype(str).str.strip()
-        def get_bid(date_val):
-            return wm_data_map.get((fund_code, date_val), {}).get('bid', '')
-        def get_offer(date_val):
-            return wm_data_map.get((fund_code, date_val), {}).get('offer', '')
-        nav_df['bid'] = nav_df['date_str'].map(get_bid)
-        nav_df['offer'] = nav_df['date_str'].map(get_offer)
-        nav_df['source_nav'] = "finnomena"
-        if 'fund_code' not in nav_df.columns:
-            nav_df['fund_code'] = fund_code
-        if 'date_str' in nav_df.columns: del nav_df['date_str']
-        safe_name = sanitize_filename(fund_code)
-        output_path = MERGED_NAV_DIR/f"merged_nav_{safe_name}.csv"
-        nav_df.to_csv(output_path, index=False, encoding="utf-8-sig")
-        if count % 300 == 0:
-            print(f"Processed NAVs: {count}/{total_files}")
-    log("NAV Merge Completed")
+        wm_df = pd.DataFrame({
+            'fund_code': wm_df['fund_code'].astype(str).str.strip(),
+            'date': pd.to_datetime(wm_df['nav_date'].astype(str).str.strip(), format="%d-%m-%Y", errors='coerce').dt.date,
+            'bid': pd.to_numeric(wm_df['bid_price'], errors='coerce'),
+            'offer': pd.to_numeric(wm_df['offer_price'], errors='coerce'),
+        }).dropna(subset=['date']).drop_duplicates(subset=['fund_code', 'date'], keep='last')
+    fn_store = NavStore(FN_NAV_STORE_DIR)
+    merged_store = NavStore(MERGED_NAV_STORE_DIR, schema=MERGED_NAV_SCHEMA)
+    changes = fn_store.changes()
+    if changes is None or merged_store.is_empty():
+        merge_nav_full(fn_store, merged_store, wm_df)
+    else:
+        merge_nav_changes(fn_store, merged_store, wm_df, changes)
+    merged_store.compact()
+
+def merge_bid_offer(nav_df, wm_df):
+    if not wm_df.empty:
+        nav_df = nav_df.merge(wm_df, on=['fund_code', 'date'], how='left')
+    nav_df['source_nav'] = "finnomena"
+    return nav_df
+
+def merge_nav_full(fn_store, merged_store, wm_df):
+    # every bucket rewritten, for a store without a change log yet; the loader then reloads everything too
+    changes = fn_store.changes()
+    total_funds = 0
+    total_rows = 0
+    for bucket, table in fn_store.iter_buckets():
+        nav_df = merge_bid_offer(table.to_pandas(), wm_df)
+        merged_store.write_bucket(bucket, merged_store.to_table(nav_df))
+        total_funds += nav_df['fund_code'].nunique()
+        total_rows += len(nav_df)
+    merged_store.reset_changes()
+    fn_store.ack(changes)
+    log(f"NAV Merge Completed ({total_funds} funds, {total_rows} rows, full)")
+
+def merge_nav_changes(fn_store, merged_store, wm_df, changes):
+    # only rows written since the last merge, plus the dates bid/offer just arrived for
+    since = dict(changes)
+    if not wm_df.empty:
+        for code, day in zip(wm_df['fund_code'], wm_df['date']):
+            day = day.isoformat()
+            if code not in since or day < since[code]: since[code] = day
+    total_rows = 0
+    funds = set()
+    for bucket, nav_df in fn_store.read_since(since):
+        nav_df = merge_bid_offer(nav_df, wm_df)
+        total_rows += merged_store.append(nav_df)
+        funds.update(nav_df['fund_code'])
+    fn_store.ack(changes)
+    log(f"NAV Merge Completed ({len(funds)} funds, {total_rows} rows changed)")
 
 @task(name="merged_funds_file", log_prints=True)
 def merged_file():
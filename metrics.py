@@ -0,0 +1,186 @@
+import re
+import threading
+from pathlib import Path
+from urllib.parse import urlparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# CONFIG
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0)  # seconds
+SNAPSHOT_SECONDS = 15  # how often start_snapshots rewrites its file
+ENDPOINT_PATTERNS = [  # url -> endpoint label, first match wins, keeps fund codes out of the labels
+    (r"/fund/v2/public/funds/?$", "fund_list"),
+    (r"/nav/q", "nav"),
+    (r"/fund/v2/public/funds/[^/]+/fee$", "fee"),
+    (r"/fund/v2/public/funds/[^/]+/portfolio$", "portfolio"),
+    (r"/fund/v2/public/funds/[^/]+/performance$", "performance"),
+    (r"/fund/v2/public/funds/[^/]+$", "info"),
+    (r"/search/_search", "search"),
+    (r"/stock/quote/", "quote"),
+    (r"/port/?$", "port"),
+    (r"/allocation/?$", "allocation"),
+    (r"/profile/?$", "profile"),
+    (r"web-fct-api\.sec\.or\.th/api/funds", "sec_funds"),
+    (r"\.pdf$", "factsheet"),
+]
+_COMPILED_PATTERNS = [(re.compile(p, re.IGNORECASE), name) for p, name in ENDPOINT_PATTERNS]
+_REGISTRY = []
+_COLLECTORS = []
+_LOCK = threading.Lock()
+_SERVER = None
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (list(extra.items()) if extra else [])
+    if not pairs: return ""
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        with _LOCK: _REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def inc(self, value=1, **labels):
+        k = self.key(labels)
+        with self.lock: self.values[k] = self.values.get(k, 0) + value
+
+    def render(self):
+        with self.lock: items = sorted(self.values.items())
+        return [f"{self.name}{format_labels(self.labelnames, k)} {v}" for k, v in items]
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        k = self.key(labels)
+        with self.lock: self.values[k] = value
+
+class Histogram(Counter):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help_text, labelnames)
+
+    def observe(self, value, **labels):
+        k = self.key(labels)
+        with self.lock:
+            entry = self.values.get(k)
+            if entry is None:
+                entry = self.values[k] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound: entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        with self.lock: items = sorted((k, ([*v[0]], v[1], v[2])) for k, v in self.values.items())
+        lines = []
+        for k, (counts, total, count) in items:
+            for bound, c in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, k, {'le': bound})} {c}")
+            lines.append(f"{self.name}_bucket{format_labels(self.labelnames, k, {'le': '+Inf'})} {count}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, k)} {total:.6f}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, k)} {count}")
+        return lines
+
+REQUESTS = Counter("scraper_requests_total", "HTTP requests by answer status", ["task", "host", "endpoint", "status"])
+REQUEST_SECONDS = Histogram("scraper_request_seconds", "HTTP request latency in seconds", ["task", "host", "endpoint"])
+RESPONSE_BYTES = Counter("scraper_response_bytes_total", "Response body bytes received", ["task", "host", "endpoint"])
+RETRIES = Counter("scraper_retries_total", "Requests sent again after a failed attempt", ["task", "host", "endpoint"])
+QUEUE_DEPTH = Gauge("scraper_queue_depth", "Items waiting in an in-process queue", ["task", "queue"])
+HOST_RATE = Gauge("scraper_host_rate", "Current requests per second allowed by the rate limiter", ["host"])
+HOST_CONCURRENCY = Gauge("scraper_host_concurrency", "Current concurrent requests allowed by the rate limiter", ["host"])
+
+def endpoint_label(url):
+    for pattern, name in _COMPILED_PATTERNS:
+        if pattern.search(url): return name
+    return "other"
+
+def observe_request(task, url, status, seconds, nbytes=0):
+    host = urlparse(url).hostname or ""
+    endpoint = endpoint_label(url)
+    REQUESTS.inc(task=task, host=host, endpoint=endpoint, status=status if status is not None else "error")
+    REQUEST_SECONDS.observe(seconds, task=task, host=host, endpoint=endpoint)
+    if nbytes: RESPONSE_BYTES.inc(nbytes, task=task, host=host, endpoint=endpoint)
+
+def count_retry(task, url):
+    RETRIES.inc(task=task, host=urlparse(url).hostname or "", endpoint=endpoint_label(url))
+
+def add_collector(fn):
+    # called before every render, for values that are cheaper to read than to push (limiter state)
+    with _LOCK: _COLLECTORS.append(fn)
+
+def render():
+    with _LOCK:
+        collectors = list(_COLLECTORS)
+        metrics = list(_REGISTRY)
+    for fn in collectors:
+        try: fn()
+        except: pass
+    lines = []
+    for m in metrics:
+        lines.append(f"# HELP {m.name} {m.help_text}")
+        lines.append(f"# TYPE {m.name} {m.kind}")
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+def write_snapshot(path):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(render())
+    tmp_path.replace(path)
+    return path
+
+def start_snapshots(path, interval=SNAPSHOT_SECONDS):
+    # for a process that can't hold the port itself (a flow run under Prefect .serve()), the process
+    # serving the endpoint reads the file; set the returned event to stop
+    stop = threading.Event()
+    def run():
+        while not stop.wait(interval):
+            try: write_snapshot(path)
+            except: pass
+    threading.Thread(target=run, name="metrics-snapshot", daemon=True).start()
+    return stop
+
+def read_source(path):
+    try: return Path(path).read_text(encoding="utf-8") if path else None
+    except OSError: return None
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = (read_source(self.server.source) or render()).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args): pass
+
+def start_server(port, host="0.0.0.0", source=None):
+    # source: snapshot file written by start_snapshots in another process, served instead of this
+    # process's own registry whenever it exists
+    global _SERVER
+    with _LOCK:
+        if _SERVER or not port: return _SERVER
+        _SERVER = ThreadingHTTPServer((host, port), MetricsHandler)
+        _SERVER.source = source
+    threading.Thread(target=_SERVER.serve_forever, name="metrics", daemon=True).start()
+    return _SERVER
@@ -0,0 +1,238 @@
+import os
+import json
+import zlib
+import time
+import threading
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pathlib import Path
+from datetime import datetime
+
+# CONFIG
+NUM_BUCKETS = 16  # funds are hashed into buckets, one compacted parquet file per bucket
+ROW_GROUP_SIZE = 50000  # rows are sorted by fund_code so per-fund reads only touch a few row groups
+COMPRESSION = "zstd"
+NAV_SCHEMA = pa.schema([
+    ("fund_code", pa.string()),
+    ("date", pa.date32()),
+    ("value", pa.float64()),
+    ("amount", pa.float64()),
+])
+MERGED_NAV_SCHEMA = pa.schema(list(NAV_SCHEMA) + [
+    ("bid", pa.float64()),
+    ("offer", pa.float64()),
+    ("source_nav", pa.string()),
+])
+KEY_COLS = ["fund_code", "date"]
+STAGE_FLUSH_ROWS = 50000  # staged rows are written out as delta files once this many are waiting
+STAGE_FLUSH_SECONDS = 600  # or once the oldest staged row has waited this long
+MAX_DELTA_FILES = 8  # compact() rewrites a bucket once it has this many delta files, readers merge them until then
+STAGED_FILE = "staged.csv"  # rows staged but not yet in a delta file, fsynced, replayed when the store is opened
+CHANGES_FILE = "changes.json"  # fund_code -> first date written since the store's reader last caught up
+
+def bucket_of(fund_code):
+    return zlib.crc32(str(fund_code).encode("utf-8")) % NUM_BUCKETS
+
+class NavStore:
+    def __init__(self, root_dir, schema=NAV_SCHEMA):
+        self.root_dir = Path(root_dir)
+        self.schema = schema
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.RLock()
+        self.staged = []
+        self.staged_rows = 0
+        self.staged_since = None
+        self.recover()
+
+    def bucket_dir(self, bucket):
+        return self.root_dir/f"bucket={bucket:02d}"
+
+    def bucket_parts(self, bucket):
+        d = self.bucket_dir(bucket)
+        # part.parquet is the compacted base, delta-*.parquet are appends in arrival order
+        return sorted(d.glob("*.parquet"), key=lambda p: (p.name != "part.parquet", p.name)) if d.exists() else []
+
+    def is_empty(self):
+        return not any(self.bucket_parts(b) for b in range(NUM_BUCKETS))
+
+    def to_table(self, df):
+        df = df.copy()
+        for field in self.schema:
+            if field.name not in df.columns: df[field.name] = None
+        df["fund_code"] = df["fund_code"].astype(str).str.strip()
+        df["date"] = pd.to_datetime(df["date"], errors="coerce").dt.date
+        for field in self.schema:
+            if pa.types.is_floating(field.type):
+                df[field.name] = pd.to_numeric(df[field.name], errors="coerce")
+        df = df.dropna(subset=KEY_COLS)
+        return pa.Table.from_pandas(df[self.schema.names], schema=self.schema, preserve_index=False)
+
+    def dedupe(self, table):
+        # later rows win, so a re-download of the same day replaces the old value
+        df = table.to_pandas()
+        df = df.drop_duplicates(subset=KEY_COLS, keep="last").sort_values(KEY_COLS)
+        return pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+
+    def read_bucket(self, bucket, columns=None, filters=None):
+        tables = [pq.read_table(p, columns=columns, filters=filters, schema=self.schema) for p in self.bucket_parts(bucket)]
+        if not tables:
+            return (self.schema if columns is None else pa.schema([self.schema.field(c) for c in columns])).empty_table()
+        table = pa.concat_tables(tables)
+        if len(tables) > 1 and columns is None: table = self.dedupe(table)
+        return table
+
+    def write_bucket(self, bucket, table):
+        d = self.bucket_dir(bucket)
+        d.mkdir(parents=True, exist_ok=True)
+        old_parts = self.bucket_parts(bucket)
+        tmp_path = d/"part.parquet.tmp"
+        pq.write_table(table.sort_by([(c, "ascending") for c in KEY_COLS]), tmp_path,
+                       compression=COMPRESSION, row_group_size=ROW_GROUP_SIZE)
+        tmp_path.replace(d/"part.parquet")
+        for p in old_parts:
+            if p.name != "part.parquet":
+                try: p.unlink()
+                except: pass
+
+    def append(self, df):
+        if df is None or len(df) == 0: return 0
+        table = self.to_table(df)
+        buckets = pd.Series([bucket_of(c) for c in table.column("fund_code").to_pylist()])
+        for bucket, idx in buckets.groupby(buckets).groups.items():
+            d = self.bucket_dir(bucket)
+            d.mkdir(parents=True, exist_ok=True)
+            part = table.take(pa.array(list(idx)))
+            tmp_path = d/f"delta-{time.time_ns()}.parquet.tmp"
+            pq.write_table(part, tmp_path, compression=COMPRESSION)
+            # appends are committed ahead of resume markers, so they have to be on disk, not just in the page cache
+            with open(tmp_path, "rb") as f: os.fsync(f.fileno())
+            tmp_path.replace(tmp_path.with_suffix(""))
+        self.mark_changed(table)
+        return table.num_rows
+
+    def stage(self, df):
+        # cheap durable append for a steady trickle of rows: one fsynced line per row in STAGED_FILE,
+        # delta files are only written per STAGE_FLUSH_ROWS / STAGE_FLUSH_SECONDS instead of per call
+        if df is None or len(df) == 0: return 0
+        table = self.to_table(df)
+        with self.lock:
+            path = self.root_dir/STAGED_FILE
+            with open(path, "a", newline="", encoding="utf-8") as f:
+                table.to_pandas().to_csv(f, header=f.tell() == 0, index=False)
+                f.flush()
+                os.fsync(f.fileno())
+            self.staged.append(table)
+            self.staged_rows += table.num_rows
+            if self.staged_since is None: self.staged_since = time.monotonic()
+            due = self.staged_rows >= STAGE_FLUSH_ROWS or time.monotonic() - self.staged_since >= STAGE_FLUSH_SECONDS
+        if due: self.flush()
+        return table.num_rows
+
+    def flush(self):
+        with self.lock:
+            if not self.staged: return 0
+            written = self.append(pa.concat_tables(self.staged).to_pandas())
+            (self.root_dir/STAGED_FILE).unlink(missing_ok=True)
+            self.staged, self.staged_rows, self.staged_since = [], 0, None
+        return written
+
+    def recover(self):
+        # rows staged by a run that never flushed them, writing them twice is harmless (later rows win)
+        path = self.root_dir/STAGED_FILE
+        if not path.exists(): return 0
+        try: df = pd.read_csv(path)
+        except Exception: df = None
+        written = self.append(df) if df is not None else 0
+        path.unlink(missing_ok=True)
+        return written
+
+    def compact(self, min_deltas=MAX_DELTA_FILES):
+        self.flush()
+        for bucket in range(NUM_BUCKETS):
+            deltas = [p for p in self.bucket_parts(bucket) if p.name != "part.parquet"]
+            if deltas and len(deltas) >= min_deltas:
+                self.write_bucket(bucket, self.read_bucket(bucket))
+
+    def changes(self):
+        # {fund_code: "YYYY-MM-DD"} written since ack(), None when unknown (a store from before the change log)
+        path = self.root_dir/CHANGES_FILE
+        if not path.exists(): return None if not self.is_empty() else {}
+        with open(path, "r", encoding="utf-8") as f: return json.load(f)
+
+    def save_changes(self, changes):
+        path = self.root_dir/CHANGES_FILE
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f: json.dump(changes, f)
+        tmp_path.replace(path)
+
+    def reset_changes(self):
+        # after a rewrite of every bucket: changes() is unknown (None) again, so the reader takes everything
+        with self.lock: (self.root_dir/CHANGES_FILE).unlink(missing_ok=True)
+
+    def mark_changed(self, table):
+        if not table.num_rows: return
+        agg = table.group_by("fund_code").aggregate([("date", "min")])
+        with self.lock:
+            changes = self.changes() or {}
+            for code, d in zip(agg.column("fund_code").to_pylist(), agg.column("date_min").to_pylist()):
+                day = d.isoformat()
+                if code not in changes or day < changes[code]: changes[code] = day
+            self.save_changes(changes)
+
+    def ack(self, seen):
+        # the reader has handled seen (what changes() returned), entries that moved earlier since stay
+        with self.lock:
+            changes = self.changes() or {}
+            seen = seen or {}
+            self.save_changes({code: day for code, day in changes.items() if seen.get(code) != day})
+
+    def read_since(self, since):
+        # {fund_code: first date} -> (bucket, DataFrame) with only those funds' rows from that date on
+        by_bucket = {}
+        for code in since: by_bucket.setdefault(bucket_of(code), []).append(code)
+        for bucket, codes in sorted(by_bucket.items()):
+            df = self.read_bucket(bucket, filters=[("fund_code", "in", codes)]).to_pandas()
+            if df.empty: continue
+            df = df[pd.to_datetime(df["date"]) >= pd.to_datetime(df["fund_code"].map(since))]
+            if len(df): yield bucket, df
+
+    def read_fund(self, fund_code, start=None, end=None):
+        filters = [("fund_code", "=", str(fund_code))]
+        if start: filters.append(("date", ">=", start))
+        if end: filters.append(("date", "<=", end))
+        return self.read_bucket(bucket_of(fund_code), filters=filters).to_pandas()
+
+    def iter_buckets(self):
+        for bucket in range(NUM_BUCKETS):
+            table = self.read_bucket(bucket)
+            if table.num_rows: yield bucket, table
+
+    def last_dates(self):
+        last = {}
+        for bucket in range(NUM_BUCKETS):
+            table = self.read_bucket(bucket, columns=KEY_COLS)
+            if not table.num_rows: continue
+            agg = table.group_by("fund_code").aggregate([("date", "max")])
+            for code, d in zip(agg.column("fund_code").to_pylist(), agg.column("date_max").to_pylist()):
+                last[code] = datetime.combine(d, datetime.min.time())
+        return last
+
+def import_csv_dir(store, csv_dir, pattern="*.csv", date_format="%d-%m-%Y"):
+    # one time migration from the old one-csv-per-fund layout
+    frames = []
+    imported = 0
+    for path in sorted(Path(csv_dir).glob(pattern)):
+        try: df = pd.read_csv(path)
+        except: continue
+        if df.empty or "date" not in df.columns: continue
+        if "fund_code" not in df.columns: df["fund_code"] = path.stem
+        df["date"] = pd.to_datetime(df["date"].astype(str).str.strip(), format=date_format, errors="coerce")
+        frames.append(df)
+        imported += 1
+        if len(frames) >= 200:
+            store.append(pd.concat(frames, ignore_index=True))
+            frames = []
+    if frames: store.append(pd.concat(frames, ignore_index=True))
+    store.compact()
+    return imported
@@ -0,0 +1,122 @@
+import asyncio
+import threading
+import time
+import metrics
+
+# CONFIG
+HOST_LIMITS = {  # where each host starts and how far it may climb; ceilings are the old fixed pacing, no host is pushed past it
+    "www.finnomena.com": {"rate": 2.0, "max_rate": 4.0, "concurrency": 2, "max_concurrency": 3},  # Don't set finnomena more than 3 to avoid ban
+    "www.wealthmagik.com": {"rate": 1.0, "max_rate": 1.5, "concurrency": 2, "max_concurrency": 3},  # was 3 threads with 1-3s sleeps. Don't set more than 3 to avoid ban
+    "web-fct-api.sec.or.th": {"rate": 0.3, "max_rate": 0.5, "concurrency": 1, "max_concurrency": 1},  # was one request at a time with 1-3s sleeps
+}
+DEFAULT_LIMIT = {"rate": 2.0, "max_rate": 4.0, "concurrency": 2, "max_concurrency": 2}  # factsheet PDFs on AMC sites, was 2 open requests
+MIN_RATE = 0.2  # requests per second, never slower than this
+BURST_SECONDS = 2.0  # the bucket holds this many seconds worth of tokens
+RATE_STEP = 0.05  # additive increase per healthy response (requests per second)
+BACKOFF_FACTOR = 0.5  # multiplicative decrease on 429/5xx/timeouts
+SLOW_LATENCY = 8.0  # seconds, slower answers stop the increase without backing off
+COOLDOWN_SECONDS = 5  # host pause after 429/5xx when there is no Retry-After
+ERROR_COOLDOWN_SECONDS = 2  # host pause after a timeout or connection error
+MAX_COOLDOWN_SECONDS = 120
+POLL_SECONDS = 0.05
+_LIMITERS = {}
+_LOCK = threading.Lock()
+
+def parse_retry_after(value):
+    try: return min(float(value), MAX_COOLDOWN_SECONDS)
+    except: return None
+
+class HostLimiter:
+    def __init__(self, host, rate, max_rate, concurrency, max_concurrency):
+        self.host = host
+        self.lock = threading.Lock()
+        self.rate = float(rate)
+        self.max_rate = float(max_rate)
+        self.limit = float(concurrency)
+        self.max_limit = float(max_concurrency)
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.last_backoff = 0.0
+        self.stats = {"requests": 0, "throttled": 0, "errors": 0, "slow": 0, "backoffs": 0, "waited": 0.0}
+
+    def try_acquire(self):
+        # 0 when a request may start now, otherwise seconds to wait before asking again
+        with self.lock:
+            now = time.monotonic()
+            if now < self.paused_until: return self.paused_until - now
+            if self.in_flight >= int(self.limit): return POLL_SECONDS
+            burst = max(1.0, self.rate * BURST_SECONDS)
+            self.tokens = min(burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1: return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+            self.in_flight += 1
+            self.stats["requests"] += 1
+            return 0
+
+    def started(self, asked_at):
+        now = time.monotonic()
+        with self.lock: self.stats["waited"] += now - asked_at
+        return now
+
+    def acquire(self):
+        asked_at = time.monotonic()
+        while True:
+            wait = self.try_acquire()
+            if not wait: return self.started(asked_at)
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        asked_at = time.monotonic()
+        while True:
+            wait = self.try_acquire()
+            if not wait: return self.started(asked_at)
+            await asyncio.sleep(wait)
+
+    def release(self, ticket, status=None, retry_after=None):
+        # status None means the request never got an answer (timeout, reset connection)
+        now = time.monotonic()
+        with self.lock:
+            self.in_flight = max(self.in_flight - 1, 0)
+            if status is None or status == 429 or status >= 500:
+                self.stats["errors" if status is None else "throttled"] += 1
+                pause = parse_retry_after(retry_after) or (ERROR_COOLDOWN_SECONDS if status is None else COOLDOWN_SECONDS)
+                self.paused_until = max(self.paused_until, now + pause)
+                # requests already in flight when we backed off don't count a second time
+                if ticket >= self.last_backoff:
+                    self.rate = max(MIN_RATE, self.rate * BACKOFF_FACTOR)
+                    self.limit = max(1.0, self.limit * BACKOFF_FACTOR)
+                    self.tokens = min(self.tokens, 0.0)
+                    self.last_backoff = now
+                    self.stats["backoffs"] += 1
+            elif now - ticket > SLOW_LATENCY:
+                self.stats["slow"] += 1
+            else:
+                self.rate = min(self.max_rate, self.rate + RATE_STEP)
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def summary(self):
+        s = self.stats
+        return (f"Rate limit ({self.host}): {s['requests']} requests, {s['throttled']} throttled (429/5xx), "
+                f"{s['errors']} without answer, {s['slow']} slow, {s['backoffs']} backoffs, waited {s['waited']:.0f}s, "
+                f"now {self.rate:.2f} req/s x {int(self.limit)} concurrent")
+
+def get_limiter(host):
+    host = host or "default"
+    with _LOCK:
+        if host not in _LIMITERS:
+            _LIMITERS[host] = HostLimiter(host, **HOST_LIMITS.get(host, DEFAULT_LIMIT))
+        return _LIMITERS[host]
+
+def limiter_summary(host):
+    return get_limiter(host).summary()
+
+def collect_metrics():
+    with _LOCK: limiters = list(_LIMITERS.values())
+    for limiter in limiters:
+        metrics.HOST_RATE.set(round(limiter.rate, 3), host=limiter.host)
+        metrics.HOST_CONCURRENCY.set(int(limiter.limit), host=limiter.host)
+
+metrics.add_collector(collect_metrics)
@@ -0,0 +1,98 @@
+import sqlite3
+import threading
+from pathlib import Path
+from datetime import datetime
+
+# CONFIG
+INDEX_FILE = Path(__file__).resolve().parent/"resume_index.db"
+BUSY_TIMEOUT = 30  # seconds, several scrapers commit to the same file
+
+def connect(db_path=INDEX_FILE):
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS resume (
+            task TEXT NOT NULL,
+            run_date TEXT NOT NULL,
+            fund TEXT NOT NULL,
+            done_at TEXT NOT NULL,
+            PRIMARY KEY (task, run_date, fund)
+        ) WITHOUT ROWID
+    """)
+    conn.commit()
+    return conn
+
+def has_state(task, legacy_file=None, db_path=INDEX_FILE):
+    # same meaning as "the resume log exists": the task left markers on some day and hasn't been reset since
+    if legacy_file and Path(legacy_file).exists(): return True  # not imported yet
+    if not Path(db_path).exists(): return False
+    conn = connect(db_path)
+    try: return conn.execute("SELECT 1 FROM resume WHERE task = ? LIMIT 1", (task,)).fetchone() is not None
+    finally: conn.close()
+
+# finished funds of one task for one run date, membership is answered from memory
+class ResumeIndex:
+    def __init__(self, task, run_date=None, legacy_file=None, log=print, db_path=INDEX_FILE):
+        self.task = task
+        self.run_date = run_date or datetime.now().strftime("%Y-%m-%d")
+        self.log = log
+        self.lock = threading.Lock()
+        self.conn = connect(db_path)
+        with self.lock:
+            # markers from an earlier day mean that run is over, like the old date-mismatch check
+            stale = self.conn.execute("DELETE FROM resume WHERE task = ? AND run_date <> ?", (task, self.run_date)).rowcount
+            if legacy_file: self.migrate(Path(legacy_file))
+            self.conn.commit()
+            self.finished = {row[0] for row in self.conn.execute(
+                "SELECT fund FROM resume WHERE task = ? AND run_date = ?", (task, self.run_date))}
+        if stale: log(f"Resume index ({task}): dropped {stale} entries from an earlier day")
+
+    def migrate(self, legacy_file):
+        # one-time import of the old <task>_resume.log, the file is removed once its entries are in the table
+        if not legacy_file.exists(): return
+        try:
+            with open(legacy_file, 'r', encoding='utf-8') as f:
+                parts = [line.strip().split('|') for line in f if line.strip()]
+            if parts and len(parts[0]) >= 2 and parts[0][1] == self.run_date:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO resume (task, run_date, fund, done_at) VALUES (?, ?, ?, ?)",
+                    [(self.task, self.run_date, p[0], p[2] if len(p) > 2 else "") for p in parts]
+                )
+            legacy_file.unlink()
+            self.log(f"Resume index ({self.task}): imported {len(parts)} entries from {legacy_file.name}")
+        except Exception as e:
+            self.log(f"Cannot import {legacy_file.name}: {e}")
+
+    def __contains__(self, fund):
+        return fund in self.finished
+
+    def __len__(self):
+        return len(self.finished)
+
+    def add(self, funds):
+        done_at = datetime.now().strftime("%H:%M:%S")
+        funds = [f for f in funds if f not in self.finished]
+        if not funds: return
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO resume (task, run_date, fund, done_at) VALUES (?, ?, ?, ?)",
+                [(self.task, self.run_date, f, done_at) for f in funds]
+            )
+            self.conn.commit()
+            self.finished.update(funds)
+
+    def add_lines(self, lines):
+        # resume_line() markers from the csv writer, "code|date|time"
+        self.add([line.split('|')[0] for line in lines])
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM resume WHERE task = ?", (self.task,))
+            self.conn.commit()
+            self.finished = set()
+
+    def close(self):
+        with self.lock:
+            try: self.conn.close()
+            except: pass
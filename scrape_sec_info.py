@@ -1,14 +1,23 @@
 import csv
+import json
+import hashlib
+import sqlite3
 import time
 import re
 from pathlib import Path
-import random
 import requests
 import math
 import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import quote, unquote
 from datetime import datetime
 from prefect import task
+from http_pool import get_session, close_sessions
+from rate_limiter import limiter_summary
+from metrics import count_retry
+from resume_index import ResumeIndex
+from csv_writer import CsvWriterThread, resume_line
 
 # CONFIG
 script_dir = Path(__file__).resolve().parent
@@ -17,14 +26,26 @@ INPUT_FILE = script_dir/"finnomena/raw_data/finnomena_fund_list.csv"
 OUTPUT_DIR = script_dir/"merged_output"
 if not OUTPUT_DIR.exists():OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 OUTPUT_FILENAME = OUTPUT_DIR/"all_sec_fund_info.csv"
-RESUME_FILE = script_dir/"scrape_sec_resume.log"
+DELTA_FILENAME = OUTPUT_DIR/"sec_fund_info_delta.csv"  # changed rows since the last db_loader run, it deletes the file after loading
+STATE_DB = script_dir/"scrape_sec_state.db"  # last representDate and row hash per fund
+RESUME_FILE = script_dir/"scrape_sec_resume.log"  # old resume log, imported into the resume index once
 API_URL = "https://web-fct-api.sec.or.th/api/funds"
-BATCH_SIZE = 2
+BATCH_STATE_FILE = script_dir/"scrape_sec_batch.json"  # last batch size the API accepted, next run starts there
+BATCH_SIZE_START = 2  # when there is no state file yet
+BATCH_SIZE_MIN = 1
+BATCH_SIZE_MAX = 200
+BATCH_GROW_FACTOR = 2  # after a batch goes through
+BATCH_SHRINK_FACTOR = 0.5  # after 400/413 or a timeout
+CEILING_RESET_BATCHES = 20  # a refused size is tried again after this many batches went through
 MAX_RETRIES = 3
 RETRY_DELAY = 2
+REQUEST_TIMEOUT = 20
+NUM_WORKERS = 4  # batches in flight at once, one session each, requests are paced by rate_limiter
 LOG_BUFFER = []
+HAS_ERROR = False
 _G_STORAGE = {}
 PROCESSED_COUNT = 0
+POOL_NAME = "sec"
 
 def get_obj(name):
     if name not in _G_STORAGE:
@@ -34,9 +55,6 @@ def get_obj(name):
             _G_STORAGE[name] = threading.Lock()
     return _G_STORAGE[name]
 
-def polite_sleep():
-    time.sleep(random.uniform(1, 3))
-
 def log(msg):
     global HAS_ERROR
     if "error" in msg.lower() or "failed" in msg.lower():
@@ -58,33 +76,9 @@ def save_log_if_error():
         print(f"Cannot save log file: {e}")
 
 def get_resume_state():
-    if not RESUME_FILE.exists(): return set()
-    finished = set()
-    try:
-        with open(RESUME_FILE, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        if not lines: return set()
-        first_line_parts = lines[0].strip().split('|')
-        if len(first_line_parts) < 2 or first_line_parts[1] != current_date_str:
-            log(f"Resume file date mismatch Deleting and starting new")
-            try: RESUME_FILE.unlink()
-            except: pass
-            return set()
-        for line in lines:
-            parts = line.strip().split('|')
-            if len(parts) >= 1: finished.add(parts[0])
-        log(f"Resuming Found {len(finished)} funds done")
-        return finished
-    except Exception as e: 
-        log(f"Error reading resume file: {e}")
-        return set()
-
-def append_resume_state(code):
-    try:
-        current_time = datetime.now().strftime("%H:%M:%S")
-        with open(RESUME_FILE, 'a', encoding='utf-8') as f:
-            f.write(f"{code}|{current_date_str}|{current_time}\n")
-    except: pass
+    finished = ResumeIndex(POOL_NAME, current_date_str, RESUME_FILE, log)
+    if finished: log(f"Resuming Found {len(finished)} funds done")
+    return finished
 
 def clean_number(text):
     if text is None: return ""
@@ -128,26 +122,236 @@ def create_session():
     })
     return s
 
+# finds the largest batch the API takes: doubles until a batch is refused, then bisects between
+# the largest accepted and the smallest refused size
+class BatchSizer:
+    def __init__(self, size=BATCH_SIZE_START):
+        self.size = min(max(int(size), BATCH_SIZE_MIN), BATCH_SIZE_MAX)
+        self.ceiling = BATCH_SIZE_MAX + 1  # smallest size refused in this run, growth stays below it
+        self.good = None
+        self.since_refused = 0
+        self.stats = {"batches": 0, "shrinks": 0, "singles": 0}
+        self.lock = threading.Lock()  # shared by all workers
+
+    @classmethod
+    def load(cls):
+        try:
+            with open(BATCH_STATE_FILE, 'r', encoding='utf-8') as f:
+                return cls(json.load(f).get("size", BATCH_SIZE_START))
+        except: return cls()
+
+    def save(self):
+        if not self.good: return
+        try:
+            tmp_path = BATCH_STATE_FILE.with_suffix(".tmp")
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"size": self.good, "updated": current_date_str}, f)
+            tmp_path.replace(BATCH_STATE_FILE)
+        except Exception as e:
+            log(f"Cannot save batch size: {e}")
+
+    def grow(self, used):
+        with self.lock:
+            self.stats["batches"] += 1
+            if used < self.ceiling: self.good = max(self.good or 0, used)
+            self.since_refused += 1
+            if self.ceiling <= BATCH_SIZE_MAX and self.since_refused >= CEILING_RESET_BATCHES:
+                # a single timeout shouldn't cap the size for the rest of the run
+                self.ceiling = BATCH_SIZE_MAX + 1
+                self.since_refused = 0
+            # the tail of the queue, or a batch taken before another worker grew the size
+            if used < self.size: return
+            if self.ceiling > BATCH_SIZE_MAX: target = int(self.size * BATCH_GROW_FACTOR)
+            else: target = (self.size + self.ceiling) // 2
+            self.size = max(self.size, min(target, self.ceiling - 1, BATCH_SIZE_MAX))
+
+    def shrink(self, used):
+        with self.lock:
+            self.stats["shrinks"] += 1
+            self.since_refused = 0
+            self.ceiling = min(self.ceiling, used)
+            if self.good and self.good >= self.ceiling: self.good = None  # accepted earlier, refused now: start over
+            self.size = max(BATCH_SIZE_MIN, int(used * BATCH_SHRINK_FACTOR), self.good or 0)
+
+    def add_single(self):
+        with self.lock: self.stats["singles"] += 1
+
+    def summary(self):
+        s = self.stats
+        return (f"SEC batches: {s['batches']} sent, {s['shrinks']} shrinks, {s['singles']} single-fund retries, "
+                f"size now {self.size} (largest accepted {self.good or '-'})")
+
+# last written row of every fund, a fund whose representDate and row hash are both the same is left out
+# of the csv files; new entries wait in memory until the writer confirms their rows are on disk
+class FundStateStore:
+    def __init__(self, db_path=STATE_DB):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS fund_state (
+                fund_code TEXT PRIMARY KEY,
+                represent_date TEXT NOT NULL,
+                row_hash TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            ) WITHOUT ROWID
+        """)
+        self.conn.commit()
+        self.known = {code: (date, row_hash) for code, date, row_hash in self.conn.execute(
+            "SELECT fund_code, represent_date, row_hash FROM fund_state")}
+        self.pending = {}
+        self.confirmed = {}
+        self.stats = {"changed": 0, "unchanged": 0}
+
+    def is_changed(self, fund_code, represent_date, row_hash):
+        state = (represent_date or "", row_hash)
+        with self.lock:
+            if self.known.get(fund_code) == state:
+                self.stats["unchanged"] += 1
+                return False
+            self.stats["changed"] += 1
+            self.pending[fund_code] = state
+            return True
+
+    def confirm(self, markers):
+        # writer on_commit callback, the rows of these funds are flushed to both csv files
+        with self.lock:
+            for line in markers:
+                code = line.split('|')[0]
+                if code in self.pending: self.confirmed[code] = self.pending.pop(code)
+
+    def save(self):
+        # only confirmed rows, a fund whose row never reached the files is written again next run
+        with self.lock:
+            if not self.confirmed: return
+            updated_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            try:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO fund_state (fund_code, represent_date, row_hash, updated_at) VALUES (?, ?, ?, ?)",
+                    [(code, date, row_hash, updated_at) for code, (date, row_hash) in self.confirmed.items()]
+                )
+                self.conn.commit()
+                self.known.update(self.confirmed)
+                self.confirmed = {}
+            except Exception as e:
+                log(f"Cannot save SEC fund state: {e}")
+
+    def close(self):
+        try: self.conn.close()
+        except: pass
+
+    def summary(self):
+        return f"SEC rows: {self.stats['changed']} changed, {self.stats['unchanged']} unchanged (skipped)"
+
+def row_hash(row):
+    return hashlib.sha1(json.dumps(row, sort_keys=True).encode("utf-8")).hexdigest()
+
 def fetch_batch_data(session, fund_codes_batch):
+    # ("ok", rows), ("too_big", None) for 400/413/timeouts on a multi-fund batch, ("error", None) after retries
+    # a single fund answered with 400 is a fund the API doesn't know, that is ("ok", [])
     for attempt in range(1, MAX_RETRIES + 1):
+        if get_obj("STOP_EVENT").is_set(): return "error", None
+        if attempt > 1: count_retry(POOL_NAME, API_URL)
         try:
-            response = session.post(API_URL, json=fund_codes_batch, timeout=20)
+            response = session.post(API_URL, json=fund_codes_batch, timeout=REQUEST_TIMEOUT)
             if response.status_code == 200:
-                return response.json()
-            elif response.status_code == 400:
-                return [] 
+                return "ok", response.json() or []
+            elif response.status_code in (400, 413):
+                if len(fund_codes_batch) > 1: return "too_big", None
+                return "ok", []
             elif response.status_code == 429:
-                time.sleep(5)
+                continue  # rate_limiter pauses the host (Retry-After or cooldown) before the retry goes out
             else:
                 log(f"API Error {response.status_code} (Batch size: {len(fund_codes_batch)})")
+        except requests.Timeout:
+            if len(fund_codes_batch) > 1: return "too_big", None
+            log(f"Timeout for {fund_codes_batch[0]} (Attempt {attempt})")
         except Exception as e:
             log(f"Connection Error (Attempt {attempt}): {e}")
             time.sleep(RETRY_DELAY)
-            
-    return []
+    return "error", None
+
+def fetch_funds(session, batch, sizer):
+    # (status, {fund code: api row}, unresolved codes), the map only when status is "ok"
+    # a fund is "Not Found" only after a single-fund request answered without it, unresolved ones got no answer
+    status, data = fetch_batch_data(session, batch)
+    if status != "ok": return status, None, []
+    sizer.grow(len(batch))
+    api_data_map = {item.get("abbrName"): item for item in data if isinstance(item, dict) and item.get("abbrName")}
+    unresolved = []
+    if len(batch) > 1:
+        # big answers sometimes leave funds out, those get asked for one by one
+        for code in [c for c in batch if c not in api_data_map]:
+            sizer.add_single()
+            status, data = fetch_batch_data(session, [code])
+            if status == "ok":
+                api_data_map.update({item.get("abbrName"): item for item in data if isinstance(item, dict) and item.get("abbrName")})
+            else:
+                unresolved.append(code)
+    return "ok", api_data_map, unresolved
+
+def build_row(fund_code, match_data):
+    safe_code = quote(fund_code, safe='')
+    sec_page_url = f"https://fundcheck.sec.or.th/fund-detail;funds={safe_code}"
+    row_data = {
+        "fund_code": fund_code,
+        "sec_url": sec_page_url,
+        "as_of_date": "N/A",
+        "sharpe_ratio": "", "alpha": "", "beta": "",
+        "max_drawdown": "", "recovering_period": "",
+        "tracking_error": "", "turnover_ratio": "", "fx_hedging": ""
+    }
+    if match_data:
+        row_data["as_of_date"] = convert_thai_date(match_data.get("representDate"))
+        row_data["sharpe_ratio"] = clean_number(match_data.get("sharpRatio"))
+        row_data["alpha"] = clean_number(match_data.get("alpha"))
+        row_data["beta"] = clean_number(match_data.get("beta"))
+        row_data["max_drawdown"] = clean_number(match_data.get("maximumDrawdown"))
+        row_data["tracking_error"] = clean_number(match_data.get("trackingError"))
+        row_data["turnover_ratio"] = clean_number(match_data.get("turnoverRatio"))
+        row_data["fx_hedging"] = clean_number(match_data.get("fxHedging"))
+        row_data["recovering_period"] = calculate_recovering_days(match_data.get("recoveringPeriod"))
+    return row_data
+
+def process_batches(work_queue, sizer, writer, store, total_all, finished_start):
+    # each worker takes the next batch at the current size, answers come back in any order and
+    # every batch goes to the writer with its own resume markers, nothing waits on a slow batch
+    global PROCESSED_COUNT
+    session = get_session(POOL_NAME, create_session)
+    while not get_obj("STOP_EVENT").is_set():
+        with get_obj("QUEUE_LOCK"):
+            if not work_queue: break
+            batch = [work_queue.popleft() for _ in range(min(sizer.size, len(work_queue)))]
+        status, api_data_map, unresolved = fetch_funds(session, batch, sizer)
+        if status == "too_big":
+            sizer.shrink(len(batch))
+            with get_obj("QUEUE_LOCK"): work_queue.extendleft(reversed(batch))
+            continue
+        if status == "error":
+            log(f"No answer for {len(batch)} funds ({batch[0]}..), kept for next round")
+            continue
+        if unresolved:
+            # no marker, the next round asks for them again
+            log(f"No answer for {len(unresolved)} funds ({', '.join(unresolved[:3])}..), kept for next round")
+            batch = [c for c in batch if c not in unresolved]
+        batch_rows = []
+        for fund_code in batch:
+            match_data = api_data_map.get(fund_code)
+            row_data = build_row(fund_code, match_data)
+            changed = store.is_changed(fund_code, (match_data or {}).get("representDate"), row_hash(row_data))
+            if changed: batch_rows.append(row_data)
+            with get_obj("COUNT_LOCK"):
+                PROCESSED_COUNT += 1
+                current_total = finished_start + PROCESSED_COUNT
+            status_msg = "(SEC)" if match_data else "(Not Found SEC)"
+            if not changed: status_msg = "(SEC unchanged)"
+            log(f"[{current_total}/{total_all}] {fund_code} {status_msg}")
+        # marked done by the writer once the rows are on disk, unchanged funds only get the marker
+        writer.submit({"rows": batch_rows, "delta": batch_rows}, [resume_line(code, current_date_str) for code in batch])
 
 @task(name="sec_scraper", log_prints=True)
 def sec_scrape():
+    global HAS_ERROR
     finished_funds = get_resume_state()
     all_funds = []
     if not INPUT_FILE.exists():
@@ -168,6 +372,7 @@ def sec_scrape():
     log(f"Total: {total_all}, Finished: {finished_start}, Remaining: {len(pending_funds)}")
     if not pending_funds:
         log("All done (SEC)")
+        finished_funds.close()
         return
 
     headers = [
@@ -177,64 +382,46 @@ def sec_scrape():
         "tracking_error", "turnover_ratio", "fx_hedging",
         "sec_url"
     ]
-    if not OUTPUT_FILENAME.exists() or OUTPUT_FILENAME.stat().st_size == 0:
-        with open(OUTPUT_FILENAME, 'w', newline="", encoding="utf-8-sig") as f:
-            writer = csv.DictWriter(f, fieldnames=headers)
-            writer.writeheader()
-    session = create_session()
-    chunks = [pending_funds[i:i + BATCH_SIZE] for i in range(0, len(pending_funds), BATCH_SIZE)]
-    log(f"Starting processing {len(chunks)} batches")
+    store = FundStateStore()
+    # row hashes are kept only once the writer has the rows on disk
+    writer = CsvWriterThread(finished_funds, log, POOL_NAME, on_commit=store.confirm)
+    for key, path in (("rows", OUTPUT_FILENAME), ("delta", DELTA_FILENAME)):
+        write_header = not path.exists() or path.stat().st_size == 0
+        writer.add_output(key, path, headers, 'a', write_header)
+    writer.start()
+    sizer = BatchSizer.load()
+    work_queue = deque(pending_funds)
+    num_workers = min(NUM_WORKERS, len(pending_funds))
+    log(f"Starting {num_workers} workers with batch size {sizer.size}")
     global PROCESSED_COUNT
     PROCESSED_COUNT = 0
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    futures = []
     try:
-        for batch in chunks:
-            if get_obj("STOP_EVENT").is_set():break
-            api_data_list = fetch_batch_data(session, batch)
-            api_data_map = {item.get("abbrName"): item for item in api_data_list if item.get("abbrName")}
-            batch_rows = []
-            for fund_code in batch:
-                match_data = api_data_map.get(fund_code)
-                safe_code = quote(fund_code, safe='')
-                sec_page_url = f"https://fundcheck.sec.or.th/fund-detail;funds={safe_code}"
-                row_data = {
-                    "fund_code": fund_code,
-                    "sec_url": sec_page_url,
-                    "as_of_date": "N/A",
-                    "sharpe_ratio": "", "alpha": "", "beta": "",
-                    "max_drawdown": "", "recovering_period": "",
-                    "tracking_error": "", "turnover_ratio": "", "fx_hedging": ""
-                }
-                if match_data:
-                    row_data["as_of_date"] = convert_thai_date(match_data.get("representDate"))
-                    row_data["sharpe_ratio"] = clean_number(match_data.get("sharpRatio"))
-                    row_data["alpha"] = clean_number(match_data.get("alpha"))
-                    row_data["beta"] = clean_number(match_data.get("beta"))
-                    row_data["max_drawdown"] = clean_number(match_data.get("maximumDrawdown"))
-                    row_data["tracking_error"] = clean_number(match_data.get("trackingError"))
-                    row_data["turnover_ratio"] = clean_number(match_data.get("turnoverRatio"))
-                    row_data["fx_hedging"] = clean_number(match_data.get("fxHedging"))
-                    row_data["recovering_period"] = calculate_recovering_days(match_data.get("recoveringPeriod"))
-                batch_rows.append(row_data)
-                with get_obj("COUNT_LOCK"):
-                    PROCESSED_COUNT += 1
-                    current_total = finished_start + PROCESSED_COUNT
-                status_msg = "(SEC)" if match_data else "(Not Found SEC)"
-                log(f"[{current_total}/{total_all}] {fund_code} {status_msg}")
-                append_resume_state(fund_code)
-            with get_obj("CSV_LOCK"):
-                with open(OUTPUT_FILENAME, 'a', newline="", encoding="utf-8-sig") as f:
-                    writer = csv.DictWriter(f, fieldnames=headers)
-                    writer.writerows(batch_rows)
-            polite_sleep()
-
+        for _ in range(num_workers):
+            futures.append(executor.submit(process_batches, work_queue, sizer, writer, store, total_all, finished_start))
+        for future in as_completed(futures):
+            try: future.result()
+            except Exception as e: log(f"Error in SEC worker: {e}")
     except KeyboardInterrupt:
         log("\nStopping Scraper")
         get_obj("STOP_EVENT").set()
+        executor.shutdown(wait=False, cancel_futures=True)
         HAS_ERROR = True
     except Exception as e:
         log(f"Critical Error: {e}")
         HAS_ERROR = True
     finally:
+        writer.close()
+        finished_funds.close()
+        store.save()
+        store.close()
+        log(writer.summary())
+        log(store.summary())
+        sizer.save()
+        log(sizer.summary())
+        log(close_sessions(POOL_NAME))
+        log(limiter_summary("web-fct-api.sec.or.th"))
         save_log_if_error()
         log("Done (SEC)")
 
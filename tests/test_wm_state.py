@@ -0,0 +1,132 @@
+import json
+import sys
+import pytest
+from pathlib import Path
+
+root = Path(__file__).resolve().parent.parent
+if str(root) not in sys.path: sys.path.append(str(root))
+from wealthmagik import wm_state, bid_offer_wealthmagik
+from wealthmagik.wm_state import extract_state, parse_state, to_rows, remember, recall, format_percent
+from wealthmagik.holding_wealthmagik import parse_holdings_html
+from wealthmagik.allocations_wealthmagik import parse_allocations_html, ALLOC_KINDS
+
+# hand-built pages: they check the state walk and the DOM parsers agree, not that STATE_LISTS matches the live site
+FIXTURES_DIR = root/"tests"/"fixtures"/"wealthmagik"
+
+CAPTURED_DIR = root/"wealthmagik"/"fixtures"  # pages saved from the live site by benchmark_parsers.py --fetch
+
+def captured(page):
+    paths = sorted(CAPTURED_DIR.glob(f"*__{page}.html")) if CAPTURED_DIR.exists() else []
+    if not paths: pytest.skip(f"no captured {page} pages, run wealthmagik/benchmark_parsers.py --fetch N")
+    return [(path.stem.rpartition("__")[0], path.read_bytes()) for path in paths]
+
+def fixtures(page):
+    paths = sorted(FIXTURES_DIR.glob(f"*__{page}.html"))
+    assert paths, f"no {page} fixtures in {FIXTURES_DIR}"
+    return [(path.stem.rpartition("__")[0], path.read_bytes()) for path in paths]
+
+def test_holdings_from_state_match_dom():
+    for code, content in fixtures("port"):
+        url = f"https://www.wealthmagik.com/funds/{code}/port"
+        from_state = to_rows(parse_state(extract_state(content)), ["holding"], code, url)
+        from_dom = parse_holdings_html(content.decode("utf-8"), code, url, "html.parser")
+        assert from_state, code
+        assert from_state == from_dom, code
+
+def test_allocations_from_state_match_dom():
+    for code, content in fixtures("allocation"):
+        url = f"https://www.wealthmagik.com/funds/{code}/allocation"
+        parsed = parse_state(extract_state(content))
+        assert all(parsed.get(k) for k in ALLOC_KINDS), code
+        from_dom = parse_allocations_html(content.decode("utf-8"), code, url, "html.parser")
+        assert to_rows(parsed, ALLOC_KINDS, code, url) == from_dom, code
+
+def test_lookalike_keys_are_not_holdings():
+    state = {
+        "support-info": {"contacts": [{"name": "Call center", "value": "02-123"}]},
+        "stopTrading": [{"name": "Holiday", "ratio": 0}],
+        "stockPrice": [{"name": "SET", "percent": 1.25}],
+        "assetValue": [{"name": "NAV", "value": 1234.5}],
+    }
+    parsed = parse_state(state)
+    assert parsed == {}
+    remember("TEST-LOOKALIKE", parsed)
+    assert recall("TEST-LOOKALIKE", ["holding"]) is None
+    wm_state._SEEN.pop("TEST-LOOKALIKE", None)
+
+def test_format_percent_matches_page_text():
+    assert format_percent(12.5) == "12.50"
+    assert format_percent(100) == "100.00"
+    assert format_percent(6.1234) == "6.12"
+    assert format_percent("8.00%") == "8.00"
+    assert format_percent("-") == "-"
+
+def test_dom_percent_keeps_page_spelling():
+    html = '<div class="portallocation-list"><span class="name-text">PTT</span><span class="ratio-text">12.50%</span></div>'
+    rows = parse_holdings_html(html, "TEST", "https://www.wealthmagik.com/funds/TEST/port", "html.parser")
+    assert rows[0]["percent"] == "12.50"
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, content):
+        self.content = content
+
+class FakeSession:
+    def __init__(self, content):
+        self.content = content
+
+    def get(self, url, timeout=None):
+        return FakeResponse(self.content)
+
+def profile_page(state):
+    escaped = json.dumps(state).replace('"', "&q;").encode("utf-8")
+    return b'<html><body><app-root></app-root><script id="serverApp-state" type="application/json">' + escaped + b"</script></body></html>"
+
+def test_profile_state_shares_sibling_lists():
+    holdings = [{"name": "PTT", "ratio": 12.5}, {"name": "KBANK", "ratio": 9.75}]
+    state = {
+        "fund-detail": {"fundCode": "TEST-SIBLING", "tnaclassDate": "20250930", "bidPrice": 10.1, "offerPrice": 10.2},
+        "top5Holdings": {"asOfDate": "20250930", "items": holdings},
+    }
+    session = FakeSession(profile_page(state))
+    result = bid_offer_wealthmagik.fetch_fund_data("TEST-SIBLING", "https://www.wealthmagik.com/funds/TEST-SIBLING/profile", session)
+    assert result == {"fund_code": "TEST-SIBLING", "nav_date": "30-09-2025", "bid_price": 10.1, "offer_price": 10.2}
+    shared = recall("TEST-SIBLING", ["holding"])
+    wm_state._SEEN.pop("TEST-SIBLING", None)
+    assert shared == {"holding": [("PTT", format_percent(12.5), "30-09-2025"), ("KBANK", format_percent(9.75), "30-09-2025")]}
+
+def test_profile_without_lists_reads_only_fund_detail():
+    state = {"fund-detail": {"fundCode": "TEST-DETAIL", "tnaclassDate": "20250930", "bidPrice": 1, "offerPrice": 2}}
+    content = profile_page(state)
+    assert not wm_state.has_key(content, wm_state.STATE_LISTS)
+    assert wm_state.extract_section(content, "fund-detail") == state["fund-detail"]
+
+def test_captured_port_state_matches_dom():
+    # the real check of STATE_LISTS: the live state must give the rows the live page shows
+    for code, content in captured("port"):
+        url = f"https://www.wealthmagik.com/funds/{code}/port"
+        from_dom = parse_holdings_html(content.decode("utf-8"), code, url, "html.parser")
+        if not from_dom: continue
+        assert to_rows(parse_state(extract_state(content)), ["holding"], code, url) == from_dom, code
+
+def test_captured_allocation_state_matches_dom():
+    for code, content in captured("allocation"):
+        url = f"https://www.wealthmagik.com/funds/{code}/allocation"
+        from_dom = parse_allocations_html(content.decode("utf-8"), code, url, "html.parser")
+        if not from_dom: continue
+        assert to_rows(parse_state(extract_state(content)), ALLOC_KINDS, code, url) == from_dom, code
+
+def test_captured_state_lists_are_all_read():
+    for code, content in captured("port") + captured("allocation"):
+        state = extract_state(content)
+        assert state is not None, code
+        holding_like = [path for path, rows, read in wm_state.find_lists(state) if not read]
+        assert all("holding" not in path.lower() and "allocation" not in path.lower() for path in holding_like), (code, holding_like)
+
+def test_summary_flags_a_state_path_that_never_hits():
+    for _ in range(3): wm_state.count("TEST-SUMMARY", "dom")
+    assert "failed" in wm_state.state_summary("TEST-SUMMARY")
+    wm_state.count("TEST-SUMMARY", "state")
+    wm_state.count("TEST-SUMMARY", "dom")
+    assert "failed" not in wm_state.state_summary("TEST-SUMMARY")
@@ -5,7 +5,7 @@ from pathlib import Path
 import random
 import requests
 import threading
-from bs4 import BeautifulSoup
+import sys
 from urllib.parse import unquote
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -19,13 +19,23 @@ RAW_DATA_DIR = script_dir/"raw_data"
 if not RAW_DATA_DIR.exists():RAW_DATA_DIR.mkdir(parents=True, exist_ok=True)
 INPUT_FILENAME = RAW_DATA_DIR/"wealthmagik_fund_list.csv"
 OUTPUT_FILENAME = RAW_DATA_DIR/"wealthmagik_allocations.csv"
-RESUME_FILE = script_dir/"allocations_resume.log"
+RESUME_FILE = script_dir/"allocations_resume.log"  # old resume log, imported into the resume index once
 MAX_RETRIES = 3
 RETRY_DELAY = 2
 LOG_BUFFER = []
 HAS_ERROR = False
 _G_STORAGE = {}
-NUM_WORKERS = 3
+NUM_WORKERS = 3  # Threads, requests to www.wealthmagik.com are paced by rate_limiter. Don't set more than 3 to avoid ban
+POOL_NAME = "allocations_wm"
+if str(root) not in sys.path: sys.path.append(str(root))
+from http_pool import get_session, close_sessions
+from rate_limiter import limiter_summary
+from metrics import count_retry
+from csv_writer import CsvWriterThread, resume_line
+from resume_index import ResumeIndex
+from wealthmagik.html_backend import parse_html
+from wealthmagik.wm_state import extract_state, parse_state, remember, recall, to_rows, count, state_summary
+ALLOC_KINDS = ["asset_alloc", "country_alloc"]
 
 def create_authenticated_session():
     s = requests.Session()
@@ -67,9 +77,6 @@ def get_obj(name):
             _G_STORAGE[name] = threading.Lock()
     return _G_STORAGE[name]
 
-def polite_sleep():
-    time.sleep(random.uniform(1, 3))
-
 def log(msg):
     global HAS_ERROR
     if "error" in msg.lower() or "failed" in msg.lower():
@@ -90,39 +97,13 @@ def save_log_if_error():
     except: pass
 
 def get_resume_state():
-    if not RESUME_FILE.exists(): return set()
-    finished = set()
-    try:
-        with open(RESUME_FILE, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        if not lines: return set()
-        first_line_parts = lines[0].strip().split('|')
-        if len(first_line_parts) < 2 or first_line_parts[1] != current_date_str:
-            log(f"Resume file date mismatch Deleting and starting new")
-            try: RESUME_FILE.unlink()
-            except: pass
-            return set()
-        for line in lines:
-            parts = line.strip().split('|')
-            if len(parts) >= 1: finished.add(parts[0])
-        log(f"Resuming Found {len(finished)} funds done")
-        return finished
-    except Exception as e: 
-        log(f"Error reading resume file: {e}")
-        return set()
-
-def append_resume_state(code):
-    with get_obj("CSV_LOCK"):
-        try:
-            current_time = datetime.now().strftime("%H:%M:%S")
-            with open(RESUME_FILE, 'a', encoding='utf-8') as f:
-                f.write(f"{code}|{current_date_str}|{current_time}\n")
-        except: pass
+    finished = ResumeIndex(POOL_NAME, current_date_str, RESUME_FILE, log)
+    if finished: log(f"Resuming Found {len(finished)} funds done")
+    return finished
 
 def cleanup_resume_file():
-    if RESUME_FILE.exists():
-        try: RESUME_FILE.unlink()
-        except: pass
+    try: ResumeIndex(POOL_NAME, current_date_str, log=log).clear()
+    except: pass
 
 def clean_text(text):
     return re.sub(r'\s+', ' ', text).strip() if text else ""
@@ -171,21 +152,36 @@ def scrape_section_soup(soup, container_class, data_type, fund_code, url):
     except: pass
     return results
 
+def parse_allocations_html(html, fund_code, alloc_url, backend=None):
+    # rows, [] for a rendered page without tables, None when the page didn't render
+    soup = parse_html(html, backend)
+    all_data = []
+    all_data.extend(scrape_section_soup(soup, "investmentAllocationByAsset", "asset_alloc", fund_code, alloc_url))
+    all_data.extend(scrape_section_soup(soup, "investmentAllocationByCountry", "country_alloc", fund_code, alloc_url))
+    if all_data: return all_data
+    if soup.select(".fundName") or soup.select("h1"): return []
+    return None
+
 def scrape_allocations(session, fund_code, profile_url):
     alloc_url = re.sub(r"/profile/?$", "/allocation", profile_url)
-    polite_sleep()
+    shared = recall(fund_code, ALLOC_KINDS)
+    if shared is not None:
+        count(POOL_NAME, "shared")
+        return to_rows(shared, ALLOC_KINDS, fund_code, alloc_url)
     for attempt in range(1, MAX_RETRIES + 1):
         if get_obj("STOP_EVENT").is_set(): return None
+        if attempt > 1: count_retry(POOL_NAME, alloc_url)
         try:
             response = session.get(alloc_url, timeout=10)
             if response.status_code == 200:
-                soup = BeautifulSoup(response.text, 'html.parser')
-                all_data = []
-                all_data.extend(scrape_section_soup(soup, "investmentAllocationByAsset", "asset_alloc", fund_code, alloc_url))
-                all_data.extend(scrape_section_soup(soup, "investmentAllocationByCountry", "country_alloc", fund_code, alloc_url))
-                if all_data: return all_data
-                if soup.select(".fundName") or soup.select("h1"):
-                    return []
+                parsed = parse_state(extract_state(response.content))
+                remember(fund_code, parsed)
+                if all(parsed.get(k) for k in ALLOC_KINDS):
+                    count(POOL_NAME, "state")
+                    return to_rows(parsed, ALLOC_KINDS, fund_code, alloc_url)
+                all_data = parse_allocations_html(response.text, fund_code, alloc_url)
+                if all_data: count(POOL_NAME, "dom")
+                if all_data is not None: return all_data
             elif response.status_code == 404:
                 return []
             if attempt < MAX_RETRIES: time.sleep(RETRY_DELAY)
@@ -197,7 +193,7 @@ def scrape_allocations(session, fund_code, profile_url):
 
 def process_fund_task(fund, writer):
     if get_obj("STOP_EVENT").is_set(): return None
-    session = create_authenticated_session()
+    session = get_session(POOL_NAME, create_authenticated_session)
     try:
         code = unquote(fund.get("fund_code", "")).strip()
         url = fund.get("url", "")
@@ -205,19 +201,15 @@ def process_fund_task(fund, writer):
         data = scrape_allocations(session, code, url) 
         if get_obj("STOP_EVENT").is_set(): return None
         if data:
-            with get_obj("CSV_LOCK"):
-                writer.writerows(data)
-            append_resume_state(code)
+            writer.submit({"rows": data}, resume_line(code, current_date_str))
             return f"{code} Done (allocations/wealthmagik)" 
         elif data == []:
-             append_resume_state(code)
+             writer.submit(resume=resume_line(code, current_date_str))
              return f"{code} - No Data"
         else:
              raise Exception("Failed to fetch")
     except Exception as e:
         raise e
-    finally:
-        session.close()
 
 @task(name="allocations_wm_request", log_prints=True)
 def allo_wm_req():
@@ -230,21 +222,22 @@ def allo_wm_req():
         log(f"Input file not found: {INPUT_FILENAME}")
         return
     mode = 'a' if finished_funds else 'w'
-    f_out = open(OUTPUT_FILENAME, mode, newline="", encoding="utf-8-sig")
     keys = ["fund_code", "type", "name", "percent", "as_of_date", "source_url"]
-    writer = csv.DictWriter(f_out, fieldnames=keys)
-    if mode == 'w': writer.writeheader()
+    writer = CsvWriterThread(finished_funds, log, POOL_NAME)
+    writer.add_output("rows", OUTPUT_FILENAME, keys, mode, mode == 'w')
     pending_funds = [f for f in funds if unquote(f.get("fund_code", "")).strip() not in finished_funds]
     total = len(funds)
     current_fund_codes = {unquote(f.get("fund_code", "")).strip() for f in funds}
-    finished_count_start = len(finished_funds.intersection(current_fund_codes))
+    finished_count_start = sum(1 for c in current_fund_codes if c in finished_funds)
     remaining = len(pending_funds)
     log(f"Total: {total}, Finished: {finished_count_start}, Remaining: {remaining}")
     if remaining == 0:
         log("All done")
-        f_out.close()
+        writer.close()
+        finished_funds.close()
         return
     log(f"Starting Scraper (allocations wealtmagik)")
+    writer.start()
     executor = ThreadPoolExecutor(max_workers=NUM_WORKERS)
     futures = []
     try:
@@ -263,8 +256,6 @@ def allo_wm_req():
                          log(f"[{current_total}/{total}] {result_msg}")
                     else:
                          log(f"[{current_total}/{total}] {result_msg}")
-                    if count % 10 == 0:
-                        with get_obj("CSV_LOCK"): f_out.flush()
 
             except Exception as e:
                 pass
@@ -276,7 +267,12 @@ def allo_wm_req():
         global HAS_ERROR
         HAS_ERROR = True
     finally:
-        f_out.close()
+        writer.close()
+        finished_funds.close()
+        log(writer.summary())
+        log(state_summary(POOL_NAME))
+        log(close_sessions(POOL_NAME))
+        log(limiter_summary("www.wealthmagik.com"))
         save_log_if_error()
         log("Done (allocations/WM)")
 
@@ -0,0 +1,166 @@
+import argparse
+import csv
+import json
+import re
+import subprocess
+import sys
+import time
+from pathlib import Path
+from urllib.parse import unquote
+
+# CONFIG
+script_dir = Path(__file__).resolve().parent
+root = script_dir.parent
+FIXTURES_DIR = script_dir/"fixtures"  # <fund code>__port.html / <fund code>__allocation.html as served, saved by --fetch
+MIN_PAGE_KB = 50  # a rendered port/allocation page is far bigger, smaller files are hand-built or cut down
+INPUT_FILENAME = script_dir/"raw_data"/"wealthmagik_fund_list.csv"
+PAGES = ["port", "allocation"]
+REPEAT = 3
+POOL_NAME = "benchmark_wm"
+if str(root) not in sys.path: sys.path.append(str(root))
+from wealthmagik.html_backend import available_backends
+from wealthmagik.wm_state import extract_state, find_lists
+from wealthmagik.holding_wealthmagik import parse_holdings_html, create_authenticated_session
+from wealthmagik.allocations_wealthmagik import parse_allocations_html
+from http_pool import get_session, close_sessions
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+EXTRACTORS = {"port": parse_holdings_html, "allocation": parse_allocations_html}
+
+def fetch_fixtures(limit, fixtures_dir):
+    fixtures_dir.mkdir(parents=True, exist_ok=True)
+    with open(INPUT_FILENAME, "r", encoding="utf-8-sig") as f:
+        funds = list(csv.DictReader(f))[:limit]
+    session = get_session(POOL_NAME, create_authenticated_session)
+    saved = 0
+    for fund in funds:
+        code = unquote(fund.get("fund_code", "")).strip()
+        for page in PAGES:
+            url = re.sub(r"/profile/?$", f"/{page}", fund.get("url", ""))
+            try:
+                response = session.get(url, timeout=10)
+                if response.status_code != 200: continue
+                (fixtures_dir/f"{code}__{page}.html").write_bytes(response.content)
+                saved += 1
+            except Exception as e:
+                print(f"Cannot fetch {url}: {e}")
+    print(f"Saved {saved} pages to {fixtures_dir}")
+    print(close_sessions(POOL_NAME))
+
+def load_fixtures(fixtures_dir):
+    pages = []
+    for path in sorted(fixtures_dir.glob("*.html")):
+        code, _, page = path.stem.rpartition("__")
+        if page in EXTRACTORS:
+            pages.append((code, page, path.read_text(encoding="utf-8", errors="replace")))
+    return pages
+
+def print_state_keys(pages):
+    # which state lists hold name/percent rows on the captured pages, and whether STATE_LISTS reads them
+    for code, page, html in pages:
+        state = extract_state(html)
+        if state is None:
+            print(f"{code}/{page}: no serverApp-state")
+            continue
+        lists = find_lists(state)
+        if not lists: print(f"{code}/{page}: no name/percent lists in the state")
+        for path, rows, read in lists:
+            print(f"{code}/{page}: {path} ({rows} rows){'' if read else '  <- not in STATE_LISTS'}")
+
+def run_backend(backend, pages):
+    return [EXTRACTORS[page](html, code, f"https://www.wealthmagik.com/funds/{code}/{page}", backend) for code, page, html in pages]
+
+def time_backend(backend, pages, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run_backend(backend, pages)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def peak_rss():
+    # bytes, the whole process including what lxml/selectolax allocate in C
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss)
+    return None
+
+def child_memory(backend, fixtures_dir):
+    # runs in its own interpreter, every parser library is already imported and the pages are read before "before"
+    pages = load_fixtures(fixtures_dir)
+    before = peak_rss()
+    run_backend(backend, pages)
+    print(json.dumps({"before": before, "peak": peak_rss()}))
+
+def measure_memory(backend, fixtures_dir):
+    # (peak RSS, growth while parsing) in bytes, None when it can't be measured here
+    try:
+        out = subprocess.run(
+            [sys.executable, str(Path(__file__).resolve()), "--child-memory", backend, "--fixtures", str(fixtures_dir)],
+            capture_output=True, text=True, timeout=600, check=True
+        ).stdout.strip().splitlines()
+        result = json.loads(out[-1])
+        if result["peak"] is None: return None
+        return result["peak"], result["peak"] - result["before"]
+    except Exception:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare HTML parser backends on saved WealthMagik pages")
+    parser.add_argument("--fixtures", type=Path, default=FIXTURES_DIR)
+    parser.add_argument("--fetch", type=int, default=0, help="download port/allocation pages for the first N funds first")
+    parser.add_argument("--backends", default=",".join(available_backends()))
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--state-keys", action="store_true", help="list the name/percent lists in each page state and exit")
+    parser.add_argument("--allow-small", action="store_true", help=f"run on pages under {MIN_PAGE_KB} KB too")
+    parser.add_argument("--child-memory", metavar="BACKEND", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child_memory:
+        child_memory(args.child_memory, args.fixtures)
+        return 0
+    if args.fetch: fetch_fixtures(args.fetch, args.fixtures)
+    pages = load_fixtures(args.fixtures)
+    if not pages:
+        print(f"No fixtures in {args.fixtures} (use --fetch N)")
+        return 1
+    if args.state_keys:
+        print_state_keys(pages)
+        return 0
+    small = [f"{code}/{page}" for code, page, html in pages if len(html) < MIN_PAGE_KB * 1024]
+    if small and not args.allow_small:
+        print(f"{len(small)} of {len(pages)} pages are under {MIN_PAGE_KB} KB ({', '.join(small[:5])}), timings on them say nothing about real pages")
+        print("Capture real pages with --fetch N (or pass --allow-small to compare outputs only)")
+        return 1
+    backends = [b.strip() for b in args.backends.split(",") if b.strip()]
+    print(f"{len(pages)} pages, {sum(len(p[2]) for p in pages) / 1024 / 1024:.1f} MB of HTML, best of {args.repeat}")
+    reference = run_backend("html.parser", pages)
+    mismatched = 0
+    print(f"{'backend':<12} {'total s':>9} {'ms/page':>9} {'RSS MB':>8} {'+parse MB':>10}  output")
+    for backend in backends:
+        try:
+            output = run_backend(backend, pages)
+        except Exception as e:
+            print(f"{backend:<12} skipped: {e}")
+            continue
+        diffs = [f"{code}/{page}" for (code, page, _), a, b in zip(pages, reference, output) if a != b]
+        mismatched += len(diffs)
+        elapsed = time_backend(backend, pages, args.repeat)
+        memory = measure_memory(backend, args.fixtures)
+        rss = f"{memory[0] / 1024 / 1024:>8.1f} {memory[1] / 1024 / 1024:>10.1f}" if memory else f"{'-':>8} {'-':>10}"
+        status = "identical" if not diffs else f"{len(diffs)} pages differ: {', '.join(diffs[:5])}"
+        print(f"{backend:<12} {elapsed:>9.3f} {elapsed / len(pages) * 1000:>9.2f} {rss}  {status}")
+    return 1 if mismatched else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,9 +3,10 @@ import time
 from pathlib import Path
 import random
 import threading
-import json
+import queue
+import sys
 import requests
-from bs4 import BeautifulSoup
+from urllib.parse import unquote
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from prefect import task
@@ -18,10 +19,19 @@ RAW_DATA_DIR = script_dir/"raw_data"
 if not RAW_DATA_DIR.exists():RAW_DATA_DIR.mkdir(parents=True, exist_ok=True)
 INPUT_FILENAME = RAW_DATA_DIR/"wealthmagik_fund_list.csv"
 OUTPUT_FILENAME = RAW_DATA_DIR/"wealthmagik_bid_offer.csv"
-RESUME_FILE = script_dir/"bid_offer_resume.log"
+RESUME_FILE = script_dir/"bid_offer_resume.log"  # old resume log, imported into the resume index once
 MAX_RETRIES = 3
 RETRY_DELAY = 2
-NUM_WORKERS = 3
+NUM_WORKERS = 3  # Threads, requests to www.wealthmagik.com are paced by rate_limiter. Don't set more than 3 to avoid ban
+PROGRESS_SECONDS = 30  # how often the overall rate/ETA line is logged
+POOL_NAME = "bid_offer_wm"
+if str(root) not in sys.path: sys.path.append(str(root))
+from http_pool import get_session, close_sessions
+from rate_limiter import limiter_summary
+from metrics import count_retry
+from csv_writer import CsvWriterThread, resume_line
+from resume_index import ResumeIndex
+from wealthmagik.wm_state import extract_state, extract_section, has_key, parse_state, remember, STATE_LISTS
 LOG_BUFFER = []
 HAS_ERROR = False
 _G_STORAGE = {}
@@ -40,9 +50,7 @@ def get_obj(name):
             _G_STORAGE[name] = threading.Lock()
     return _G_STORAGE[name]
 PROCESSED_COUNT = 0 
-
-def polite_sleep():
-    time.sleep(random.uniform(1, 2))
+LAST_PROGRESS = 0.0
 
 def log(msg):
     global HAS_ERROR
@@ -66,34 +74,16 @@ def save_log_if_error():
     except: pass
 
 def load_finished_funds():
-    finished = set()
+    # funds already in the output csv count as finished too, as they did before the resume index
+    finished = ResumeIndex(POOL_NAME, current_date_str, RESUME_FILE, log)
     if OUTPUT_FILENAME.exists():
         try:
             with open(OUTPUT_FILENAME, 'r', encoding="utf-8-sig") as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    if row.get("fund_code"):
-                        finished.add(row["fund_code"])
+                finished.add({row["fund_code"] for row in csv.DictReader(f) if row.get("fund_code")})
         except Exception as e:
             log(f"Error reading output file: {e}")
-    if RESUME_FILE.exists():
-        try:
-            with open(RESUME_FILE, 'r', encoding='utf-8') as f:
-                for line in f:
-                    parts = line.strip().split('|')
-                    if len(parts) >= 1: finished.add(parts[0])
-        except Exception as e:
-            log(f"Error reading resume file: {e}")
     return finished
 
-def append_resume_state(code):
-    with get_obj("RESUME_LOCK"):
-        try:
-            current_time = datetime.now().strftime("%H:%M:%S")
-            with open(RESUME_FILE, 'a', encoding='utf-8') as f:
-                f.write(f"{code}|{current_date_str}|{current_time}\n")
-        except: pass
-
 def format_date(date_str):
     if not date_str: return ""
     try:
@@ -101,25 +91,34 @@ def format_date(date_str):
     except:
         return date_str
 
-def fetch_fund_data(fund_code, fund_url):
-    url = fund_url 
-    headers = {
+def create_session():
+    s = requests.Session()
+    s.headers.update({
         "User-Agent": random.choice(USER_AGENTS),
         "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
         "Referer": "https://www.wealthmagik.com/",
         "Connection": "keep-alive"
-    }
+    })
+    return s
+
+def fetch_fund_data(fund_code, fund_url, session=None):
+    url = fund_url 
+    session = session or get_session(POOL_NAME, create_session)
     for attempt in range(MAX_RETRIES):
         if get_obj("STOP_EVENT").is_set(): return None
+        if attempt: count_retry(POOL_NAME, url)
         try:
-            response = requests.get(url, headers=headers, timeout=10)
+            response = session.get(url, timeout=10)
             if response.status_code == 200:
-                soup = BeautifulSoup(response.text, 'html.parser')
-                script_tag = soup.find("script", {"id": "serverApp-state"})
-                if script_tag:
-                    raw_json = script_tag.string.replace('&q;', '"')
-                    data = json.loads(raw_json)
-                    fund_detail = data.get('fund-detail', {})
+                # only the fund-detail slice of the raw bytes is decoded, unless holdings/allocations sit in the
+                # same state: those are read too, they save the later scrapers a request
+                content = response.content
+                fund_detail = None if has_key(content, STATE_LISTS) else extract_section(content, 'fund-detail')
+                state = {'fund-detail': fund_detail} if fund_detail is not None else extract_state(content)
+                if state is not None:
+                    parsed = parse_state(state)
+                    remember(unquote(fund_code), parsed)
+                    fund_detail = parsed.get('fund_detail', {})
                     return {
                         "fund_code": fund_detail.get('fundCode'),
                         "nav_date": format_date(fund_detail.get('tnaclassDate')),
@@ -135,30 +134,47 @@ def fetch_fund_data(fund_code, fund_url):
         time.sleep(RETRY_DELAY * (attempt + 1))
     return None
 
-def process_batch(worker_id, funds, fieldnames, total_all_funds, finished_count_start):
+def report_progress(total_all_funds, finished_count_start, remaining, run_started):
+    global LAST_PROGRESS
+    now = time.monotonic()
+    with get_obj("COUNT_LOCK"):
+        if now - LAST_PROGRESS < PROGRESS_SECONDS: return
+        LAST_PROGRESS = now
+        done = PROCESSED_COUNT
+    rate = done / max(now - run_started, 1e-6)
+    eta = (remaining - done) / rate if rate else 0
+    log(f"Progress: {finished_count_start + done}/{total_all_funds} ({rate:.2f} funds/s, ETA {eta / 60:.1f} min)")
+
+def process_queue(worker_id, work_queue, writer, total_all_funds, finished_count_start, remaining, run_started, stats):
+    # every worker takes the next fund as soon as it is free, so one slow page only holds up its own worker
     global PROCESSED_COUNT
-    with open(OUTPUT_FILENAME, 'a', newline="", encoding="utf-8-sig") as f_out:
-        writer = csv.DictWriter(f_out, fieldnames=fieldnames)
-        for fund_item in funds:
-            if get_obj("STOP_EVENT").is_set(): break
-            fund_code = fund_item['fund_code']
-            fund_url = fund_item['url']
-            result = fetch_fund_data(fund_code, fund_url)
-            with get_obj("COUNT_LOCK"):
-                PROCESSED_COUNT += 1
-                current_progress = finished_count_start + PROCESSED_COUNT
-            if isinstance(result, dict):
-                with get_obj("CSV_LOCK"):
-                    writer.writerow(result)
-                    f_out.flush()
-                append_resume_state(fund_code)
-                log(f"[{current_progress}/{total_all_funds}] {fund_code} (bid_offer/wealthmagik)")
-            elif result == "Not Found":
-                log(f"[{current_progress}/{total_all_funds}] {fund_code} (Not Found)")
-                append_resume_state(fund_code)
-            else:
-                log(f"[{current_progress}/{total_all_funds}] {fund_code} (No Data)")
-            polite_sleep()
+    while not get_obj("STOP_EVENT").is_set():
+        try: fund_item = work_queue.get_nowait()
+        except queue.Empty: break
+        fund_code = fund_item['fund_code']
+        fund_url = fund_item['url']
+        started = time.monotonic()
+        result = fetch_fund_data(fund_code, fund_url)
+        stats["busy"] += time.monotonic() - started
+        stats["funds"] += 1
+        with get_obj("COUNT_LOCK"):
+            PROCESSED_COUNT += 1
+            current_progress = finished_count_start + PROCESSED_COUNT
+        if isinstance(result, dict):
+            writer.submit({"rows": [result]}, resume_line(fund_code, current_date_str))
+            log(f"[{current_progress}/{total_all_funds}] {fund_code} (bid_offer/wealthmagik)")
+        elif result == "Not Found":
+            log(f"[{current_progress}/{total_all_funds}] {fund_code} (Not Found)")
+            writer.submit(resume=resume_line(fund_code, current_date_str))
+        else:
+            log(f"[{current_progress}/{total_all_funds}] {fund_code} (No Data)")
+        report_progress(total_all_funds, finished_count_start, remaining, run_started)
+
+def utilization_summary(worker_stats, run_started):
+    wall = max(time.monotonic() - run_started, 1e-6)
+    parts = [f"w{i} {s['funds']} funds {s['busy'] / wall:.0%}" for i, s in enumerate(worker_stats, 1)]
+    busy = sum(s["busy"] for s in worker_stats) / (wall * len(worker_stats)) if worker_stats else 0
+    return f"Workers: {busy:.0%} busy over {wall:.0f}s | " + ", ".join(parts)
 
 @task(name="bid_offer_wm_request", log_prints=True)
 def bid_offer_wm_req():
@@ -183,22 +199,24 @@ def bid_offer_wm_req():
     log(f"Total: {total_all_funds}, Finished: {finished_count_start}, Remaining: {remaining}")
     if remaining == 0:
         log("All done")
+        finished_funds.close()
         return
     fieldnames = ["fund_code", "nav_date", "bid_price", "offer_price"]
-    if not OUTPUT_FILENAME.exists() or OUTPUT_FILENAME.stat().st_size == 0:
-         with open(OUTPUT_FILENAME, 'w', newline="", encoding="utf-8-sig") as f_out:
-            writer = csv.DictWriter(f_out, fieldnames=fieldnames)
-            writer.writeheader()
-    chunk_size = (len(pending_funds) // NUM_WORKERS) + 1
-    batches = [pending_funds[i:i + chunk_size] for i in range(0, len(pending_funds), chunk_size)]
-    log(f"Starting {len(batches)} workers")
-    global PROCESSED_COUNT
+    write_header = not OUTPUT_FILENAME.exists() or OUTPUT_FILENAME.stat().st_size == 0
+    writer = CsvWriterThread(finished_funds, log, POOL_NAME).add_output("rows", OUTPUT_FILENAME, fieldnames, 'a', write_header).start()
+    work_queue = queue.Queue()
+    for fund_item in pending_funds: work_queue.put(fund_item)
+    num_workers = min(NUM_WORKERS, remaining)
+    log(f"Starting {num_workers} workers")
+    global PROCESSED_COUNT, LAST_PROGRESS
     PROCESSED_COUNT = 0 
-    executor = ThreadPoolExecutor(max_workers=NUM_WORKERS)
+    run_started = LAST_PROGRESS = time.monotonic()
+    worker_stats = [{"funds": 0, "busy": 0.0} for _ in range(num_workers)]
+    executor = ThreadPoolExecutor(max_workers=num_workers)
     futures = []
     try:
-        for i, batch in enumerate(batches):
-            futures.append(executor.submit(process_batch, i+1, batch, fieldnames, total_all_funds, finished_count_start))
+        for i, stats in enumerate(worker_stats):
+            futures.append(executor.submit(process_queue, i+1, work_queue, writer, total_all_funds, finished_count_start, remaining, run_started, stats))
         for future in as_completed(futures):
             try: future.result()
             except Exception as e: pass 
@@ -208,6 +226,12 @@ def bid_offer_wm_req():
         global HAS_ERROR
         HAS_ERROR = True
     finally:
+        writer.close()
+        finished_funds.close()
+        log(writer.summary())
+        log(utilization_summary(worker_stats, run_started))
+        log(close_sessions(POOL_NAME))
+        log(limiter_summary("www.wealthmagik.com"))
         save_log_if_error()
         log("Done (bid_offer/WM)")
 
@@ -0,0 +1,188 @@
+import csv
+import time
+import threading
+import sys
+from pathlib import Path
+from urllib.parse import unquote
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from prefect import task
+
+# CONFIG
+script_dir = Path(__file__).resolve().parent
+root = script_dir.parent
+current_date_str = datetime.now().strftime("%Y-%m-%d")
+RAW_DATA_DIR = script_dir/"raw_data"
+if not RAW_DATA_DIR.exists(): RAW_DATA_DIR.mkdir(parents=True, exist_ok=True)
+INPUT_FILENAME = RAW_DATA_DIR/"wealthmagik_fund_list.csv"
+NUM_WORKERS = 8  # Threads, each keeps one session for all pages of its funds, requests are paced by rate_limiter
+POOL_NAME = "crawler_wm"
+LOG_BUFFER = []
+HAS_ERROR = False
+_G_STORAGE = {}
+if str(root) not in sys.path: sys.path.append(str(root))
+from http_pool import get_session, close_sessions
+from rate_limiter import limiter_summary
+from csv_writer import CsvWriterThread, resume_line
+from wealthmagik.wm_state import state_summary
+from wealthmagik import bid_offer_wealthmagik as bid_offer
+from wealthmagik import holding_wealthmagik as holding
+from wealthmagik import allocations_wealthmagik as allocations
+# resume state per dataset, kept under the single-page scrapers' task names so either can pick up after the other
+DATASETS = {
+    "bid_offer": {"module": bid_offer, "output": bid_offer.OUTPUT_FILENAME,
+                  "fields": ["fund_code", "nav_date", "bid_price", "offer_price"]},
+    "holding": {"module": holding, "output": holding.OUTPUT_FILENAME,
+                "fields": ["fund_code", "type", "name", "percent", "as_of_date", "source_url"]},
+    "allocations": {"module": allocations, "output": allocations.OUTPUT_FILENAME,
+                    "fields": ["fund_code", "type", "name", "percent", "as_of_date", "source_url"]},
+}
+
+def get_obj(name):
+    if name not in _G_STORAGE:
+        if name == "STOP_EVENT":
+            _G_STORAGE[name] = threading.Event()
+        else:
+            _G_STORAGE[name] = threading.Lock()
+    return _G_STORAGE[name]
+
+def log(msg):
+    global HAS_ERROR
+    if "error" in msg.lower() or "failed" in msg.lower():
+        HAS_ERROR = True
+    timestamp = time.strftime('%H:%M:%S')
+    with get_obj("LOG_LOCK"):
+        print(f"[{timestamp}] {msg}")
+        LOG_BUFFER.append(f"[{timestamp}] {msg}")
+
+def save_log_if_error():
+    if not HAS_ERROR: return
+    try:
+        log_dir = root/"Logs"
+        if not log_dir.exists(): log_dir.mkdir(parents=True, exist_ok=True)
+        filename = f"crawler_wm_{datetime.now().strftime('%Y-%m-%d')}.log"
+        with open(log_dir/filename, "w", encoding="utf-8") as f:
+            f.write("\n".join(LOG_BUFFER))
+    except: pass
+
+def open_writers(datasets, finished):
+    writers = {}
+    for name in datasets:
+        d = DATASETS[name]
+        writer = CsvWriterThread(finished[name], log, f"{POOL_NAME}_{name}")
+        if name == "bid_offer":
+            # bid/offer appends across days like its own scraper does
+            write_header = not d["output"].exists() or d["output"].stat().st_size == 0
+            writer.add_output("rows", d["output"], d["fields"], 'a', write_header)
+        else:
+            mode = 'a' if finished[name] else 'w'
+            writer.add_output("rows", d["output"], d["fields"], mode, mode == 'w')
+        writers[name] = writer.start()
+    return writers
+
+def crawl_fund(fund, needs, writers):
+    # all pages of one fund on the worker's session, profile first so its state can fill holdings/allocations
+    if get_obj("STOP_EVENT").is_set(): return None
+    session = get_session(POOL_NAME, holding.create_authenticated_session)
+    raw_code = fund.get("fund_code", "").strip()
+    code = unquote(raw_code).strip()
+    url = fund.get("url", "").strip()
+    done, failed = [], []
+    if "bid_offer" in needs:
+        result = bid_offer.fetch_fund_data(raw_code, url, session)
+        if isinstance(result, dict):
+            writers["bid_offer"].submit({"rows": [result]}, resume_line(raw_code, current_date_str))
+            done.append("bid_offer")
+        elif result == "Not Found":
+            writers["bid_offer"].submit(resume=resume_line(raw_code, current_date_str))
+            done.append("bid_offer")
+        else:
+            failed.append("bid_offer")
+    for name, scrape in (("holding", holding.scrape_holdings), ("allocations", allocations.scrape_allocations)):
+        if name not in needs or get_obj("STOP_EVENT").is_set(): continue
+        data = scrape(session, code, url)
+        if data is None:
+            failed.append(name)
+            continue
+        writers[name].submit({"rows": data} if data else None, resume_line(code, current_date_str))
+        done.append(name)
+    return code, done, failed
+
+def stop_all():
+    get_obj("STOP_EVENT").set()
+    for d in DATASETS.values():
+        d["module"].get_obj("STOP_EVENT").set()
+
+@task(name="crawler_wm_request", log_prints=True)
+def crawler_wm_req(with_holdings=True, with_allocations=True):
+    log("Starting WealthMagik Crawler")
+    funds = []
+    try:
+        with open(INPUT_FILENAME, "r", encoding="utf-8-sig") as f:
+            for row in csv.DictReader(f):
+                if row.get("fund_code") and row.get("url"): funds.append(row)
+    except:
+        log(f"Error: Input file not found: {INPUT_FILENAME}")
+        return
+    datasets = ["bid_offer"] + (["holding"] if with_holdings else []) + (["allocations"] if with_allocations else [])
+    finished = {"bid_offer": bid_offer.load_finished_funds()}
+    if with_holdings: finished["holding"] = holding.get_resume_state()
+    if with_allocations: finished["allocations"] = allocations.get_resume_state()
+    work = []
+    for fund in funds:
+        raw_code = fund["fund_code"].strip()
+        code = unquote(raw_code).strip()
+        needs = {name for name in datasets if (raw_code if name == "bid_offer" else code) not in finished[name]}
+        if needs: work.append((fund, needs))
+    total = len(funds)
+    finished_count_start = total - len(work)
+    pages = sum(len(needs) for _, needs in work)
+    log(f"Total: {total}, Finished: {finished_count_start}, Remaining: {len(work)} funds ({pages} pages: {', '.join(datasets)})")
+    if not work:
+        log("All done")
+        for index in finished.values(): index.close()
+        return
+    writers = open_writers(datasets, finished)
+    executor = ThreadPoolExecutor(max_workers=NUM_WORKERS)
+    futures = []
+    try:
+        count = 0
+        for fund, needs in work:
+            if get_obj("STOP_EVENT").is_set(): break
+            futures.append(executor.submit(crawl_fund, fund, needs, writers))
+        for future in as_completed(futures):
+            if get_obj("STOP_EVENT").is_set(): break
+            try:
+                result = future.result()
+                if not result: continue
+                code, done, failed = result
+                count += 1
+                current_total = finished_count_start + count
+                if failed:
+                    log(f"[{current_total}/{total}] {code} missing {', '.join(failed)} (wealthmagik, kept for next round)")
+                else:
+                    log(f"[{current_total}/{total}] {code} Done ({', '.join(done)}/wealthmagik)")
+            except Exception as e:
+                log(f"Error in crawler worker: {e}")
+    except KeyboardInterrupt:
+        log("Stopping Crawler")
+        stop_all()
+        executor.shutdown(wait=False, cancel_futures=True)
+        global HAS_ERROR
+        HAS_ERROR = True
+    finally:
+        for writer in writers.values():
+            writer.close()
+            log(writer.summary())
+        for index in finished.values(): index.close()
+        for name in ("holding_wm", "allocations_wm"):
+            log(state_summary(name))
+        log(close_sessions(POOL_NAME))
+        log(limiter_summary("www.wealthmagik.com"))
+        # page errors are logged by the scraper modules whose fetch code we run
+        for d in DATASETS.values(): d["module"].save_log_if_error()
+        save_log_if_error()
+        log("Done (crawler/WM)")
+
+if __name__ == "__main__":
+    crawler_wm_req.fn()
@@ -0,0 +1,50 @@
+from bs4 import BeautifulSoup
+
+# CONFIG
+PARSER_BACKEND = "html.parser"  # auto, selectolax, lxml or html.parser; stays on html.parser until benchmark_parsers.py on captured pages shows a faster one gives the same rows
+AUTO_ORDER = ["selectolax", "lxml", "html.parser"]  # what "auto" tries first
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+try:
+    import lxml  # only needed as the BeautifulSoup tree builder
+except ImportError:
+    lxml = None
+
+# the scrapers only use select/select_one/get_text, so a selectolax node gets those three and nothing else
+class SelectolaxNode:
+    __slots__ = ("node",)
+
+    def __init__(self, node):
+        self.node = node
+
+    def select(self, css):
+        return [SelectolaxNode(n) for n in self.node.css(css)]
+
+    def select_one(self, css):
+        n = self.node.css_first(css)
+        return SelectolaxNode(n) if n is not None else None
+
+    def get_text(self):
+        return self.node.text(deep=True)
+
+def available_backends():
+    found = []
+    if LexborHTMLParser is not None: found.append("selectolax")
+    if lxml is not None: found.append("lxml")
+    found.append("html.parser")
+    return found
+
+def resolve_backend(name=None):
+    name = name or PARSER_BACKEND
+    found = available_backends()
+    if name == "auto": return next(b for b in AUTO_ORDER if b in found)
+    if name not in found: raise ValueError(f"HTML parser backend not installed: {name}")
+    return name
+
+def parse_html(html, backend=None):
+    backend = resolve_backend(backend)
+    if backend == "selectolax": return SelectolaxNode(LexborHTMLParser(html).root)
+    return BeautifulSoup(html, backend)
@@ -0,0 +1,200 @@
+import json
+import re
+import threading
+from datetime import datetime
+
+# CONFIG
+STATE_START = b'id="serverApp-state"'
+STATE_END = b"</script>"
+STATE_ESCAPES = [(b"&q;", b'"'), (b"&s;", b"'"), (b"&l;", b"<"), (b"&g;", b">"), (b"&a;", b"&")]  # Angular TransferState, &a; last
+ESCAPED_TOKEN = re.compile(rb"&q;|[{}]")  # string quotes are still &q; before unescaping
+NAME_KEYS = ["name", "nameTh", "nameEn", "securityName", "assetName", "countryName", "stockName", "holdingName"]
+PERCENT_KEYS = ["ratio", "percent", "percentage", "weight", "ratioPercent", "navPercent"]
+PERCENT_DECIMALS = 2  # as rendered on the port/allocation pages
+DATE_KEYS = ["asOfDate", "asofdate", "asOf", "dataDate", "date"]  # not the NAV date, holdings are as of month end
+STATE_LISTS = {  # exact TransferState keys of the lists we read, anything else in the state is ignored
+    "topHoldings": "holding",
+    "top5Holdings": "holding",
+    "top5": "holding",
+    "assetAllocation": "asset_alloc",
+    "assetAllocations": "asset_alloc",
+    "countryAllocation": "country_alloc",
+    "countryAllocations": "country_alloc",
+}
+LIST_WRAPPERS = ["items", "data", "list"]  # {"topHoldings": {"asOfDate": ..., "items": [...]}}
+_SEEN = {}  # fund code -> rows found in some page state, lets later scrapers skip their own fetch
+_STATS = {}
+_LOCK = threading.Lock()
+
+def state_span(content):
+    # the state sits in one <script> tag, found in the raw bytes without decoding or building a tree
+    start = content.find(STATE_START)
+    if start < 0: return None
+    start = content.find(b">", start) + 1
+    end = content.find(STATE_END, start)
+    if start <= 0 or end < 0: return None
+    return start, end
+
+def unescape(raw):
+    for escaped, char in STATE_ESCAPES:
+        raw = raw.replace(escaped, char)
+    return raw
+
+def extract_state(content):
+    # content: the response body, bytes (str is encoded first)
+    if isinstance(content, str): content = content.encode("utf-8")
+    span = state_span(content)
+    if not span: return None
+    try: return json.loads(unescape(content[span[0]:span[1]]))
+    except: return None
+
+def quote_is_escaped(content, pos):
+    backslashes = 0
+    while pos > 0 and content[pos - 1] == 92:
+        backslashes += 1
+        pos -= 1
+    return backslashes % 2 == 1
+
+def has_key(content, keys):
+    # True when one of keys is a key somewhere in the still-escaped state, a plain bytes search
+    span = state_span(content)
+    if not span: return False
+    return any(content.find(b"&q;" + key.encode("utf-8") + b"&q;:", span[0], span[1]) >= 0 for key in keys)
+
+def extract_section(content, key):
+    # cuts the object stored under key out of the still-escaped state and decodes only that slice
+    # None when it isn't there or isn't an object, the caller then reads the whole state
+    span = state_span(content)
+    if not span: return None
+    needle = b"&q;" + key.encode("utf-8") + b"&q;:"
+    pos = content.find(needle, span[0], span[1])
+    if pos < 0: return None
+    start = content.find(b"{", pos + len(needle), span[1])
+    if start < 0 or content[pos + len(needle):start].strip(): return None
+    depth = 0
+    in_string = False
+    for m in ESCAPED_TOKEN.finditer(content, start, span[1]):
+        if m.group() == b"&q;":
+            if not quote_is_escaped(content, m.start()): in_string = not in_string
+        elif not in_string:
+            depth += 1 if m.group() == b"{" else -1
+            if depth == 0:
+                try: return json.loads(unescape(content[start:m.end()]))
+                except: return None
+    return None
+
+def format_state_date(value):
+    if not value: return ""
+    text = str(value).strip()
+    for fmt, size in (("%Y%m%d", 8), ("%Y-%m-%d", 10)):
+        try: return datetime.strptime(text[:size], fmt).strftime("%d-%m-%Y")
+        except: pass
+    return text
+
+def format_percent(value):
+    # state numbers spelled the way the pages print them (12.5 -> "12.50"), so state rows match the HTML rows;
+    # a string in the state is treated like page text, only the "%" goes
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f"{value:.{PERCENT_DECIMALS}f}"
+    return str(value).replace("%", "").strip()
+
+def first_key(item, keys):
+    for k in keys:
+        value = item.get(k)
+        if value not in (None, ""): return value
+    return None
+
+def rows_from_list(items):
+    rows = []
+    for item in items:
+        if not isinstance(item, dict): continue
+        name = first_key(item, NAME_KEYS)
+        percent = first_key(item, PERCENT_KEYS)
+        if name is None or percent is None or isinstance(percent, (dict, list)): continue
+        name = re.sub(r'\s+', ' ', str(name)).strip()
+        percent = format_percent(percent)
+        if name and percent: rows.append((name, percent))
+    # a list where most entries aren't name/percent pairs is something else (nav history, fees, ...)
+    return rows if len(rows) * 2 >= len(items) else []
+
+def walk(node, kind, as_of, found):
+    # kind is set only right under one of the STATE_LISTS keys (or its wrapper), never guessed from a path
+    if isinstance(node, dict):
+        date = first_key(node, DATE_KEYS)
+        if date is not None and not isinstance(date, (dict, list)): as_of = date
+        for k, v in node.items():
+            child_kind = STATE_LISTS.get(k) or (kind if k in LIST_WRAPPERS else None)
+            walk(v, child_kind, as_of, found)
+    elif isinstance(node, list) and node and isinstance(node[0], dict):
+        rows = rows_from_list(node) if kind else []
+        if rows and kind not in found:
+            found[kind] = [(name, percent, format_state_date(as_of)) for name, percent in rows]
+        elif not kind:
+            for v in node:
+                walk(v, None, as_of, found)
+
+def find_lists(node, path="", found=None):
+    # every list of name/percent entries anywhere in a state, whatever its key: [(path, rows, read by STATE_LISTS)]
+    # run it on a captured page to check STATE_LISTS against what the site really sends
+    if found is None: found = []
+    if isinstance(node, dict):
+        for k, v in node.items():
+            find_lists(v, f"{path}.{k}" if path else str(k), found)
+    elif isinstance(node, list) and node and isinstance(node[0], dict):
+        rows = rows_from_list(node)
+        if rows:
+            keys = path.split(".")
+            read = keys[-1] in STATE_LISTS or (len(keys) > 1 and keys[-1] in LIST_WRAPPERS and keys[-2] in STATE_LISTS)
+            found.append((path, len(rows), read))
+        else:
+            for i, v in enumerate(node):
+                find_lists(v, f"{path}[{i}]", found)
+    return found
+
+def parse_state(state):
+    # {"fund_detail": {...}, "holding": [(name, percent, as_of_date)], "asset_alloc": [...], "country_alloc": [...]}
+    # kinds the state doesn't have are left out, the caller falls back to the DOM for those
+    parsed = {}
+    if not isinstance(state, dict): return parsed
+    if isinstance(state.get("fund-detail"), dict): parsed["fund_detail"] = state["fund-detail"]
+    found = {}
+    walk(state, None, None, found)
+    parsed.update(found)
+    return parsed
+
+def remember(fund_code, parsed):
+    kinds = {k: v for k, v in parsed.items() if k in STATE_LISTS.values()}
+    if not kinds: return
+    with _LOCK: _SEEN.setdefault(fund_code, {}).update(kinds)
+
+def recall(fund_code, kinds):
+    # None unless a page state seen earlier in this process had every one of these kinds for the fund
+    with _LOCK: seen = _SEEN.get(fund_code, {})
+    if not all(k in seen for k in kinds): return None
+    return {k: seen[k] for k in kinds}
+
+def to_rows(parsed, kinds, fund_code, url):
+    rows = []
+    for kind in kinds:
+        for name, percent, as_of_date in parsed.get(kind) or []:
+            rows.append({
+                "fund_code": fund_code, "type": kind, "name": name,
+                "percent": percent, "as_of_date": as_of_date, "source_url": url
+            })
+    return rows
+
+def count(name, key):
+    with _LOCK:
+        stats = _STATS.setdefault(name, {"state": 0, "shared": 0, "dom": 0})
+        stats[key] += 1
+
+def state_summary(name):
+    # "dom" only counts funds whose rows the HTML had and the state didn't, so it is the state path's miss count
+    with _LOCK: s = dict(_STATS.pop(name, {"state": 0, "shared": 0, "dom": 0}))
+    total = s["state"] + s["shared"] + s["dom"]
+    summary = f"Page state ({name}): {s['state']} funds from JSON state, {s['shared']} from another page, {s['dom']} from HTML"
+    if total: summary += f" ({s['dom'] / total:.0%} missed by the state)"
+    if s["dom"] and not s["state"] and not s["shared"]:
+        # a wrong key would quietly send every fund to the HTML parser, this puts it in the saved log
+        summary += ", state lookup failed for every fund: check STATE_LISTS with benchmark_parsers.py --state-keys"
+    return summary